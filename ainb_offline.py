@@ -7,4 +7,7 @@ thisdir = os.path.dirname(abspath)
 os.chdir(thisdir)
 
 from src import main
-main.main()
+
+# Guarded for precompute's spawned workers, which import this as __mp_main__
+if __name__ == "__main__":
+    main.main()
@@ -0,0 +1,125 @@
+from __future__ import annotations
+from typing import *
+
+from .app_types import *
+
+
+# Reverse index of everything in an ainb that holds a node index: {target node_i: refs}.
+# Removing or inserting a node shifts every index after it, and with this only the refs to those nodes
+# get renumbered instead of walking every node's links+params on each op.
+# Refs point straight at the json containers, so ops that edit refs in place keep the index current themselves.
+
+class AinbNodeRefKinds:
+    LINK = "link"  # Linked Nodes[link_type][i]["Node Index"]
+    REPLACEMENT = "replacement"  # Linked Nodes[link_type][i]["Replacement Node Index"]
+    INPUT = "input"  # Input Parameters[param_type][i]["Node Index"], when it's not -1 or a multi param
+    SOURCE = "source"  # Input Parameters[param_type][i]["Sources"][j]["Node Index"]
+    PRECONDITION = "precondition"  # Precondition Nodes[i]
+    COMMAND_ROOT = "command_root"  # Commands[i]["Left Node Index"]
+    COMMAND_RIGHT = "command_right"  # Commands[i]["Right Node Index"], when it's not -1
+
+
+class AinbNodeRef:
+    __slots__ = ("kind", "owner", "container", "key", "target")
+
+    def __init__(self, kind: str, owner: dict, container: Union[dict, list], key: Union[str, int]):
+        self.kind = kind
+        self.owner = owner  # Node or command json holding this ref
+        self.container = container
+        self.key = key
+        # The node index it's filed under, only changed along with the index.
+        # Removal never reads the json back, which may have been changed since.
+        self.target: int = container[key]
+
+
+class AinbNodeRefs:
+    __slots__ = ("by_target", "by_owner")
+
+    # Name in MutableAinb.derived_cache, keyed on the file revision
+    DERIVED_NAME = "node_refs"
+
+    def __init__(self):
+        self.by_target: Dict[int, Set[AinbNodeRef]] = {}
+        self.by_owner: Dict[int, List[AinbNodeRef]] = {}  # {id(owner json): refs}, owners stay alive while they're in the file
+
+    @classmethod
+    def build(cls, ainb_json: dict) -> AinbNodeRefs:
+        refs = cls()
+        for command in ainb_json.get("Commands", []):
+            refs.add_owner(command, is_command=True)
+        for node in ainb_json.get("Nodes", []):
+            refs.add_owner(node)
+        return refs
+
+    @staticmethod
+    def scan_node(node: dict) -> List[AinbNodeRef]:
+        out = []
+        for links in node.get("Linked Nodes", {}).values():
+            for link in links:
+                out += AinbNodeRefs.scan_link(node, link)
+        for params in node.get(ParamSectionName.INPUT, {}).values():
+            for param in params:
+                if param.get("Node Index", -1) >= 0:
+                    out.append(AinbNodeRef(AinbNodeRefKinds.INPUT, node, param, "Node Index"))
+                for source in param.get("Sources", []):
+                    out.append(AinbNodeRef(AinbNodeRefKinds.SOURCE, node, source, "Node Index"))
+        preconditions = node.get("Precondition Nodes", [])
+        for i in range(len(preconditions)):
+            out.append(AinbNodeRef(AinbNodeRefKinds.PRECONDITION, node, preconditions, i))
+        return out
+
+    @staticmethod
+    def scan_link(node: dict, link: dict) -> List[AinbNodeRef]:
+        out = [AinbNodeRef(AinbNodeRefKinds.LINK, node, link, "Node Index")]
+        if "Replacement Node Index" in link:
+            out.append(AinbNodeRef(AinbNodeRefKinds.REPLACEMENT, node, link, "Replacement Node Index"))
+        return out
+
+    @staticmethod
+    def scan_command(command: dict) -> List[AinbNodeRef]:
+        out = [AinbNodeRef(AinbNodeRefKinds.COMMAND_ROOT, command, command, "Left Node Index")]
+        if command.get("Right Node Index", -1) >= 0:
+            out.append(AinbNodeRef(AinbNodeRefKinds.COMMAND_RIGHT, command, command, "Right Node Index"))
+        return out
+
+    def add_refs(self, owner: dict, refs: List[AinbNodeRef]) -> None:
+        self.by_owner.setdefault(id(owner), []).extend(refs)
+        for ref in refs:
+            self.by_target.setdefault(ref.target, set()).add(ref)
+
+    def add_owner(self, owner: dict, is_command: bool = False) -> None:
+        self.add_refs(owner, self.scan_command(owner) if is_command else self.scan_node(owner))
+
+    def remove_owner(self, owner: dict) -> None:
+        for ref in self.by_owner.pop(id(owner), []):
+            self.by_target[ref.target].discard(ref)
+
+    def reindex_owner(self, owner: dict, is_command: bool = False) -> None:
+        # After an owner's refs were moved around or replaced, eg list entries removed or a section restored
+        self.remove_owner(owner)
+        self.add_owner(owner, is_command=is_command)
+
+    def remove_container(self, owner: dict, container: Union[dict, list]) -> None:
+        # Drop the refs held by something that left the owner, eg a removed link
+        kept = []
+        for ref in self.by_owner.get(id(owner), []):
+            if ref.container is container:
+                self.by_target[ref.target].discard(ref)
+            else:
+                kept.append(ref)
+        self.by_owner[id(owner)] = kept
+
+    def get_refs_to(self, node_i: int) -> Set[AinbNodeRef]:
+        return self.by_target.get(node_i, set())
+
+    def shift_targets(self, node_i: int, delta: int) -> None:
+        # Every ref to node_i or later moves by delta, only those refs are touched
+        shifted = {}
+        for target, refs in self.by_target.items():
+            if target >= node_i:
+                target += delta
+                for ref in refs:
+                    ref.container[ref.key] = ref.target = target
+            if refs:
+                shifted[target] = refs
+        self.by_target = shifted
@@ -1,4 +1,5 @@
 from collections import defaultdict
+import contextlib
 import functools
 import os
 import pathlib
@@ -8,8 +9,10 @@ from typing import *
 import dearpygui.dearpygui as dpg
 
 from .app_types import *
-from .db import Connection, AinbFileNodeUsageIndex, PackIndex
+from .db import Connection, AinbFileInfoIndex, AinbFileNodeUsageIndex, AinbUserDefinedParamCatalog, ContentSearchIndex, FilePathIndex, PackIndex
+from .db import NodeSignature, UserDefinedParamUsage
 from .dt_tools.ainb import AINB
+from .dt_tools.asb import ASB
 from . import pack_util
 
 
@@ -43,7 +46,21 @@ def scoped_pack_lookup(req: PackIndexEntry) -> PackIndexEntry:
 
 @functools.lru_cache
 def get_pack_index_by_extension(ext: RomfsFileTypes) -> Dict[str, Dict[str, PackIndexEntry]]:
-    return PackIndex.get_all_entries_by_extension(Connection.get(), ext)
+    with Connection.reader() as conn:
+        return PackIndex.get_all_entries_by_extension(conn, ext)
+
+
+@functools.lru_cache
+def get_node_catalog(file_category: str) -> Dict[str, List[NodeSignature]]:
+    # Crawl results don't change during a session, so the palette only ever hits the db once per category
+    with Connection.reader() as conn:
+        return AinbFileNodeUsageIndex.get_catalog(conn, file_category)
+
+
+@functools.lru_cache
+def get_userdefined_catalog(file_category: str) -> Dict[str, List[UserDefinedParamUsage]]:
+    with Connection.reader() as conn:
+        return AinbUserDefinedParamCatalog.get_by_file_category(conn, file_category)
 
 
 def build_indexes_for_unknown_files() -> None:
@@ -51,7 +68,7 @@ def build_indexes_for_unknown_files() -> None:
     entry_hit = 0
     entry_total = 0
 
-    with Connection.get() as conn:
+    with Connection.writer() as conn:
         ainb_cache = PackIndex.get_all_entries_by_extension(conn, RomfsFileTypes.AINB)
         asb_cache = PackIndex.get_all_entries_by_extension(conn, RomfsFileTypes.ASB)
 
@@ -128,6 +145,7 @@ def build_indexes_for_unknown_files() -> None:
         if entry_hit < entry_total:
             print(f"Ranking param usage... (please wait a long time)", flush=True)
             AinbFileNodeUsageIndex.postprocess(conn)
+            FilePathIndex.rebuild(conn)
             print(f"Caching {entry_total-entry_hit} new entries", flush=True)
 
     print(f"Cache hits {entry_hit}/{entry_total}\n", flush=True)
@@ -143,19 +161,19 @@ def inspect_pack(conn: sqlite3.Connection, rootfs: str, packfile: str, pack_data
 
     # Crawl each ainb to discover param info per node type.
     for internalfile, data in pack_data[RomfsFileTypes.AINB].items():
+        location = PackIndexEntry(packfile=packfile, internalfile=internalfile, extension=RomfsFileTypes.AINB)
         if packfile == "Root":
-            data = memoryview(open(f"{rootfs}/{internalfile}", "rb").read())
-        ainb_json = AINB(data).output_dict
+            data_ctx = pack_util.open_mmap(f"{rootfs}/{internalfile}")
+        else:
+            data_ctx = contextlib.nullcontext(data)
+        with data_ctx as data:
+            ainb_json = AINB(data).output_dict
+            AinbFileInfoIndex.persist(conn, location, ainb_json, data)
 
-        # TODO index file level info in another table?
-        fullfile = PackIndexEntry(packfile=packfile, internalfile=internalfile, extension=RomfsFileTypes.AINB).fullfile
+        ContentSearchIndex.persist_file(conn, location, ainb_json)
         file_category = ainb_json["Info"]["File Category"]
-        #file_globals = ainb_json.get(ParamSectionName.GLOBAL, {})
-        #AinbFileInfoIndex.add(fullfile, file_category, file_globals)
 
-        # TODO additional table for userdefined classes/instantiation/??? detail,
-        # since just counting userdefineds leaves a lot of type info out.
-        # might be able to generally add metadata/flags/etc to all params this way?
+        # might be able to generally add metadata/flags/etc to all params like the userdefined catalog?
 
         for node_i, aj_node in enumerate(ainb_json.get("Nodes", [])):
             node_type = aj_node["Node Type"]
@@ -172,4 +190,13 @@ def inspect_pack(conn: sqlite3.Connection, rootfs: str, packfile: str, pack_data
 
             # aj_node.get("Linked Nodes", {})
             AinbFileNodeUsageIndex.persist(conn, file_category, node_type, param_details)
+            AinbUserDefinedParamCatalog.persist_node(conn, file_category, node_type, aj_node)
 
+    # asbs only feed search for now
+    for internalfile, data in pack_data[RomfsFileTypes.ASB].items():
+        if packfile == "Root":
+            asb_json = ASB(pack_util.load_compressed_file(f"{rootfs}/{internalfile}")).output_dict
+        else:
+            asb_json = ASB(data).output_dict
+        location = PackIndexEntry(packfile=packfile, internalfile=internalfile, extension=RomfsFileTypes.ASB)
+        ContentSearchIndex.persist_file(conn, location, asb_json)
@@ -0,0 +1,306 @@
+from concurrent.futures import Future, ProcessPoolExecutor, as_completed
+import hashlib
+import multiprocessing
+import os
+import sqlite3
+from typing import *
+
+import dearpygui.dearpygui as dpg
+import graphviz
+import orjson
+from . import curio
+
+from .app_types import *
+from .db import Connection, AinbGraphLayoutCache, PackIndex
+from .dt_tools.ainb import AINB
+from . import pack_util
+
+
+# Optional stage after the crawl: compute what opening a file would otherwise compute on first open (graph layouts),
+# so first opens show a graph right away. Runs from the Debug menu at low priority, or headless with --precompute[=N].
+# Layouts here are made without dpg, node sizes are estimated from what the graph editor would render.
+# They're stored as estimated, and the editor lays the graph out again from real node sizes the first time it's opened.
+
+
+PRECOMPUTE_CORES_ENV = "PRECOMPUTE_CORES"
+PROGRESS_TAG = "precompute/progress"
+is_precompute_running = False  # In the app, so the Debug menu can't start a second pool
+
+# Rough metrics for the 16px font + default dpg node styling, only needs to be close enough for graphviz spacing
+CHAR_WIDTH = 8
+ROW_HEIGHT = 24
+TITLE_HEIGHT = 28
+NODE_PADDING = 16
+GLOBALS_NODE_I = -420
+PARAM_INPUT_WIDTHS = {
+    "int": 80,
+    "bool": 20,
+    "float": 100,
+    "string": 150,
+    "vec3f": 300,
+    "userdefined": 300,
+}
+
+
+def get_core_budget(requested: Optional[int] = None) -> int:
+    # 0/None means everything but one core, which stays with the ui
+    if not requested:
+        requested = int(os.environ.get(PRECOMPUTE_CORES_ENV) or 0)
+    cpu_count = os.cpu_count() or 1
+    if requested <= 0:
+        requested = cpu_count - 1
+    return max(1, min(requested, cpu_count))
+
+
+def get_layout_key(ainb_json: dict) -> str:
+    # Layouts only depend on which nodes exist and how they're linked, param edits don't invalidate them
+    structure = [
+        (node_i, node.get("Node Type"), [
+            link.get("Node Index") for links in node.get("Linked Nodes", {}).values() for link in links
+        ])
+        for node_i, node in enumerate(ainb_json.get("Nodes", []))
+    ]
+    return hashlib.blake2b(orjson.dumps(structure), digest_size=16).hexdigest()
+
+
+def get_layout_edges(ainb_json: dict) -> List[Tuple[int, int]]:
+    # Same src -> dst directions the graph editor links with, minus resolving which params are involved
+    nodes = ainb_json.get("Nodes", [])
+    edges = []
+    for node_i, node in enumerate(nodes):
+        for link_type, links in node.get("Linked Nodes", {}).items():
+            for link in links:
+                remote_i = link.get("Node Index")
+                if remote_i is None or not (0 <= remote_i < len(nodes)):
+                    continue
+                if link_type in ("Standard Link", "Resident Update Link"):
+                    edges.append((node_i, remote_i))
+                elif link_type in ("String Input Link", "int Input Link"):
+                    edges.append((remote_i, node_i))
+                elif link_type == "Output/bool Input/float Input Link":
+                    edges += _get_bidirectional_link_edges(node_i, node, link)
+    return edges
+
+
+def _get_bidirectional_link_edges(node_i: int, node: dict, link: dict) -> List[Tuple[int, int]]:
+    param_name = link.get("Parameter")
+    for params in node.get(ParamSectionName.INPUT, {}).values():
+        for param in params:
+            if param.get("Name") != param_name:
+                continue
+            if param.get("Node Index", 0) <= -100:
+                # multi, every source feeds this input
+                return [(src["Node Index"], node_i) for src in param.get("Sources", []) if not src.get("Function")]
+            return [(link["Node Index"], node_i)]
+    return [(node_i, link["Node Index"])]
+
+
+def estimate_param_row_width(section: str, param_type: str, i_of_type: int, param: dict) -> int:
+    label = f"{param_type} {i_of_type}: {param.get('Name', '')}"
+    width = (len(label) + 2) * CHAR_WIDTH  # + one char section legend
+    if section != ParamSectionName.OUTPUT:
+        width += PARAM_INPUT_WIDTHS.get(param_type, 300) + CHAR_WIDTH
+    return width
+
+
+def estimate_node_size(ainb_json: dict, node_i: int) -> Tuple[int, int]:
+    # -> (w, h) in pixels, like dpg's rect_size for the rendered node
+    if node_i == GLOBALS_NODE_I:
+        label = ParamSectionName.GLOBAL
+        sections = {ParamSectionName.GLOBAL: ainb_json.get(ParamSectionName.GLOBAL, {})}
+        row_widths = []
+    else:
+        node = ainb_json["Nodes"][node_i]
+        node_type = node["Name"] if node["Node Type"] == "UserDefined" else node["Node Type"]
+        label = f"{node_type} ({node_i})"
+        sections = {s: node.get(s, {}) for s in (ParamSectionName.IMMEDIATE, ParamSectionName.INPUT, ParamSectionName.OUTPUT)}
+
+        # Top meta: commands and flags, external modules get an extra button
+        row_widths = [len(f"@ Command[{cmd['Name']}]") * CHAR_WIDTH for cmd in ainb_json.get("Commands", []) if cmd["Left Node Index"] == node_i]
+        for flag in node.get("Flags", []):
+            if flag == "Is External AINB":
+                row_widths.append((len(node["Name"]) * 2 + 40) * CHAR_WIDTH)
+            else:
+                row_widths.append(len(f"@ {flag}") * CHAR_WIDTH)
+
+        # Standard/resident links each get their own output attribute
+        for link_type, links in node.get("Linked Nodes", {}).items():
+            if link_type not in ("Standard Link", "Resident Update Link"):
+                continue
+            for link in links:
+                text = link.get("Connection Name") or link.get("Condition") or f"[{link_type}]"
+                row_widths.append((len(text) + 12) * CHAR_WIDTH)
+
+    for section, typed_params in sections.items():
+        for param_type, params in typed_params.items():
+            for i_of_type, param in enumerate(params):
+                row_widths.append(estimate_param_row_width(section, param_type, i_of_type, param))
+
+    w = max([len(label) * CHAR_WIDTH, *row_widths]) + 2 * NODE_PADDING
+    h = TITLE_HEIGHT + ROW_HEIGHT * max(1, len(row_widths)) + NODE_PADDING
+    return w, h
+
+
+def compute_layout(ainb_json: dict) -> Dict[int, Tuple[int, int]]:
+    # Headless version of AinbGraphLayout.finalize
+    dot = graphviz.Digraph(
+        "hi",
+        graph_attr={"rankdir": "LR"},
+        node_attr={"fontsize": "16", "fixedsize": "true", "shape": "box"}
+    )
+    node_indexes = list(range(len(ainb_json.get("Nodes", []))))
+    if ainb_json.get(ParamSectionName.GLOBAL):
+        node_indexes.insert(0, GLOBALS_NODE_I)
+    for node_i in node_indexes:
+        w, h = estimate_node_size(ainb_json, node_i)
+        dot.node(str(node_i), label=str(node_i), width=str(w / 50), height=str(h / 50))
+    for src_i, dst_i in get_layout_edges(ainb_json):
+        dot.edge(str(src_i), str(dst_i))
+
+    graphdump = orjson.loads(dot.pipe("json"))
+    out = {}
+    for obj in graphdump.get("objects", []):
+        x, y = obj["pos"].split(",")
+        out[int(obj["name"])] = int(float(x)), -1 * int(float(y))
+    return out
+
+
+def find_missing_layouts(conn: sqlite3.Connection) -> Dict[str, List[str]]:
+    # {packfile: [internalfile]} for every crawled ainb without any cached layout
+    have_layouts = AinbGraphLayoutCache.get_all_fullfiles(conn)
+    out = {}
+    for packfile, entries in PackIndex.get_all_entries_by_extension(conn, RomfsFileTypes.AINB).items():
+        if missing := [e.internalfile for e in entries.values() if e.fullfile not in have_layouts]:
+            out[packfile] = missing
+    return out
+
+
+def init_worker(romfs: str, title_version: str) -> None:
+    # Worker processes get just enough app config for pack_util, and stay out of the ui's way
+    if hasattr(os, "nice"):
+        os.nice(10)
+    dpg.create_context()
+    with dpg.value_registry():
+        dpg.add_string_value(tag=AppConfigKeys.ROMFS_PATH, default_value=romfs)
+        dpg.add_string_value(tag=AppConfigKeys.TITLE_VERSION, default_value=title_version)
+
+
+def precompute_pack(romfs: str, packfile: str, internalfiles: List[str]) -> List[Tuple[str, str, Dict[int, Tuple[int, int]]]]:
+    # Runs in a worker process, one pack at a time so each pack is only decompressed once.
+    # -> [(fullfile, layout_key, layout_data)], the parent does all the writing
+    if packfile == "Root":
+        datas = {f: None for f in internalfiles}
+    else:
+        try:
+            datas = pack_util.load_ext_files_from_pack(f"{romfs}/{packfile}", [RomfsFileTypes.AINB])[RomfsFileTypes.AINB]
+        except Exception as e:
+            # Only this pack is skipped, the rest of the run goes on
+            print(f"Precompute failed to load {packfile}: {e}")
+            return []
+
+    out = []
+    for internalfile in internalfiles:
+        location = PackIndexEntry(internalfile=internalfile, packfile=packfile, extension=RomfsFileTypes.AINB)
+        try:
+            if packfile == "Root":
+                with pack_util.open_mmap(f"{romfs}/{internalfile}") as data:
+                    ainb_json = AINB(data).output_dict
+            else:
+                ainb_json = AINB(datas[internalfile]).output_dict
+            out.append((location.fullfile, get_layout_key(ainb_json), compute_layout(ainb_json)))
+        except Exception as e:
+            # Some files hit layout loops etc, they'll just be laid out on open like before
+            print(f"Precompute failed for {location.fullfile}: {e}")
+    return out
+
+
+def persist_pack_result(future: Future) -> int:
+    # Blocking, call from a thread when the ui is running
+    rows = future.result()
+    with Connection.writer() as conn:
+        for fullfile, layout_key, layout_data in rows:
+            AinbGraphLayoutCache.persist(conn, fullfile, layout_key, layout_data, is_estimated=True)
+    return len(rows)
+
+
+def make_pool(core_budget: int) -> ProcessPoolExecutor:
+    # spawn, never fork a process that has dpg+sqlite+threads going
+    romfs = dpg.get_value(AppConfigKeys.ROMFS_PATH)
+    title_version = dpg.get_value(AppConfigKeys.TITLE_VERSION)
+    return ProcessPoolExecutor(
+        max_workers=core_budget,
+        mp_context=multiprocessing.get_context("spawn"),
+        initializer=init_worker,
+        initargs=(romfs, title_version),
+    )
+
+
+def submit_all(pool: ProcessPoolExecutor, todo: Dict[str, List[str]]) -> Dict[Future, str]:
+    romfs = dpg.get_value(AppConfigKeys.ROMFS_PATH)
+    # Biggest packs first so one straggler doesn't hold up the tail
+    by_size = sorted(todo.items(), key=lambda kv: -len(kv[1]))
+    return {pool.submit(precompute_pack, romfs, packfile, internalfiles): packfile for packfile, internalfiles in by_size}
+
+
+def run_precompute(core_budget: Optional[int] = None) -> int:
+    # Headless, for the --precompute cli
+    core_budget = get_core_budget(core_budget)
+    with Connection.reader() as conn:
+        todo = find_missing_layouts(conn)
+    total = sum(len(v) for v in todo.values())
+    print(f"Precomputing {total} layouts on {core_budget} cores", flush=True)
+
+    done = 0
+    with make_pool(core_budget) as pool:
+        futures = submit_all(pool, todo)
+        for future in as_completed(futures):
+            done += persist_pack_result(future)
+            print(f"{done}/{total} {futures[future]}", flush=True)
+    print(f"Precomputed {done}/{total} layouts", flush=True)
+    return done
+
+
+async def precompute_as_coro(core_budget: Optional[int] = None, dpg_args=None) -> None:
+    # Background version for the running app
+    global is_precompute_running
+    if is_precompute_running:
+        return  # Menu clicked again, one pool at a time is plenty
+    is_precompute_running = True
+    try:
+        await precompute_in_pool(core_budget)
+    finally:
+        is_precompute_running = False
+
+
+async def precompute_in_pool(core_budget: Optional[int]) -> None:
+    core_budget = get_core_budget(core_budget)
+    with Connection.reader() as conn:
+        todo = find_missing_layouts(conn)
+    total = sum(len(v) for v in todo.values())
+
+    done = 0
+    pool = make_pool(core_budget)
+    try:
+        futures = submit_all(pool, todo)
+        # Whichever pack finishes first gets saved first, the biggest ones were submitted first and take longest
+        completed = as_completed(futures)
+        for _ in range(len(futures)):
+            future = await curio.run_in_thread(next, completed)
+            done += await curio.run_in_thread(persist_pack_result, future)
+            show_progress(done, total, futures[future])
+        show_progress(done, total, None)
+    finally:
+        # Also on cancellation at app exit, don't leave workers grinding through the queue
+        pool.shutdown(wait=False, cancel_futures=True)
+
+
+def show_progress(done: int, total: int, packfile: Optional[str]) -> None:
+    if not dpg.does_item_exist(PROGRESS_TAG):
+        return
+    dpg.show_item(PROGRESS_TAG)
+    if packfile is None:
+        dpg.configure_item(PROGRESS_TAG, overlay=f"Precomputed {done} layouts")
+        dpg.set_value(PROGRESS_TAG, 1.0)
+        return
+    dpg.configure_item(PROGRESS_TAG, overlay=f"Precomputing {done}/{total}: {packfile}")
+    dpg.set_value(PROGRESS_TAG, done / max(total, 1))
@@ -86,7 +86,13 @@ class DeferredNodeLinkCall:
 # These represent mutations for the dt_tools.ainb.AINB.output_dict json dict
 AinbEditOperationTypes = ConstDottableStringSet({
     "ADD_NODE",  # Use `op_value: dict` as node json, executor assigns the Node Index
-    "REPLACE_JSON",  # Overwrite entire ainb with `op_value: str` json
+    "REMOVE_LAST_NODE",  # Inverse of ADD_NODE, pops the last node
+    "REMOVE_NODE",  # Remove the node at op_selector, unhooking anything pointing at it and renumbering the nodes after it
+    "INSERT_NODE",  # Inverse of REMOVE_NODE, `op_value: {"Node": dict, "Restore": jsondiff.JsonPatch}` goes back in at op_selector
+    "ADD_LINK",  # Insert `op_value: dict` as the link at op_selector, Nodes[node_i]["Linked Nodes"][link_type][i_of_link_type]
+    "REMOVE_LINK",  # Remove the link at op_selector, inverse of ADD_LINK
+    "REPLACE_JSON",  # Overwrite entire ainb with `op_value: str` json, applied as a diff
+    "JSON_PATCH",  # Apply `op_value: jsondiff.JsonPatch`, the small form of REPLACE_JSON
     "PARAM_UPDATE_DEFAULT",  # Set the "Value" to op_value for a param found with op_selector
 })
 
@@ -94,7 +100,9 @@ AinbEditOperationTypes = ConstDottableStringSet({
 # These represent mutations for the dt_tools.asb.ASB.output_dict json dict
 AsbEditOperationTypes = ConstDottableStringSet({
     "ADD_NODE",  # Use `op_value: dict` as node json, executor assigns the Node Index
-    "REPLACE_JSON",  # Overwrite entire asb with `op_value: str` json
+    "REMOVE_LAST_NODE",  # Inverse of ADD_NODE, pops the last node
+    "REPLACE_JSON",  # Overwrite entire asb with `op_value: str` json, applied as a diff
+    "JSON_PATCH",  # Apply `op_value: jsondiff.JsonPatch`, the small form of REPLACE_JSON
     "PARAM_UPDATE_DEFAULT",  # Set the "Value" to op_value for a param found with op_selector
 })
 
@@ -109,7 +117,9 @@ class AinbEditOperation:
     op_value: Any
     op_selector: Optional["JSONPath"] = None
     when: datetime = field(default_factory=datetime.now)
-    filehash = None  # TODO this should be set on certain persist+export events
+    filehash: Optional[str] = None  # Hash of the data this op was saved as, when it was the latest op at a save
+    seq: Optional[int] = None  # Position in the file's edit journal, assigned when first recorded
+    is_save_pending: bool = False  # Serialized into a queued save, its value must stay what was written (not journaled)
 
 
 @dataclass
@@ -118,7 +128,9 @@ class AsbEditOperation:
     op_value: Any
     op_selector: Union[AsbEditOperationDefaultValueSelector] = None
     when: datetime = field(default_factory=datetime.now)
-    filehash = None  # TODO this should be set on certain persist+export events
+    filehash: Optional[str] = None  # Hash of the data this op was saved as, when it was the latest op at a save
+    seq: Optional[int] = None  # Position in the file's edit journal, assigned when first recorded
+    is_save_pending: bool = False  # Serialized into a queued save, its value must stay what was written (not journaled)
 
 
 @dataclass(frozen=True)
@@ -179,6 +191,11 @@ class PackIndexEntry:
     def fullfile(self) -> str:
         return f"{self.packfile}:{self.internalfile}"
 
+    @classmethod
+    def from_fullfile(cls, fullfile: str) -> "PackIndexEntry":
+        packfile, internalfile = fullfile.split(":", 1)
+        return cls(internalfile=internalfile, packfile=packfile, extension=RomfsFileTypes.get_from_filename(internalfile))
+
     # Intended to normalize short relative paths so db files are compatible, Root pack vs real pack lookup consistency, etc
     @staticmethod
     def fix_backslashes(file: Union[str, pathlib.Path]) -> str:
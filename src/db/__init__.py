@@ -1,3 +1,10 @@
 from .connection import *
+from .ainb_file_info_index import *
 from .ainb_file_node_usage_index import *
+from .ainb_graph_layout_cache import *
+from .ainb_userdefined_param_catalog import *
+from .content_search_index import *
+from .edit_history import *
+from .file_path_index import *
 from .pack_index import *
+from .undo_spill import *
@@ -0,0 +1,124 @@
+import hashlib
+import sqlite3
+from typing import *
+
+import orjson
+
+from ..app_types import *
+
+
+# File level facts from the crawl, so "largest Logic files" or "files with global X" never parse anything
+
+
+class AinbFileInfoIndex:
+    TABLE = "ainb_file_info_index"
+    SORTABLE_COLUMNS = ("fullfile", "file_category", "node_count", "command_count", "global_count", "embedded_count", "byte_size")
+
+    @classmethod
+    def emit_create(cls) -> List[str]:
+        return [f"""
+            CREATE TABLE IF NOT EXISTS {cls.TABLE}(
+                fullfile TEXT,
+                packfile TEXT,
+                internalfile TEXT,
+                file_category TEXT,
+                node_count INT,
+                command_count INT,
+                command_names_csv TEXT,
+                global_count INT,
+                embedded_count INT,
+                file_hash TEXT,
+                byte_size INT,
+                PRIMARY KEY(fullfile ASC)
+            ) WITHOUT ROWID;""",
+            f"""CREATE INDEX IF NOT EXISTS idx_afii_category_size ON {cls.TABLE} (file_category, byte_size);""",
+        ]
+
+    @staticmethod
+    def hash_data(data: Union[bytes, memoryview]) -> str:
+        # Only for telling files apart, doesn't need to match anything in the ainb's own File Hashes
+        return hashlib.blake2b(data, digest_size=8).hexdigest()
+
+    @classmethod
+    def persist(cls, conn: sqlite3.Connection, location: PackIndexEntry, ainb_json: dict, data: Union[bytes, memoryview]) -> None:
+        command_names = [cmd.get("Name", "") for cmd in ainb_json.get("Commands", [])]
+        global_count = sum(len(params) for params in ainb_json.get(ParamSectionName.GLOBAL, {}).values())
+        conn.execute(f"""
+            INSERT OR REPLACE INTO {cls.TABLE}
+            (fullfile, packfile, internalfile, file_category, node_count, command_count, command_names_csv, global_count, embedded_count, file_hash, byte_size)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?);
+            """, (
+                location.fullfile, location.packfile, location.internalfile,
+                ainb_json["Info"]["File Category"],
+                len(ainb_json.get("Nodes", [])),
+                len(command_names),
+                ",".join(command_names),
+                global_count,
+                len(ainb_json.get("Embedded AINB Files", [])),
+                cls.hash_data(data),
+                len(data),
+            ))
+        AinbFileGlobalParamIndex.persist(conn, location, ainb_json.get(ParamSectionName.GLOBAL, {}))
+
+    @classmethod
+    def get_file_categories(cls, conn: sqlite3.Connection) -> List[str]:
+        return [r[0] for r in conn.execute(f"SELECT DISTINCT file_category FROM {cls.TABLE} ORDER BY file_category;")]
+
+    @classmethod
+    def query(
+        cls,
+        conn: sqlite3.Connection,
+        order_by: str = "fullfile",
+        descending: bool = False,
+        file_category: Optional[str] = None,
+        global_name: Optional[str] = None,
+        limit: int = 1000,
+    ) -> List[tuple]:
+        # -> [(packfile, internalfile, file_category, node_count, command_count, command_names_csv, global_count, embedded_count, byte_size)]
+        if order_by not in cls.SORTABLE_COLUMNS:
+            raise ValueError(f"Cannot sort by {order_by}")
+        where, params = [], []
+        if file_category:
+            where.append("i.file_category = ?")
+            params.append(file_category)
+        if global_name:
+            where.append(f"i.fullfile IN (SELECT fullfile FROM {AinbFileGlobalParamIndex.TABLE} WHERE name = ?)")
+            params.append(global_name)
+        where_sql = f"WHERE {' AND '.join(where)}" if where else ""
+        direction = "DESC" if descending else "ASC"
+        return conn.execute(f"""
+            SELECT i.packfile, i.internalfile, i.file_category, i.node_count, i.command_count, i.command_names_csv, i.global_count, i.embedded_count, i.byte_size
+            FROM {cls.TABLE} AS i
+            {where_sql}
+            ORDER BY i.{order_by} {direction}, i.fullfile ASC
+            LIMIT ?;
+            """, (*params, limit)).fetchall()
+
+
+class AinbFileGlobalParamIndex:
+    TABLE = "ainb_file_global_param_index"
+
+    @classmethod
+    def emit_create(cls) -> List[str]:
+        return [f"""
+            CREATE TABLE IF NOT EXISTS {cls.TABLE}(
+                fullfile TEXT,
+                param_type TEXT,
+                i_of_type INT,
+                name TEXT,
+                default_value_json TEXT,
+                PRIMARY KEY(fullfile ASC, param_type ASC, i_of_type ASC)
+            ) WITHOUT ROWID;""",
+            f"""CREATE INDEX IF NOT EXISTS idx_afgpi_name ON {cls.TABLE} (name, fullfile);""",
+        ]
+
+    @classmethod
+    def persist(cls, conn: sqlite3.Connection, location: PackIndexEntry, global_params: dict) -> None:
+        rows = []
+        for param_type, params in global_params.items():
+            for i_of_type, param in enumerate(params):
+                rows.append((location.fullfile, param_type, i_of_type, param.get("Name", ""), orjson.dumps(param.get("Default Value"))))
+        conn.executemany(f"""
+            INSERT OR REPLACE INTO {cls.TABLE}(fullfile, param_type, i_of_type, name, default_value_json)
+            VALUES (?, ?, ?, ?, ?);
+            """, rows)
@@ -1,12 +1,35 @@
+from dataclasses import dataclass, field
+import hashlib
 import sqlite3
 from typing import *
 
 import orjson
 
+from ..app_types import *
+
 # Element_Expression is not used in Logic
 # Element_Expression is the only node type with multiple signatures (userdefined param class sig uniqueness tbd)
 
 
+@dataclass(frozen=True)
+class NodeSignatureParam:
+    param_section: str
+    param_type: str
+    i_of_type: int
+    name: str
+    class_name: Optional[str]  # userdefined only
+
+
+@dataclass
+class NodeSignature:
+    # One distinct set of param details seen for a node type, in one file category
+    node_type: str
+    signature_id: str
+    usage_count: int
+    is_most_common: bool
+    params: List[NodeSignatureParam] = field(default_factory=list)
+
+
 class AinbFileNodeUsageIndex:
     TABLE = "ainb_file_node_usage_index"
 
@@ -16,44 +39,110 @@ class AinbFileNodeUsageIndex:
             CREATE TABLE IF NOT EXISTS {cls.TABLE}(
                 file_category TEXT,
                 node_type TEXT,
-                param_details_json TEXT,
+                signature_id TEXT,
                 detailset_usage_count INT,
                 is_most_common INT,
-                PRIMARY KEY(file_category ASC, node_type ASC, param_details_json ASC)
+                PRIMARY KEY(file_category ASC, node_type ASC, signature_id ASC)
             ) WITHOUT ROWID;""",
             f"""CREATE INDEX IF NOT EXISTS idx_afnui_lookup1 ON {cls.TABLE} (file_category, node_type, is_most_common);""",
         ]
 
+    @staticmethod
+    def get_signature_id(param_details_json: dict) -> str:
+        return hashlib.blake2b(orjson.dumps(param_details_json, option=orjson.OPT_SORT_KEYS), digest_size=12).hexdigest()
+
     @classmethod
     def persist(cls, conn: sqlite3.Connection, file_category: str, node_type: str, param_details_json: dict) -> None:
         # Count which full param data are most often used (to call this node type, in this ainb file category)
+        signature_id = cls.get_signature_id(param_details_json)
+        AinbNodeSignatureParam.persist_once(conn, signature_id, param_details_json)
         conn.execute(f"""
             INSERT INTO {cls.TABLE}
-            (file_category, node_type, param_details_json, detailset_usage_count, is_most_common)
+            (file_category, node_type, signature_id, detailset_usage_count, is_most_common)
             VALUES (?, ?, ?, 1, 0)
             ON CONFLICT DO UPDATE SET detailset_usage_count = detailset_usage_count + 1
-            """, (file_category, node_type, orjson.dumps(param_details_json)))
+            """, (file_category, node_type, signature_id))
 
     @classmethod
     def postprocess(cls, conn: sqlite3.Connection) -> None:
-        # After all rows are persisted, mark the most common
+        # After all rows are persisted, mark exactly one most common per node type. Ties go to the lowest id so reruns agree.
         conn.execute(f"""
             UPDATE {cls.TABLE} AS t1
-            SET is_most_common = 1
-            WHERE t1.detailset_usage_count = (
-                SELECT MAX(detailset_usage_count)
+            SET is_most_common = (t1.signature_id = (
+                SELECT t2.signature_id
                 FROM {cls.TABLE} AS t2
                 WHERE t2.file_category = t1.file_category
                 AND t2.node_type = t1.node_type
-            );""")
+                ORDER BY t2.detailset_usage_count DESC, t2.signature_id ASC
+                LIMIT 1
+            ));""")
+
+    @classmethod
+    def get_catalog(cls, conn: sqlite3.Connection, file_category: str) -> Dict[str, List[NodeSignature]]:
+        # {node_type: [most common signature, other variants by usage...]}, all from structured rows
+        out: Dict[str, List[NodeSignature]] = {}
+        cursor = conn.execute(f"""
+            SELECT u.node_type, u.signature_id, u.detailset_usage_count, u.is_most_common,
+                p.param_section, p.param_type, p.i_of_type, p.param_name, p.class_name
+            FROM {cls.TABLE} AS u
+            LEFT JOIN {AinbNodeSignatureParam.TABLE} AS p ON p.signature_id = u.signature_id
+            WHERE u.file_category = ?
+            ORDER BY u.node_type ASC, u.is_most_common DESC, u.detailset_usage_count DESC, u.signature_id ASC,
+                p.param_section ASC, p.param_type ASC, p.i_of_type ASC;
+            """, (file_category,))
+        sig = None
+        for node_type, signature_id, usage_count, is_most_common, section, param_type, i_of_type, name, class_name in cursor:
+            if sig is None or sig.signature_id != signature_id or sig.node_type != node_type:
+                sig = NodeSignature(node_type, signature_id, usage_count, bool(is_most_common))
+                out.setdefault(node_type, []).append(sig)
+            if section is not None:
+                sig.params.append(NodeSignatureParam(section, param_type, i_of_type, name, class_name))
+        return out
+
+
+class AinbNodeSignatureParam:
+    # Signatures are shared between node types+categories, so each one's params are only stored once
+    TABLE = "ainb_node_signature_param"
+    persisted_signature_ids: Set[str] = set()
+
+    @classmethod
+    def emit_create(cls) -> List[str]:
+        return [f"""
+            CREATE TABLE IF NOT EXISTS {cls.TABLE}(
+                signature_id TEXT,
+                param_section TEXT,
+                param_type TEXT,
+                i_of_type INT,
+                param_name TEXT,
+                class_name TEXT,
+                param_json TEXT,
+                PRIMARY KEY(signature_id ASC, param_section ASC, param_type ASC, i_of_type ASC)
+            ) WITHOUT ROWID;"""]
+
+    @classmethod
+    def persist_once(cls, conn: sqlite3.Connection, signature_id: str, param_details_json: dict) -> None:
+        if signature_id in cls.persisted_signature_ids:
+            return
+        cls.persisted_signature_ids.add(signature_id)
+        rows = []
+        for section, typed_params in param_details_json.items():
+            for param_type, params in typed_params.items():
+                for i_of_type, param in enumerate(params):
+                    rows.append((signature_id, section, param_type, i_of_type, param.get("Name", ""), param.get("Class"), orjson.dumps(param)))
+        conn.executemany(f"""
+            INSERT OR IGNORE INTO {cls.TABLE}(signature_id, param_section, param_type, i_of_type, param_name, class_name, param_json)
+            VALUES (?, ?, ?, ?, ?, ?, ?);
+            """, rows)
 
     @classmethod
-    def get_node_types(cls, conn: sqlite3.Connection, file_category: str) -> List[Tuple[str, dict]]:
-        return [(r[0], orjson.loads(r[1])) for r in conn.execute(f"""
-            SELECT node_type, param_details_json
+    def get_param_details_json(cls, conn: sqlite3.Connection, signature_id: str) -> dict:
+        # Only decoded when a node actually gets added
+        out = {}
+        for section, param_type, param_json in conn.execute(f"""
+            SELECT param_section, param_type, param_json
             FROM {cls.TABLE}
-            WHERE file_category = ?
-            AND is_most_common = 1
-            GROUP BY file_category, node_type
-            ORDER BY node_type ASC;
-            """, (file_category,)).fetchall()]
+            WHERE signature_id = ?
+            ORDER BY param_section, param_type, i_of_type;
+            """, (signature_id,)):
+            out.setdefault(section, {}).setdefault(param_type, []).append(orjson.loads(param_json))
+        return out
@@ -0,0 +1,45 @@
+import sqlite3
+from typing import *
+
+import orjson
+
+
+class AinbGraphLayoutCache:
+    TABLE = "ainb_graph_layout_cache"
+    SCHEMA = "layout"
+
+    @classmethod
+    def emit_create(cls) -> List[str]:
+        return [f"""
+            CREATE TABLE IF NOT EXISTS {cls.SCHEMA}.{cls.TABLE}(
+                fullfile TEXT,
+                layout_key TEXT,
+                layout_json TEXT,
+                is_estimated INTEGER NOT NULL DEFAULT 0,  -- Precomputed from guessed node sizes, redone when opened
+                PRIMARY KEY(fullfile ASC)
+            ) WITHOUT ROWID;"""]
+
+    @classmethod
+    def get_by_fullfile(cls, conn: sqlite3.Connection, fullfile: str, layout_key: str) -> Optional[Tuple[Dict[int, Tuple[int, int]], bool]]:
+        # layout_key identifies the graph structure the layout was made for, anything else is stale.
+        # -> (layout, is_estimated)
+        row = conn.execute(f"""
+            SELECT layout_json, is_estimated
+            FROM {cls.SCHEMA}.{cls.TABLE}
+            WHERE fullfile = ? AND layout_key = ?;
+            """, (fullfile, layout_key)).fetchone()
+        if row is None:
+            return None
+        return {int(node_i): tuple(xy) for node_i, xy in orjson.loads(row[0]).items()}, bool(row[1])
+
+    @classmethod
+    def persist(cls, conn: sqlite3.Connection, fullfile: str, layout_key: str, layout_data: Dict[int, Tuple[int, int]], is_estimated: bool = False) -> None:
+        conn.execute(f"""
+            INSERT OR REPLACE INTO {cls.SCHEMA}.{cls.TABLE}(fullfile, layout_key, layout_json, is_estimated)
+            VALUES (?, ?, ?, ?);
+            """, (fullfile, layout_key, orjson.dumps(layout_data, option=orjson.OPT_NON_STR_KEYS), int(is_estimated)))
+
+    @classmethod
+    def get_all_fullfiles(cls, conn: sqlite3.Connection) -> Set[str]:
+        # Any layout at all, stale and estimated ones still get replaced on open
+        return {r[0] for r in conn.execute(f"SELECT fullfile FROM {cls.SCHEMA}.{cls.TABLE};")}
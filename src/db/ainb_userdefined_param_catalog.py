@@ -0,0 +1,83 @@
+from dataclasses import dataclass
+import sqlite3
+from typing import *
+
+import orjson
+
+from ..app_types import *
+
+
+# Counting whole node signatures loses the userdefined class info, every distinct class/value
+# just becomes another signature. This keeps one row per (where it's used, class, observed value) instead.
+
+
+@dataclass
+class UserDefinedParamUsage:
+    node_type: str
+    param_section: str
+    i_of_type: int
+    param_name: str
+    class_name: str
+    default_value: Any  # Only inputs carry a value, None otherwise
+    usage_count: int
+
+
+class AinbUserDefinedParamCatalog:
+    TABLE = "ainb_userdefined_param_catalog"
+
+    @classmethod
+    def emit_create(cls) -> List[str]:
+        return [f"""
+            CREATE TABLE IF NOT EXISTS {cls.TABLE}(
+                file_category TEXT,
+                node_type TEXT,
+                param_section TEXT,
+                i_of_type INT,
+                param_name TEXT,
+                class_name TEXT,
+                default_value_json TEXT,
+                usage_count INT,
+                PRIMARY KEY(file_category, node_type, param_section, i_of_type, param_name, class_name, default_value_json)
+            ) WITHOUT ROWID;""",
+            f"""CREATE INDEX IF NOT EXISTS idx_audpc_class ON {cls.TABLE} (class_name, file_category);""",
+        ]
+
+    @classmethod
+    def persist_node(cls, conn: sqlite3.Connection, file_category: str, node_type: str, aj_node: dict) -> None:
+        rows = []
+        for section in (ParamSectionName.IMMEDIATE, ParamSectionName.INPUT, ParamSectionName.OUTPUT):
+            for i_of_type, param in enumerate(aj_node.get(section, {}).get("userdefined", [])):
+                rows.append((
+                    file_category, node_type, section, i_of_type,
+                    param.get("Name", ""), param.get("Class", ""), orjson.dumps(param.get("Value")),
+                ))
+        if rows:
+            conn.executemany(f"""
+                INSERT INTO {cls.TABLE}
+                (file_category, node_type, param_section, i_of_type, param_name, class_name, default_value_json, usage_count)
+                VALUES (?, ?, ?, ?, ?, ?, ?, 1)
+                ON CONFLICT DO UPDATE SET usage_count = usage_count + 1;
+                """, rows)
+
+    @classmethod
+    def get_by_file_category(cls, conn: sqlite3.Connection, file_category: str) -> Dict[str, List[UserDefinedParamUsage]]:
+        # {node_type: [usage, ...]}, each param slot's most used class+value first
+        out: Dict[str, List[UserDefinedParamUsage]] = {}
+        cursor = conn.execute(f"""
+            SELECT node_type, param_section, i_of_type, param_name, class_name, default_value_json, usage_count
+            FROM {cls.TABLE}
+            WHERE file_category = ?
+            ORDER BY node_type, param_section, i_of_type, usage_count DESC;
+            """, (file_category,))
+        for node_type, section, i_of_type, param_name, class_name, default_value_json, usage_count in cursor:
+            usage = UserDefinedParamUsage(node_type, section, i_of_type, param_name, class_name, orjson.loads(default_value_json), usage_count)
+            out.setdefault(node_type, []).append(usage)
+        return out
+
+    @staticmethod
+    def most_common_by_slot(usages: List[UserDefinedParamUsage]) -> Dict[Tuple[str, int], UserDefinedParamUsage]:
+        # {(param_section, i_of_type): usage}, relies on get_by_file_category's ordering
+        out = {}
+        for usage in usages:
+            out.setdefault((usage.param_section, usage.i_of_type), usage)
+        return out
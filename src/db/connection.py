@@ -1,5 +1,8 @@
+import contextlib
+import hashlib
 import os
 import pathlib
+import queue
 import sqlite3
 import threading
 from typing import *
@@ -8,43 +11,289 @@ import dearpygui.dearpygui as dpg
 
 from ..app_types import *
 from .pack_index import PackIndex
-from .ainb_file_node_usage_index import AinbFileNodeUsageIndex
+from .ainb_file_info_index import AinbFileInfoIndex, AinbFileGlobalParamIndex
+from .ainb_file_node_usage_index import AinbFileNodeUsageIndex, AinbNodeSignatureParam
+from .ainb_graph_layout_cache import AinbGraphLayoutCache
+from .ainb_userdefined_param_catalog import AinbUserDefinedParamCatalog
+from .content_search_index import ContentSearchIndex
+from .edit_history import EditHistory
+from .file_path_index import FilePathIndex
+from .undo_spill import UndoSpill
 
 
-tls = threading.local()
+pool_init_lock = threading.Lock()
 
-class Connection:
-    connection: sqlite3.Connection  = None
+
+# Each db file is attached under its own schema name with its own user_version, so they can be
+# invalidated/migrated/deleted independently: wiping the crawl cache never costs you graph layouts, etc.
+class AttachedDb:
+    SCHEMA: str = None  # "main" is the connection's own db
+    VERSION: int = 0
+    # Rebuildable dbs just get dropped and recreated when no migration exists, others refuse to open
+    IS_REBUILDABLE: bool = True
+    # {from_version: fn(conn)} upgrading from_version -> from_version + 1
+    MIGRATIONS: Dict[int, Callable[[sqlite3.Connection], None]] = {}
 
     @classmethod
-    def get(cls) -> sqlite3.Connection:
-        global tls
-        if not hasattr(tls, "GLOBAL_INSTANCE"):
-            conn = tls.GLOBAL_INSTANCE = cls()
-            conn.db_init()
-        return tls.GLOBAL_INSTANCE.connection
+    def get_tables(cls) -> List[type]:
+        return []
+
+    @classmethod
+    def get_path(cls, appvar: str, title_version: str, modfs: str) -> str:
+        raise NotImplementedError()
+
+    @classmethod
+    def get_version(cls, conn: sqlite3.Connection) -> int:
+        return conn.execute(f"PRAGMA {cls.SCHEMA}.user_version;").fetchone()[0]
+
+    @classmethod
+    def has_tables(cls, conn: sqlite3.Connection) -> bool:
+        return conn.execute(f"SELECT COUNT(*) FROM {cls.SCHEMA}.sqlite_master WHERE type = 'table';").fetchone()[0] > 0
+
+    @classmethod
+    def migrate(cls, conn: sqlite3.Connection) -> None:
+        version = cls.get_version(conn)
+        if not cls.has_tables(conn):
+            version = cls.VERSION  # Fresh db, nothing to migrate
+        while version < cls.VERSION and version in cls.MIGRATIONS:
+            print(f"Migrating {cls.SCHEMA} db v{version} -> v{version + 1}")
+            cls.MIGRATIONS[version](conn)
+            version += 1
+
+        if version != cls.VERSION:
+            if not cls.IS_REBUILDABLE:
+                raise Exception(f"No migration for {cls.SCHEMA} db v{version} -> v{cls.VERSION}, refusing to touch it")
+            print(f"Rebuilding {cls.SCHEMA} db v{version} -> v{cls.VERSION}")
+            cls.drop_tables(conn)
+
+        for tbl in cls.get_tables():
+            for statement in tbl.emit_create():
+                conn.execute(statement)
+        conn.execute(f"PRAGMA {cls.SCHEMA}.user_version = {cls.VERSION};")
+
+    @classmethod
+    def drop_tables(cls, conn: sqlite3.Connection) -> None:
+        # Virtual tables first, dropping them also drops their shadow tables
+        rows = conn.execute(f"""
+            SELECT name FROM {cls.SCHEMA}.sqlite_master
+            WHERE type = 'table' AND name NOT LIKE 'sqlite_%'
+            ORDER BY sql LIKE 'CREATE VIRTUAL%' DESC;
+            """).fetchall()
+        for (name,) in rows:
+            conn.execute(f'DROP TABLE IF EXISTS {cls.SCHEMA}."{name}";')
+
+    @classmethod
+    def invalidate(cls, conn: sqlite3.Connection) -> None:
+        # Leaves empty tables behind, so the running app keeps working until it repopulates them
+        cls.drop_tables(conn)
+        cls.migrate(conn)
+
+
+class CrawlCacheDb(AttachedDb):
+    # Everything derived from crawling romfs, rebuilt on startup when missing
+    SCHEMA = "main"
+    # v2: content search, v3: file path index, v4: file info, v5: userdefined catalog, v6: structured node signatures.
+    # No migrations on purpose: any version change drops the tables and recrawls, which is cheaper to get right
+    # than a chain of upgrades for data that's rebuilt from romfs anyways.
+    VERSION = 6
+
+    @classmethod
+    def get_tables(cls) -> List[type]:
+        return [PackIndex, AinbFileNodeUsageIndex, AinbNodeSignatureParam, ContentSearchIndex, FilePathIndex, AinbFileInfoIndex, AinbFileGlobalParamIndex, AinbUserDefinedParamCatalog]
+
+    @classmethod
+    def get_path(cls, appvar: str, title_version: str, modfs: str) -> str:
+        return f"{appvar}/{title_version}/cache.db"
+
+
+def _migrate_layout_cache_v1(conn: sqlite3.Connection) -> None:
+    # v2 marks precomputed layouts, which v1 stored like real ones. Everything counts as estimated so each file
+    # gets laid out from real node sizes once more on open.
+    conn.execute(f"ALTER TABLE {AinbGraphLayoutCache.SCHEMA}.{AinbGraphLayoutCache.TABLE} ADD COLUMN is_estimated INTEGER NOT NULL DEFAULT 0;")
+    conn.execute(f"UPDATE {AinbGraphLayoutCache.SCHEMA}.{AinbGraphLayoutCache.TABLE} SET is_estimated = 1;")
+
+
+class LayoutCacheDb(AttachedDb):
+    # Computed graph layouts, rebuilt lazily as files are opened
+    SCHEMA = "layout"
+    # v2: estimated layouts from precompute
+    VERSION = 2
+    MIGRATIONS = {
+        1: _migrate_layout_cache_v1,
+    }
+
+    @classmethod
+    def get_tables(cls) -> List[type]:
+        return [AinbGraphLayoutCache]
+
+    @classmethod
+    def get_path(cls, appvar: str, title_version: str, modfs: str) -> str:
+        return f"{appvar}/{title_version}/layout.db"
+
+
+def _migrate_history_v1(conn: sqlite3.Connection) -> None:
+    # v2 adds undo_spill, edit_history is untouched
+    for statement in UndoSpill.emit_create():
+        conn.execute(statement)
 
-    def db_init(self):
-        appvar = dpg.get_value(AppConfigKeys.APPVAR_PATH)
-        title_version = dpg.get_value(AppConfigKeys.TITLE_VERSION)
 
-        # TODO multiple db files, so cache can be deleted separately
-        db_file = f"{appvar}/{title_version}/cache.db"
-        print(f"Using cache db: {db_file}")
-        pathlib.Path(db_file).parent.mkdir(parents=True, exist_ok=True)
+def _migrate_history_v2(conn: sqlite3.Connection) -> None:
+    # v3 lets unsaved edits be discarded, existing rows were all kept
+    conn.execute(f"ALTER TABLE {EditHistory.SCHEMA}.{EditHistory.TABLE} ADD COLUMN is_abandoned INTEGER NOT NULL DEFAULT 0;")
+
+
+class HistoryDb(AttachedDb):
+    # User work, modfs-specific. Never dropped, every schema change needs a migration
+    SCHEMA = "history"
+    # v2: undo spill
+    # v3: edit_history.is_abandoned
+    VERSION = 3
+    IS_REBUILDABLE = False
+    MIGRATIONS = {
+        1: _migrate_history_v1,
+        2: _migrate_history_v2,
+    }
+
+    @classmethod
+    def get_tables(cls) -> List[type]:
+        return [EditHistory, UndoSpill]
+
+    @classmethod
+    def get_path(cls, appvar: str, title_version: str, modfs: str) -> str:
+        modfs_key = hashlib.sha1(os.path.abspath(modfs).encode("utf8")).hexdigest()[:16]
+        return f"{appvar}/{title_version}/history/{modfs_key}.db"
+
+
+class ConnectionPool:
+    # One writer shared by everyone (serialized by a lock), plus read-only WAL readers so background work
+    # can read while the crawl/saves/journal write. Nothing in here touches dpg, so process workers can
+    # build their own pool from the same db_files.
+    def __init__(self, db_files: Dict[str, str], pragmas: Dict[str, Any], reader_count: int):
+        self.db_files = db_files
+        self.pragmas = pragmas
+        self.write_lock = threading.RLock()
+        self.writer = self.open(read_only=False)
+        self.readers: queue.LifoQueue[sqlite3.Connection] = queue.LifoQueue()
+        self.reader_count = reader_count
+        self.readers_opened = 0
+        self.readers_lock = threading.Lock()
+
+    def open(self, read_only: bool) -> sqlite3.Connection:
+        main_file = self.db_files[CrawlCacheDb.SCHEMA]
+        timeout_s = self.pragmas.get("busy_timeout", 5000) / 1000
         if os.name == "nt":
             # `file:` seems broken on windows? and the uri was the only way to set autocommit till 3.12
-            self.connection = sqlite3.connect(db_file)
-            if hasattr(self.connection, "autocommit"):
-                self.connection.autocommit = False
+            conn = sqlite3.connect(main_file, timeout=timeout_s, check_same_thread=False)
+            if hasattr(conn, "autocommit"):
+                conn.autocommit = False
+            attach_files = {schema: f for schema, f in self.db_files.items() if schema != "main"}
+            if read_only:
+                conn.execute("PRAGMA query_only = 1;")
         else:
-            self.connection = sqlite3.connect(f"file:{db_file}?mode=rwc&autocommit=false&cache=shared")
+            mode = "ro" if read_only else "rwc"
+            conn = sqlite3.connect(f"file:{main_file}?mode={mode}", uri=True, timeout=timeout_s, check_same_thread=False)
+            attach_files = {schema: f"file:{f}?mode={mode}" for schema, f in self.db_files.items() if schema != "main"}
+
+        for schema, db_file in attach_files.items():
+            conn.execute("ATTACH DATABASE ? AS ?;", (db_file, schema))
+
+        for pragma, value in self.pragmas.items():
+            if pragma != "busy_timeout":  # Handled by sqlite3.connect(timeout=)
+                conn.execute(f"PRAGMA {pragma} = {value};")
+        if not read_only:
+            for schema in self.db_files.keys():
+                # Persistent per db file, readers inherit it
+                conn.execute(f"PRAGMA {schema}.journal_mode = WAL;")
+                conn.execute(f"PRAGMA {schema}.synchronous = NORMAL;")
+        return conn
+
+    @contextlib.contextmanager
+    def write(self) -> Iterator[sqlite3.Connection]:
+        # Holds the write lock for one transaction, commits on success
+        with self.write_lock:
+            with self.writer:
+                yield self.writer
+
+    @contextlib.contextmanager
+    def read(self) -> Iterator[sqlite3.Connection]:
+        try:
+            conn = self.readers.get_nowait()
+        except queue.Empty:
+            with self.readers_lock:
+                can_open = self.readers_opened < self.reader_count
+                if can_open:
+                    self.readers_opened += 1
+            conn = self.open(read_only=True) if can_open else self.readers.get()
+        try:
+            yield conn
+        finally:
+            if conn.in_transaction:
+                conn.rollback()
+            self.readers.put(conn)
+
+
+class Connection:
+    # Tunable per machine, eg mmap_size=0 on network drives
+    PRAGMAS = {
+        "busy_timeout": 5000,  # ms
+        "mmap_size": 256 * 1024 * 1024,
+        "cache_size": -64 * 1024,  # KiB when negative
+        "temp_store": "MEMORY",
+    }
+    READER_COUNT = 4
+    DATABASES: List[Type[AttachedDb]] = [CrawlCacheDb, LayoutCacheDb, HistoryDb]
+    pool: ConnectionPool = None
+
+    @classmethod
+    def configure(cls, reader_count: Optional[int] = None, **pragmas) -> None:
+        # Must happen before first use
+        assert cls.pool is None
+        if reader_count is not None:
+            cls.READER_COUNT = reader_count
+        cls.PRAGMAS = {**cls.PRAGMAS, **pragmas}
+
+    @classmethod
+    def get_db_files(cls) -> Dict[str, str]:
+        appvar = dpg.get_value(AppConfigKeys.APPVAR_PATH)
+        title_version = dpg.get_value(AppConfigKeys.TITLE_VERSION)
+        modfs = dpg.get_value(AppConfigKeys.MODFS_PATH)
+        return {db.SCHEMA: db.get_path(appvar, title_version, modfs) for db in cls.DATABASES}
 
-        self.create_tables()
+    @classmethod
+    def get_pool(cls) -> ConnectionPool:
+        global pool_init_lock
+        with pool_init_lock:
+            if cls.pool is None:
+                cls.pool = cls.db_init(cls.get_db_files())
+        return cls.pool
+
+    @classmethod
+    def get(cls) -> sqlite3.Connection:
+        # The shared writer connection. Fine for quick work on the ui thread,
+        # anything running concurrently must go through writer()/reader() instead
+        return cls.get_pool().writer
+
+    @classmethod
+    def writer(cls) -> ContextManager[sqlite3.Connection]:
+        return cls.get_pool().write()
+
+    @classmethod
+    def reader(cls) -> ContextManager[sqlite3.Connection]:
+        return cls.get_pool().read()
+
+    @classmethod
+    def invalidate(cls, db: Type[AttachedDb]) -> None:
+        with cls.writer() as conn:
+            db.invalidate(conn)
+
+    @classmethod
+    def db_init(cls, db_files: Dict[str, str]) -> ConnectionPool:
+        for db_file in db_files.values():
+            pathlib.Path(db_file).parent.mkdir(parents=True, exist_ok=True)
+        print(f"Using cache db: {db_files[CrawlCacheDb.SCHEMA]}")
 
-    def create_tables(self):
-        tables = [PackIndex, AinbFileNodeUsageIndex]
-        with self.connection:
-            for tbl in tables:
-                for statement in tbl.emit_create():
-                    self.connection.execute(statement)
+        pool = ConnectionPool(db_files, cls.PRAGMAS, cls.READER_COUNT)
+        with pool.write() as conn:
+            for db in cls.DATABASES:
+                db.migrate(conn)
+        return pool
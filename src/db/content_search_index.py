@@ -0,0 +1,115 @@
+import re
+import sqlite3
+from typing import *
+
+from ..app_types import *
+
+
+# One row per node/command/blackboard per file, so hits point somewhere more useful than the file.
+# Only romfs contents get crawled, same as the node usage index.
+
+# (fullfile, node_i, kind, snippet), node_i is None for file-level rows (blackboard)
+ContentSearchHit = Tuple[str, Optional[int], str, str]
+
+
+class ContentSearchIndex:
+    TABLE = "content_search_index"
+
+    KIND_NODE = "node"
+    KIND_COMMAND = "command"
+    KIND_BLACKBOARD = "blackboard"
+
+    # bm25 weights in column order: fullfile, node_i, kind, name, node_type, param_names, param_values
+    RANK_WEIGHTS = (0.0, 0.0, 0.0, 10.0, 5.0, 2.0, 1.0)
+
+    # Noise that would only bloat the index: guids, hashes, raw bytes
+    SKIP_KEYS = {"GUID", "File Hashes", "0x38 Entries", "0x40 Entries", "EXB Section"}
+    RE_NOT_TEXT = re.compile(r"^(0x[0-9a-fA-F]+|[0-9a-fA-F]{8}-.*)$")
+
+    @classmethod
+    def emit_create(cls) -> List[str]:
+        # Default tokenizer splits on underscores, so `zelda` finds Npc_Zelda and quoted `Element_Seq` is still a phrase
+        return [f"""
+            CREATE VIRTUAL TABLE IF NOT EXISTS {cls.TABLE} USING fts5(
+                fullfile UNINDEXED,
+                node_i UNINDEXED,
+                kind UNINDEXED,
+                name,
+                node_type,
+                param_names,
+                param_values,
+                prefix = '2 3'
+            );"""]
+
+    @classmethod
+    def _collect_params(cls, json: Any, names: List[str], values: List[str]) -> None:
+        # Every nested "Name" is a param/blackboard/event name, every other string leaf is some value
+        if isinstance(json, dict):
+            for k, v in json.items():
+                if k in cls.SKIP_KEYS:
+                    continue
+                if k == "Name" and isinstance(v, str):
+                    names.append(v)
+                else:
+                    cls._collect_params(v, names, values)
+        elif isinstance(json, list):
+            for v in json:
+                cls._collect_params(v, names, values)
+        elif isinstance(json, str) and json and not cls.RE_NOT_TEXT.match(json):
+            values.append(json)
+
+    @classmethod
+    def _node_row(cls, fullfile: str, node_i: int, aj_node: dict) -> tuple:
+        names, values = [], []
+        body = {k: v for k, v in aj_node.items() if k not in ("Name", "Node Type")}
+        cls._collect_params(body, names, values)
+        return (
+            fullfile, node_i, cls.KIND_NODE,
+            aj_node.get("Name", ""), aj_node.get("Node Type", ""),
+            " ".join(names), " ".join(values),
+        )
+
+    @classmethod
+    def persist_file(cls, conn: sqlite3.Connection, location: PackIndexEntry, file_json: dict) -> None:
+        # Works for both ainb and asb output_dict, they share enough structure
+        fullfile = location.fullfile
+        rows = []
+        for node_i, aj_node in enumerate(file_json.get("Nodes", [])):
+            rows.append(cls._node_row(fullfile, aj_node.get("Node Index", node_i), aj_node))
+
+        for cmd in file_json.get("Commands", []):
+            # Hits land on the command's entry node
+            names, values = [], []
+            cls._collect_params(cmd.get("Tags", []), names, values)
+            rows.append((fullfile, cmd.get("Left Node Index"), cls.KIND_COMMAND, cmd.get("Name", ""), "", " ".join(names), " ".join(values)))
+
+        for section_name in (ParamSectionName.GLOBAL, "Local Blackboard Parameters"):
+            if section := file_json.get(section_name):
+                names, values = [], []
+                cls._collect_params(section, names, values)
+                rows.append((fullfile, None, cls.KIND_BLACKBOARD, "", section_name, " ".join(names), " ".join(values)))
+
+        conn.executemany(f"""
+            INSERT INTO {cls.TABLE}(fullfile, node_i, kind, name, node_type, param_names, param_values)
+            VALUES (?, ?, ?, ?, ?, ?, ?);
+            """, rows)
+
+    @staticmethod
+    def build_match_query(user_query: str) -> Optional[str]:
+        # Every term must match somewhere in the row, as a prefix. Quoting keeps fts5 syntax out of user input.
+        terms = [t.replace('"', '') for t in user_query.split()]
+        terms = [f'"{t}"*' for t in terms if t]
+        return " AND ".join(terms) if terms else None
+
+    @classmethod
+    def search(cls, conn: sqlite3.Connection, user_query: str, limit: int = 200) -> List[ContentSearchHit]:
+        if not (match := cls.build_match_query(user_query)):
+            return []
+        weights = ", ".join(str(w) for w in cls.RANK_WEIGHTS)
+        return conn.execute(f"""
+            SELECT fullfile, node_i, kind, snippet({cls.TABLE}, -1, '[', ']', '...', 8)
+            FROM {cls.TABLE}
+            WHERE {cls.TABLE} MATCH ?
+            ORDER BY bm25({cls.TABLE}, {weights})
+            LIMIT ?;
+            """, (match, limit)).fetchall()
@@ -0,0 +1,78 @@
+import sqlite3
+from typing import *
+
+
+class EditHistory:
+    TABLE = "edit_history"
+    SCHEMA = "history"
+
+    @classmethod
+    def emit_create(cls) -> List[str]:
+        return [f"""
+            CREATE TABLE IF NOT EXISTS {cls.SCHEMA}.{cls.TABLE}(
+                fullfile TEXT,
+                seq INT,
+                file_type TEXT,
+                op_type TEXT,
+                op_selector_json TEXT,
+                op_value_json TEXT,
+                op_when REAL,
+                filehash TEXT,
+                is_abandoned INTEGER NOT NULL DEFAULT 0,
+                PRIMARY KEY(fullfile ASC, seq ASC)
+            ) WITHOUT ROWID;"""]
+
+    @classmethod
+    def persist_many(cls, conn: sqlite3.Connection, rows: List[tuple]) -> None:
+        # rows: [(fullfile, seq, file_type, op_type, op_selector_json, op_value_json, op_when, filehash)]
+        # Merged ops come back with the same seq and just replace their row, which is never abandoned
+        conn.executemany(f"""
+            INSERT OR REPLACE INTO {cls.SCHEMA}.{cls.TABLE}
+            (fullfile, seq, file_type, op_type, op_selector_json, op_value_json, op_when, filehash)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?);
+            """, rows)
+
+    @classmethod
+    def get_next_seq(cls, conn: sqlite3.Connection, fullfile: str) -> int:
+        row = conn.execute(f"SELECT MAX(seq) FROM {cls.SCHEMA}.{cls.TABLE} WHERE fullfile = ?;", (fullfile,)).fetchone()
+        return 0 if row[0] is None else row[0] + 1
+
+    @classmethod
+    def get_last_saved(cls, conn: sqlite3.Connection, fullfile: str) -> Tuple[int, Optional[str]]:
+        # -> (seq, filehash) of the last save, (-1, None) when it was never saved
+        row = conn.execute(f"""
+            SELECT seq, filehash FROM {cls.SCHEMA}.{cls.TABLE}
+            WHERE fullfile = ? AND filehash IS NOT NULL
+            ORDER BY seq DESC LIMIT 1;
+            """, (fullfile,)).fetchone()
+        return row if row else (-1, None)
+
+    @classmethod
+    def get_unsaved(cls, conn: sqlite3.Connection, fullfile: str) -> Tuple[Optional[str], List[tuple]]:
+        # -> (filehash of the last save, [(seq, file_type, op_type, op_selector_json, op_value_json, op_when)] after it)
+        saved_seq, saved_filehash = cls.get_last_saved(conn, fullfile)
+        rows = conn.execute(f"""
+            SELECT seq, file_type, op_type, op_selector_json, op_value_json, op_when
+            FROM {cls.SCHEMA}.{cls.TABLE}
+            WHERE fullfile = ? AND seq > ? AND is_abandoned = 0
+            ORDER BY seq ASC;
+            """, (fullfile, saved_seq)).fetchall()
+        return saved_filehash, rows
+
+    @classmethod
+    def abandon_unsaved(cls, conn: sqlite3.Connection, fullfile: str) -> int:
+        # Rows after the last save stay for the record but are never replayed. Later ops get new seqs and aren't abandoned.
+        saved_seq, _ = cls.get_last_saved(conn, fullfile)
+        return conn.execute(f"""
+            UPDATE {cls.SCHEMA}.{cls.TABLE} SET is_abandoned = 1
+            WHERE fullfile = ? AND seq > ? AND is_abandoned = 0;
+            """, (fullfile, saved_seq)).rowcount
+
+    @classmethod
+    def get_fullfiles_with_unsaved(cls, conn: sqlite3.Connection) -> List[str]:
+        return [r[0] for r in conn.execute(f"""
+            SELECT fullfile FROM {cls.SCHEMA}.{cls.TABLE}
+            GROUP BY fullfile
+            HAVING MAX(CASE WHEN is_abandoned = 0 THEN seq END) > COALESCE(MAX(CASE WHEN filehash IS NOT NULL THEN seq END), -1)
+            ORDER BY fullfile;
+            """)]
@@ -0,0 +1,80 @@
+import sqlite3
+from typing import *
+
+from ..app_types import *
+from .pack_index import PackIndex
+
+
+# Substring search over every known file, for the index window's filter box.
+# Trigram fts5 answers `"term"` matches from the index, shorter terms fall back to a LIKE scan which is still cheap at this size.
+
+
+class FilePathIndex:
+    TABLE = "file_path_index"
+
+    @classmethod
+    def emit_create(cls) -> List[str]:
+        return [f"""
+            CREATE VIRTUAL TABLE IF NOT EXISTS {cls.TABLE} USING fts5(
+                fullfile,
+                packfile UNINDEXED,
+                internalfile UNINDEXED,
+                extension UNINDEXED,
+                tokenize = 'trigram'
+            );"""]
+
+    @classmethod
+    def rebuild(cls, conn: sqlite3.Connection) -> None:
+        # Derived entirely from pack_index, so just redo it whenever the crawl finds anything new
+        conn.execute(f"DELETE FROM {cls.TABLE};")
+        rows = []
+        for ext in RomfsFileTypes.all():
+            for packfile, entries in PackIndex.get_all_entries_by_extension(conn, ext).items():
+                rows += [(e.fullfile, e.packfile, e.internalfile, e.extension) for e in entries.values()]
+        conn.executemany(f"""
+            INSERT INTO {cls.TABLE}(fullfile, packfile, internalfile, extension)
+            VALUES (?, ?, ?, ?);
+            """, rows)
+
+    @staticmethod
+    def parse_filter(filter_string: str) -> Tuple[List[str], List[str]]:
+        # `-ai/, -logic/, localmodule, load`: any positive term passes (union), any negative term excludes
+        positives, negatives = [], []
+        for term in filter_string.split(","):
+            term = term.strip()
+            if term.startswith("-"):
+                if term := term[1:].strip():
+                    negatives.append(term)
+            elif term:
+                positives.append(term)
+        return positives, negatives
+
+    @staticmethod
+    def _like_pattern(term: str) -> str:
+        return "%" + term.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_") + "%"
+
+    @classmethod
+    def filter(cls, conn: sqlite3.Connection, filter_string: str, limit: int) -> List[PackIndexEntry]:
+        positives, negatives = cls.parse_filter(filter_string)
+        if not positives and not negatives:
+            return []
+
+        where, params = [], []
+        if positives and all(len(t) >= 3 for t in positives):
+            where.append(f"{cls.TABLE} MATCH ?")
+            params.append(" OR ".join('"' + t.replace('"', '""') + '"' for t in positives))
+        elif positives:
+            where.append("(" + " OR ".join(["fullfile LIKE ? ESCAPE '\\'"] * len(positives)) + ")")
+            params += [cls._like_pattern(t) for t in positives]
+        for term in negatives:
+            where.append("fullfile NOT LIKE ? ESCAPE '\\'")
+            params.append(cls._like_pattern(term))
+
+        cursor = conn.execute(f"""
+            SELECT packfile, internalfile, extension
+            FROM {cls.TABLE}
+            WHERE {" AND ".join(where)}
+            ORDER BY packfile != 'Root', packfile, internalfile
+            LIMIT ?;
+            """, (*params, limit))
+        return [PackIndexEntry(internalfile=r[1], packfile=r[0], extension=r[2]) for r in cursor.fetchall()]
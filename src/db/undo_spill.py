@@ -0,0 +1,52 @@
+import sqlite3
+from typing import *
+
+
+# Undo entries past the in-memory limit, per open file. Only meaningful for the session that wrote them.
+
+
+class UndoSpill:
+    TABLE = "undo_spill"
+    SCHEMA = "history"
+
+    @classmethod
+    def emit_create(cls) -> List[str]:
+        return [f"""
+            CREATE TABLE IF NOT EXISTS {cls.SCHEMA}.{cls.TABLE}(
+                fullfile TEXT,
+                depth INT,
+                file_type TEXT,
+                op_json TEXT,
+                inverse_op_json TEXT,
+                PRIMARY KEY(fullfile ASC, depth ASC)
+            ) WITHOUT ROWID;"""]
+
+    @classmethod
+    def persist_many(cls, conn: sqlite3.Connection, rows: List[tuple]) -> None:
+        # rows: [(fullfile, depth, file_type, op_json, inverse_op_json)], depth 0 is the oldest entry
+        conn.executemany(f"""
+            INSERT OR REPLACE INTO {cls.SCHEMA}.{cls.TABLE}(fullfile, depth, file_type, op_json, inverse_op_json)
+            VALUES (?, ?, ?, ?, ?);
+            """, rows)
+
+    @classmethod
+    def pop_newest(cls, conn: sqlite3.Connection, fullfile: str, count: int) -> List[tuple]:
+        # -> [(depth, file_type, op_json, inverse_op_json)] oldest first, removed from the table
+        rows = conn.execute(f"""
+            SELECT depth, file_type, op_json, inverse_op_json
+            FROM {cls.SCHEMA}.{cls.TABLE}
+            WHERE fullfile = ?
+            ORDER BY depth DESC
+            LIMIT ?;
+            """, (fullfile, count)).fetchall()
+        if rows:
+            conn.execute(f"DELETE FROM {cls.SCHEMA}.{cls.TABLE} WHERE fullfile = ? AND depth >= ?;", (fullfile, rows[-1][0]))
+        return rows[::-1]
+
+    @classmethod
+    def clear(cls, conn: sqlite3.Connection) -> None:
+        conn.execute(f"DELETE FROM {cls.SCHEMA}.{cls.TABLE};")
+
+    @classmethod
+    def clear_fullfile(cls, conn: sqlite3.Connection, fullfile: str) -> None:
+        conn.execute(f"DELETE FROM {cls.SCHEMA}.{cls.TABLE} WHERE fullfile = ?;", (fullfile,))
@@ -1,8 +1,10 @@
+import contextlib
+import dataclasses
+from datetime import datetime
+import functools
 import pathlib
 import dearpygui.dearpygui as dpg
-import io
-import os
-import shutil
+from . import curio
 
 from .app_types import *
 from .mutable_ainb import MutableAinb, AinbEditOperationExecutor
@@ -12,6 +14,11 @@ from .dt_tools.asb import ASB
 # XXX deferred from .ui.window_ainb_graph import WindowAinbGraph
 # XXX deferred from .ui.window_asb_graph import WindowAsbGraph
 from . import pack_util
+from .edit_journal import EditJournal
+from .jsonpath import JSONPath
+from .location_resolver import LocationResolver
+from .save_queue import SaveQueue, SaveQueueItem
+from .undo_history import UndoEntry, UndoHistory
 
 
 GLOBAL_INSTANCE = None
@@ -31,14 +38,23 @@ class EditContext:
         self.title_version = dpg.get_value(AppConfigKeys.TITLE_VERSION)
         self.open_windows: Dict[str, "WindowAinbGraph"] = {}
         self.edit_histories: Dict[str, List[AinbEditOperation]] = {}
+        self.undo_histories: Dict[str, UndoHistory] = {}
+        UndoHistory.clear_spills()
+        self.journal = EditJournal()
+        self.resolver = LocationResolver(self.romfs, self.modfs)
+        self.save_queue = SaveQueue(self.romfs, self.modfs, self.resolver, self.journal)
+        # {(fullfile, selector): (file, op_selector, value)}, param edits waiting for the next frame, latest value wins
+        self.coalesced_edits: Dict[Tuple[str, tuple], tuple] = {}
 
     def set_callback_queue(self, q):
         self.dpg_callback_queue = q
 
-    async def open_ainb_window_as_coro(self, ainb_location: PackIndexEntry, dpg_args=None):
+    async def open_ainb_window_as_coro(self, ainb_location: PackIndexEntry, pan_node_i: Optional[int] = None, dpg_args=None):
         if window := self.open_windows.get(ainb_location.fullfile):
             # Ignore request and just raise existing window
             dpg.focus_item(window.tag)
+            if pan_node_i is not None:
+                window.editor.pan_to_node(pan_node_i)
             return
 
         from .ui.window_ainb_graph import WindowAinbGraph  # XXX
@@ -46,7 +62,7 @@ class EditContext:
         i = len(self.open_windows)
         self.open_windows[ainb_location.fullfile] = window
         pos = [400 + 25*i, 50 + 25*i]
-        await window.create_as_coro(width=1280, height=1080, pos=pos)
+        await window.create_as_coro(width=1280, height=1080, pos=pos, pan_node_i=pan_node_i)
 
     async def open_asb_window_as_coro(self, asb_location: PackIndexEntry, dpg_args=None):
         if window := self.open_windows.get(asb_location.fullfile):
@@ -65,141 +81,213 @@ class EditContext:
         del self.open_windows[location.fullfile]
 
     def load_ainb(self, ainb_location: PackIndexEntry) -> MutableAinb:
-        data = self._resolve_and_read(ainb_location)
-        ainb = AINB(data)
-        return MutableAinb.from_dt_ainb(ainb, ainb_location)
+        # Only the json outlives loading: the parser with its stream, string pool and section lists is a temporary,
+        # and the file's buffer (with the decompressed pack behind it) is released as the with block ends
+        with self._resolve_and_read(ainb_location) as data:
+            filehash = EditJournal.hash_data(data)
+            ainb = MutableAinb.from_dt_ainb(AINB(data), ainb_location)
+        self.recover_unsaved_edits(ainb, filehash, AinbEditOperationExecutor)
+        return ainb
 
     def load_asb(self, asb_location: PackIndexEntry) -> MutableAsb:
-        data = self._resolve_and_read(asb_location)
-        asb = ASB(data)
-        return MutableAsb.from_dt_asb(asb, asb_location)
+        with self._resolve_and_read(asb_location) as data:
+            filehash = EditJournal.hash_data(data)
+            asb = MutableAsb.from_dt_asb(ASB(data), asb_location)
+        self.recover_unsaved_edits(asb, filehash, AsbEditOperationExecutor)
+        return asb
 
-    def _resolve_and_read(self, location: PackIndexEntry) -> memoryview:
-        # Resolve through modfs, modfs packs, ...
-        if location.packfile == "Root":
-            modfs_file = pathlib.Path(f"{self.modfs}/{location.internalfile}")
-            if modfs_file.exists():
-                if str(modfs_file).endswith(".zs"):
-                    return pack_util.load_compressed_file(modfs_file)
-                else:
-                    return memoryview(open(modfs_file, "rb").read())
-
-            romfs_file = pathlib.Path(f"{self.romfs}/{location.internalfile}")
-            if romfs_file.exists():
-                if str(romfs_file).endswith(".zs"):
-                    return pack_util.load_compressed_file(romfs_file)
-                else:
-                    return memoryview(open(romfs_file, "rb").read())
-
-            raise FileNotFoundError(f"Failed to resolve: {location.fullfile}")
+    def recover_unsaved_edits(self, file: Union[MutableAinb, MutableAsb], filehash: str, executor: type) -> None:
+        # Replay journaled ops that never made it into a save: from earlier sessions (eg a crash),
+        # or from this session when a window was closed without saving.
+        # The file was just read from disk, so whatever history we still hold for it is replaced by what got replayed,
+        # and each replayed op can be undone like any edit.
+        self.flush_coalesced_edits()
+        history = []
+        undo_history = self.get_undo_history(file.location)
+        undo_history.clear()
+        for edit_op in self.journal.load_unsaved(file.location, filehash):
+            try:
+                inverse_op = executor.dispatch(file, edit_op)
+            except Exception as e:
+                print(f"Stopped recovering {file.location.fullfile} at {edit_op.op_type}: {e}")
+                break
+            history.append(edit_op)
+            undo_history.push(UndoEntry(edit_op, inverse_op))
+        self.edit_histories[file.location.fullfile] = history
 
-        else:
-            modfs_packfile = pathlib.Path(f"{self.modfs}/{location.packfile}")
-            if modfs_packfile.exists():
-                try:
-                    return pack_util.load_file_from_pack(modfs_packfile, location.internalfile)
-                except KeyError:
-                    pass  # Other tools+workflows might create incomplete packs, just fall back to romfs
-
-            romfs_packfile = pathlib.Path(f"{self.romfs}/{location.packfile}")
-            if romfs_packfile.exists():
-                return pack_util.load_file_from_pack(romfs_packfile, location.internalfile)
-
-            raise FileNotFoundError(f"Failed to resolve: {location.fullfile}")
-
-    def save_ainb(self, dirty_ainb: MutableAinb):
-        updated_ainb = AINB(dirty_ainb.json, from_dict=True)
-        ainb_location = dirty_ainb.location
-
-        if ainb_location.packfile == "Root":
-            modfs_ainbfile = pathlib.Path(f"{self.modfs}/{ainb_location.internalfile}")
-            modfs_ainbfile.parent.mkdir(parents=True, exist_ok=True)
-            # FIXME output to a BytesIO so we don't clobber the file on failure
-            with open(modfs_ainbfile, "wb") as outfile:
-                updated_ainb.ToBytes(updated_ainb, outfile)
-            print(f"Saved {ainb_location.fullfile}")
+    def discard_unsaved_edits(self, location: PackIndexEntry) -> None:
+        # Everything since the last save is abandoned in the journal and forgotten here, the caller reloads the file from disk
+        self.coalesced_edits = {k: v for k, v in self.coalesced_edits.items() if k[0] != location.fullfile}
+        self.save_queue.discard(location)
+        self.journal.discard_unsaved(location)
+        self.edit_histories.pop(location.fullfile, None)
+        self.get_undo_history(location).clear()
+
+    async def open_unsaved_files_as_coro(self, dpg_args=None):
+        # Windows run for as long as they're open, so each one gets its own task
+        for location in self.journal.get_locations_with_unsaved():
+            if location.extension == RomfsFileTypes.AINB:
+                await curio.spawn(self.open_ainb_window_as_coro, location)
+            elif location.extension == RomfsFileTypes.ASB:
+                await curio.spawn(self.open_asb_window_as_coro, location)
+
+    def get_latest_edit_op(self, location: PackIndexEntry) -> Optional[Union[AinbEditOperation, AsbEditOperation]]:
+        history = self.edit_histories.get(location.fullfile)
+        return history[-1] if history else None
+
+    @contextlib.contextmanager
+    def _resolve_and_read(self, location: PackIndexEntry) -> Iterator[memoryview]:
+        # Resolve through modfs, modfs packs, ...
+        # The view must not outlive the with block: loose files are mapped rather than read,
+        # and a file from a pack is a view into the whole decompressed pack.
+        resolved = self.resolver.resolve(location)
+        if not resolved.is_pack and not resolved.is_compressed:
+            with pack_util.open_mmap(resolved.path) as data:
+                yield data
             return
+
+        if resolved.is_pack:
+            data = pack_util.load_file_from_pack(resolved.path, location.internalfile)
         else:
-            modfs_packfile = pathlib.Path(f"{self.modfs}/{ainb_location.packfile}")
-            if not modfs_packfile.exists():
-                # Copy from romfs
-                modfs_packfile.parent.mkdir(parents=True, exist_ok=True)
-                romfs_packfile = pathlib.Path(f"{self.romfs}/{ainb_location.packfile}")
-                shutil.copy(romfs_packfile, modfs_packfile)
-                os.chmod(modfs_packfile, 0o664)  # PROTIP: Make your romfs read only
-
-            # Overwrite file and save updated pack
-            data = io.BytesIO()
-            updated_ainb.ToBytes(updated_ainb, data)
-            pack_util.save_file_to_pack(modfs_packfile, ainb_location.internalfile, data)
-            print(f"Saved {ainb_location.fullfile}")
+            data = pack_util.load_compressed_file(resolved.path)
+        try:
+            yield data
+        finally:
+            try:
+                data.release()
+            except BufferError:
+                pass  # Someone kept a slice after all, the buffer goes whenever they let go of it
+
+    def is_overridden_by_modfs(self, location: PackIndexEntry) -> bool:
+        return self.resolver.is_overridden_by_modfs(location)
+
+    def save_ainb(self, dirty_ainb: MutableAinb) -> CallbackReq.SpawnCoro:
+        self.enqueue_save_ainb(dirty_ainb)
+        return CallbackReq.SpawnCoro(self.save_queue.flush_as_coro)
+
+    def save_asb(self, dirty_asb: MutableAsb) -> CallbackReq.SpawnCoro:
+        self.enqueue_save_asb(dirty_asb)
+        return CallbackReq.SpawnCoro(self.save_queue.flush_as_coro)
+
+    def save_all_open_files(self) -> CallbackReq.SpawnCoro:
+        # Everything queued together, so packs shared between open files are only rebuilt once
+        for window in self.open_windows.values():
+            if ainb := getattr(window, "ainb", None):
+                self.enqueue_save_ainb(ainb)
+            elif asb := getattr(window, "asb", None):
+                self.enqueue_save_asb(asb)
+        return CallbackReq.SpawnCoro(self.save_queue.flush_as_coro)
+
+    def is_save_needed(self, file: Union[MutableAinb, MutableAsb]) -> bool:
+        # Unchanged since the last save (or load) and already in modfs, writing it again would change nothing
+        return file.is_dirty or not self.is_overridden_by_modfs(file.location)
+
+    def enqueue_save_ainb(self, dirty_ainb: MutableAinb) -> None:
+        self.flush_coalesced_edits()
+        if not self.is_save_needed(dirty_ainb):
             return
+        # Serialize now, the working json may keep changing while the queue writes in the background
+        data = dirty_ainb.to_data()
+        edit_op = self.get_latest_edit_op(dirty_ainb.location)
+        if edit_op is not None:
+            edit_op.is_save_pending = True  # Merging into it now would leave the save marked with data it doesn't hold
+        on_saved = functools.partial(dirty_ainb.mark_saved, dirty_ainb.revision)
+        self.save_queue.enqueue(SaveQueueItem(location=dirty_ainb.location, data=data, edit_op=edit_op, on_saved=on_saved))
 
-    def save_asb(self, dirty_asb: MutableAsb):
-        updated_asb = ASB(dirty_asb.json)
-        asb_location = dirty_asb.location
-
-        if asb_location.packfile == "Root":
-            modfs_asbfile = pathlib.Path(f"{self.modfs}/{asb_location.internalfile}")
-            modfs_asbfile.parent.mkdir(parents=True, exist_ok=True)
-            data = io.BytesIO()
-            updated_asb.ToBuffer(data)
-            # Root ASBs are always compressed
-            pack_util.save_compressed_file(modfs_asbfile, data)
-            print(f"Saved {asb_location.fullfile}")
+    def enqueue_save_asb(self, dirty_asb: MutableAsb) -> None:
+        self.flush_coalesced_edits()
+        if not self.is_save_needed(dirty_asb):
             return
-        else:
-            modfs_packfile = pathlib.Path(f"{self.modfs}/{asb_location.packfile}")
-            if not modfs_packfile.exists():
-                # Copy from romfs
-                modfs_packfile.parent.mkdir(parents=True, exist_ok=True)
-                romfs_packfile = pathlib.Path(f"{self.romfs}/{asb_location.packfile}")
-                shutil.copy(romfs_packfile, modfs_packfile)
-                os.chmod(modfs_packfile, 0o664)  # PROTIP: Make your romfs read only
-
-            # Overwrite file and save updated pack
-            data = io.BytesIO()
-            updated_asb.ToBytes(updated_asb, data)
-            pack_util.save_file_to_pack(modfs_packfile, asb_location.internalfile, data)
-            print(f"Saved {asb_location.fullfile}")
+        data = dirty_asb.to_data()
+        is_compressed_root = dirty_asb.location.packfile == "Root"
+        edit_op = self.get_latest_edit_op(dirty_asb.location)
+        if edit_op is not None:
+            edit_op.is_save_pending = True  # Merging into it now would leave the save marked with data it doesn't hold
+        on_saved = functools.partial(dirty_asb.mark_saved, dirty_asb.revision)
+        self.save_queue.enqueue(SaveQueueItem(location=dirty_asb.location, data=data, is_compressed_root=is_compressed_root, edit_op=edit_op, on_saved=on_saved))
+
+    def coalesce_ainb_param_edit(self, ainb: MutableAinb, op_selector: JSONPath, value: Any) -> None:
+        # No op is made until the flush, a drag only replaces the value here
+        self.coalesced_edits[(ainb.location.fullfile, tuple(op_selector.path))] = (ainb, op_selector, value)
+
+    def coalesce_asb_param_edit(self, asb: MutableAsb, op_selector: AsbEditOperationDefaultValueSelector, value: Any) -> None:
+        self.coalesced_edits[(asb.location.fullfile, op_selector)] = (asb, op_selector, value)
+
+    def flush_coalesced_edits(self) -> None:
+        # Once per frame from the ui loop, and before anything else touches the files, so ops stay in order
+        if not self.coalesced_edits:
             return
+        edits, self.coalesced_edits = self.coalesced_edits, {}
+        for file, op_selector, value in edits.values():
+            if isinstance(file, MutableAinb):
+                edit_op = AinbEditOperation(op_type=AinbEditOperationTypes.PARAM_UPDATE_DEFAULT, op_value=value, op_selector=op_selector)
+                self.perform_new_ainb_edit_operation(file, edit_op)
+            else:
+                edit_op = AsbEditOperation(op_type=AsbEditOperationTypes.PARAM_UPDATE_DEFAULT, op_value=value, op_selector=op_selector)
+                self.perform_new_asb_edit_operation(file, edit_op)
 
     def perform_new_ainb_edit_operation(self, ainb: MutableAinb, edit_op: AinbEditOperation):
+        self.flush_coalesced_edits()
         # Perform operation
-        AinbEditOperationExecutor.dispatch(ainb, edit_op)
-
-        # Store operation (after, so we won't store a crashing operation)
-        # TODO: persist history to db on every operation and set filehash upon export. eg crash recovery
-        if ainb.location.fullfile not in self.edit_histories:
-            self.edit_histories[ainb.location.fullfile] = []
-            self.edit_histories[ainb.location.fullfile].append(edit_op)
-            # persist history.db (insert edit_op)
-            #edit_op.filehash = "fakehash_first_edit"
-        else:
-            prev_op = self.edit_histories[ainb.location.fullfile][-1]
-            is_prev_op_amended = AinbEditOperationExecutor.try_merge_history(edit_op, prev_op)
-            if is_prev_op_amended:
-                pass # persist history.db (update prev_op)
-            else:
-                self.edit_histories[ainb.location.fullfile].append(edit_op)
-                # persist history.db (insert edit_op)
+        inverse_op = AinbEditOperationExecutor.dispatch(ainb, edit_op)
+        self.store_edit_operation(ainb.location, edit_op, inverse_op, AinbEditOperationExecutor)
 
     def perform_new_asb_edit_operation(self, asb: MutableAsb, edit_op: AsbEditOperation):
+        self.flush_coalesced_edits()
         # Perform operation
-        AsbEditOperationExecutor.dispatch(asb, edit_op)
+        inverse_op = AsbEditOperationExecutor.dispatch(asb, edit_op)
+        self.store_edit_operation(asb.location, edit_op, inverse_op, AsbEditOperationExecutor)
 
+    def store_edit_operation(self, location: PackIndexEntry, edit_op, inverse_op, executor: type, is_undo_redo: bool = False):
         # Store operation (after, so we won't store a crashing operation)
-        # TODO: persist history to db on every operation and set filehash upon export. eg crash recovery
-        if asb.location.fullfile not in self.edit_histories:
-            self.edit_histories[asb.location.fullfile] = []
-            self.edit_histories[asb.location.fullfile].append(edit_op)
-            # persist history.db (insert edit_op)
-            #edit_op.filehash = "fakehash_first_edit"
-        else:
-            prev_op = self.edit_histories[asb.location.fullfile][-1]
-            is_prev_op_amended = AsbEditOperationExecutor.try_merge_history(edit_op, prev_op)
-            if is_prev_op_amended:
-                pass # persist history.db (update prev_op)
-            else:
-                self.edit_histories[asb.location.fullfile].append(edit_op)
-                # persist history.db (insert edit_op)
+        history = self.edit_histories.setdefault(location.fullfile, [])
+        undo_history = self.get_undo_history(location)
+
+        # Only merge into the op that the next undo would revert, never into undo/redo steps
+        prev_op = history[-1] if history else None
+        if not is_undo_redo and prev_op is not None and prev_op is undo_history.peek_undo_op():
+            if executor.try_merge_history(edit_op, prev_op):
+                self.journal.record(location, prev_op)
+                return
+
+        history.append(edit_op)
+        self.journal.record(location, edit_op)
+        if not is_undo_redo:
+            undo_history.push(UndoEntry(edit_op, inverse_op))
+
+    def get_undo_history(self, location: PackIndexEntry) -> UndoHistory:
+        if location.fullfile not in self.undo_histories:
+            self.undo_histories[location.fullfile] = UndoHistory(location)
+        return self.undo_histories[location.fullfile]
+
+    def undo(self, file: Union[MutableAinb, MutableAsb], executor: type):
+        # Undo/redo steps are new ops in the history+journal, so replay and saves see them like any edit.
+        # Returns the op that was performed, so the ui can tell what to re-render
+        self.flush_coalesced_edits()
+        if not (entry := self.get_undo_history(file.location).pop_undo()):
+            return None
+        step = dataclasses.replace(entry.inverse_op, when=datetime.now(), seq=None, filehash=None)
+        executor.dispatch(file, step)
+        self.store_edit_operation(file.location, step, None, executor, is_undo_redo=True)
+        return step
+
+    def redo(self, file: Union[MutableAinb, MutableAsb], executor: type):
+        self.flush_coalesced_edits()
+        if not (entry := self.get_undo_history(file.location).pop_redo()):
+            return None
+        step = dataclasses.replace(entry.edit_op, when=datetime.now(), seq=None, filehash=None)
+        executor.dispatch(file, step)
+        self.store_edit_operation(file.location, step, None, executor, is_undo_redo=True)
+        return step
+
+    def undo_ainb(self, ainb: MutableAinb) -> Optional[AinbEditOperation]:
+        return self.undo(ainb, AinbEditOperationExecutor)
+
+    def redo_ainb(self, ainb: MutableAinb) -> Optional[AinbEditOperation]:
+        return self.redo(ainb, AinbEditOperationExecutor)
+
+    def undo_asb(self, asb: MutableAsb) -> Optional[AsbEditOperation]:
+        return self.undo(asb, AsbEditOperationExecutor)
+
+    def redo_asb(self, asb: MutableAsb) -> Optional[AsbEditOperation]:
+        return self.redo(asb, AsbEditOperationExecutor)
@@ -0,0 +1,159 @@
+from datetime import datetime
+import hashlib
+import time
+from typing import *
+
+import orjson
+from . import curio
+
+from .app_types import *
+from .db import Connection, EditHistory
+from .jsonpath import JSONPath
+
+
+# Every edit op is journaled to the modfs-specific history.db, so unsaved work survives a crash.
+# Ops are only queued on the ui loop and written as one transaction per flush interval (group commit).
+# WAL + synchronous=NORMAL means those commits don't fsync either, only the throttled checkpoints do.
+# Slider drags merge into their previous op, which just replaces that op's pending row until the next flush.
+
+EditOperation = Union[AinbEditOperation, AsbEditOperation]
+
+
+class EditJournal:
+    FLUSH_INTERVAL_S = 0.5
+    CHECKPOINT_INTERVAL_S = 30.0
+
+    def __init__(self):
+        # {(fullfile, seq): (file_type, op)}, serialized at flush so merges keep amending the same entry
+        self.pending: Dict[Tuple[str, int], Tuple[str, EditOperation]] = {}
+        self.next_seqs: Dict[str, int] = {}
+        # Serialized rows from a flush that failed to write, retried first next time so newer rows still replace them
+        self.unwritten_rows: List[tuple] = []
+        self.last_checkpoint = time.monotonic()
+
+    @staticmethod
+    def hash_data(data: Union[bytes, memoryview]) -> str:
+        return hashlib.blake2b(data, digest_size=16).hexdigest()
+
+    def record(self, location: PackIndexEntry, edit_op: EditOperation) -> None:
+        # Call for new ops and for merged ops alike, merged ones already have their seq
+        if edit_op.seq is None:
+            if location.fullfile not in self.next_seqs:
+                with Connection.reader() as conn:
+                    self.next_seqs[location.fullfile] = EditHistory.get_next_seq(conn, location.fullfile)
+            edit_op.seq = self.next_seqs[location.fullfile]
+            self.next_seqs[location.fullfile] += 1
+        self.pending[(location.fullfile, edit_op.seq)] = (location.extension, edit_op)
+
+    def mark_saved(self, location: PackIndexEntry, edit_op: Optional[EditOperation], data: bytes) -> None:
+        # The saved data matches the file as of edit_op, so replay starts after it.
+        # Setting filehash also stops later ops from merging into it.
+        if edit_op is None:
+            return
+        edit_op.filehash = self.hash_data(data)
+        self.record(location, edit_op)
+
+    @staticmethod
+    def dump_selector(edit_op: EditOperation) -> bytes:
+        if isinstance(edit_op.op_selector, JSONPath):
+            return orjson.dumps({"path": edit_op.op_selector.path, "names": edit_op.op_selector.names})
+        return orjson.dumps(edit_op.op_selector)
+
+    @classmethod
+    def serialize(cls, fullfile: str, file_type: str, edit_op: EditOperation) -> tuple:
+        return (
+            fullfile, edit_op.seq, file_type, edit_op.op_type,
+            cls.dump_selector(edit_op), orjson.dumps(edit_op.op_value),
+            edit_op.when.timestamp(), edit_op.filehash,
+        )
+
+    @staticmethod
+    def deserialize(file_type: str, op_type: str, op_selector_json: str, op_value_json: str, op_when: float, seq: Optional[int]) -> EditOperation:
+        selector = orjson.loads(op_selector_json)
+        value = orjson.loads(op_value_json)
+        when = datetime.fromtimestamp(op_when)
+        if file_type == RomfsFileTypes.AINB:
+            if selector is not None:
+                selector = JSONPath(path=selector["path"], names=selector["names"])
+            return AinbEditOperation(op_type=op_type, op_value=value, op_selector=selector, when=when, seq=seq)
+        else:
+            if selector is not None:
+                selector = tuple(selector)
+            return AsbEditOperation(op_type=op_type, op_value=value, op_selector=selector, when=when, seq=seq)
+
+    @classmethod
+    def dump_op(cls, edit_op: EditOperation) -> bytes:
+        # Whole op as one json value, for storage outside the journal's columns
+        return orjson.dumps([edit_op.op_type, orjson.loads(cls.dump_selector(edit_op)), edit_op.op_value, edit_op.when.timestamp()])
+
+    @classmethod
+    def load_op(cls, file_type: str, data: Union[str, bytes]) -> EditOperation:
+        op_type, selector, value, when = orjson.loads(data)
+        return cls.deserialize(file_type, op_type, orjson.dumps(selector), orjson.dumps(value), when, None)
+
+    def take_pending_rows(self) -> List[tuple]:
+        # On the ui loop, so ops can't change while they're serialized
+        rows = self.unwritten_rows + [self.serialize(fullfile, file_type, op) for (fullfile, _), (file_type, op) in self.pending.items()]
+        self.unwritten_rows = []
+        self.pending.clear()
+        return rows
+
+    def write_rows(self, rows: List[tuple]) -> None:
+        # Blocking, one transaction for everything since the last flush
+        with Connection.writer() as conn:
+            EditHistory.persist_many(conn, rows)
+            if time.monotonic() - self.last_checkpoint > self.CHECKPOINT_INTERVAL_S:
+                self.last_checkpoint = time.monotonic()
+                conn.execute(f"PRAGMA {EditHistory.SCHEMA}.wal_checkpoint(PASSIVE);")
+
+    def flush(self) -> None:
+        if rows := self.take_pending_rows():
+            try:
+                self.write_rows(rows)
+            except Exception:
+                self.unwritten_rows = rows
+                raise
+
+    async def flush_loop_as_coro(self) -> None:
+        # Runs for the whole app, a failed write (eg database is locked) is logged and retried on the next flush
+        try:
+            while True:
+                await curio.sleep(self.FLUSH_INTERVAL_S)
+                if rows := self.take_pending_rows():
+                    try:
+                        await curio.run_in_thread(self.write_rows, rows)
+                    except Exception as e:
+                        self.unwritten_rows = rows
+                        print(f"Writing {len(rows)} journal rows failed, retrying next flush: {e}", flush=True)
+        finally:
+            # App is closing, write out whatever is left
+            self.flush()
+
+    def load_unsaved(self, location: PackIndexEntry, current_filehash: str) -> List[EditOperation]:
+        # Ops recorded after the file was last saved, oldest first. Skipped when the file changed since that save,
+        # the ops may not apply to whatever is there now.
+        self.flush()
+        with Connection.reader() as conn:
+            saved_filehash, rows = EditHistory.get_unsaved(conn, location.fullfile)
+        if not rows:
+            return []
+        if saved_filehash is not None and saved_filehash != current_filehash:
+            print(f"Not recovering {len(rows)} unsaved edits for {location.fullfile}, it changed since they were made")
+            return []
+        print(f"Recovering {len(rows)} unsaved edits for {location.fullfile}")
+        return [
+            self.deserialize(file_type, op_type, selector_json, value_json, when, seq)
+            for seq, file_type, op_type, selector_json, value_json, when in rows
+        ]
+
+    def discard_unsaved(self, location: PackIndexEntry) -> None:
+        # Whatever is still queued for the file is written first, so the abandoned rows are all there to mark
+        self.flush()
+        with Connection.writer() as conn:
+            count = EditHistory.abandon_unsaved(conn, location.fullfile)
+        print(f"Discarded {count} unsaved edits for {location.fullfile}")
+
+    def get_locations_with_unsaved(self) -> List[PackIndexEntry]:
+        self.flush()
+        with Connection.reader() as conn:
+            return [PackIndexEntry.from_fullfile(f) for f in EditHistory.get_fullfiles_with_unsaved(conn)]
@@ -0,0 +1,195 @@
+from concurrent.futures import as_completed
+import fnmatch
+import pathlib
+import sqlite3
+from typing import *
+
+import dearpygui.dearpygui as dpg
+import orjson
+
+from . import app_precompute
+from .app_types import *
+from .db import Connection, PackIndex
+from .dt_tools.ainb import AINB
+from .dt_tools.asb import ASB
+from .edit_journal import EditOperation
+from .jsonpath import JSONPath, JSONPathSegment
+from .location_resolver import LocationResolver
+from .mutable_ainb import MutableAinb, AinbEditOperationExecutor
+from .mutable_asb import MutableAsb, AsbEditOperationExecutor
+from . import pack_util
+from .save_queue import SaveQueueItem, write_destination
+
+
+# Headless bulk edits: one script of edit ops applied to every matching file, eg set every Immediate float named X in all Logic files.
+# Files are grouped by pack, and each pack is read, edited and written to modfs once, in parallel worker processes.
+# Edits go straight to modfs without being journaled, so run this while the app is closed.
+#
+# A script is a json file:
+#     {
+#         "files": ["Logic/*.ainb"],  # fnmatch against internalfile as crawled (Root asbs end in .asb.zs)
+#         "packs": ["*"],  # Optional fnmatch against packfile, "Root" for loose files
+#         "ops": [{
+#             "op_type": "PARAM_UPDATE_DEFAULT",
+#             "selector": ["Nodes", "*", "Immediate Parameters", "float", "*", "Value"],  # JSONPath, * and ** wildcards
+#             "where": {"Name": "X"},  # Optional, what the object holding each selected value (or each removed node/link) must contain
+#             "value": 1.0,  # vec3f values are [x, y, z, 0.0] like the ui sends
+#         }],
+#     }
+# Ops are run in order and each selector is matched against the file as the previous ops left it.
+# REMOVE_NODE and REMOVE_LINK select what to remove, eg ["Nodes", "*"] with "where": {"Name": "X"}.
+# Ops without a selector (JSON_PATCH, ADD_NODE, ...) run once per file as they are.
+
+# Ops that shift later list entries down, eg selector ["Nodes", "*"] with REMOVE_NODE
+REMOVAL_OP_TYPES = {AinbEditOperationTypes.REMOVE_NODE, AinbEditOperationTypes.REMOVE_LINK}
+
+EXECUTORS = {
+    RomfsFileTypes.AINB: AinbEditOperationExecutor,
+    RomfsFileTypes.ASB: AsbEditOperationExecutor,
+}
+
+
+def load_script(script_path: str) -> dict:
+    script = orjson.loads(pathlib.Path(script_path).read_bytes())
+    for key in ("files", "packs"):
+        if isinstance(script.get(key), str):
+            script[key] = [script[key]]
+    script.setdefault("packs", ["*"])
+    if not script.get("files") or not script.get("ops"):
+        raise ValueError(f"Edit script {script_path} needs both files and ops")
+    return script
+
+
+def find_script_files(conn: sqlite3.Connection, script: dict) -> Dict[str, List[str]]:
+    # {packfile: [internalfile]} for every crawled file the script matches
+    out = {}
+    for extension in (RomfsFileTypes.AINB, RomfsFileTypes.ASB):
+        for packfile, entries in PackIndex.get_all_entries_by_extension(conn, extension).items():
+            if not any(fnmatch.fnmatchcase(packfile, p) for p in script["packs"]):
+                continue
+            if matches := [f for f in entries if any(fnmatch.fnmatchcase(f, p) for p in script["files"])]:
+                out.setdefault(packfile, []).extend(matches)
+    return out
+
+
+def get_default_names(selector: List[JSONPathSegment]) -> Dict[str, int]:
+    # PARAM_UPDATE_DEFAULT needs to know which segment is the param type, node and link ops which are their indexes
+    names = {}
+    if selector and selector[0] == "Nodes":
+        names["node_i"] = 1
+        if len(selector) == 5 and selector[2] == "Linked Nodes":
+            names.update(link_type=3, i_of_link_type=4)
+    for i, segment in enumerate(selector[:-1]):
+        if segment in ParamSectionName.values():
+            names.update(param_section_name=i, param_type=i + 1)
+            break
+    return names
+
+
+def expand_op(file_json: dict, file_type: str, op_json: dict) -> List[EditOperation]:
+    # One concrete op per selector match
+    op_cls = AinbEditOperation if file_type == RomfsFileTypes.AINB else AsbEditOperation
+    if (selector := op_json.get("selector")) is None:
+        return [op_cls(op_type=op_json["op_type"], op_value=op_json.get("value"))]
+
+    names = op_json.get("names") or get_default_names(selector)
+    where = op_json.get("where") or {}
+    # Removals select the node/link itself, everything else selects a value inside what where describes
+    is_removal = op_json["op_type"] in REMOVAL_OP_TYPES
+    out = []
+    for match in JSONPath(selector, names).glob(file_json):
+        if where:
+            holder = JSONPath(match.path if is_removal else match.path[:-1]).get_one(file_json)
+            if not isinstance(holder, dict) or any(holder.get(k) != v for k, v in where.items()):
+                continue
+        # Every match gets its own copy of the value, nothing in the json should be shared
+        value = orjson.loads(orjson.dumps(op_json.get("value")))
+        op_selector = JSONPath(match.path, names) if file_type == RomfsFileTypes.AINB else tuple(match.path)
+        out.append(op_cls(op_type=op_json["op_type"], op_value=value, op_selector=op_selector))
+    return out
+
+
+def apply_script(file: Union[MutableAinb, MutableAsb], file_type: str, script: dict) -> int:
+    # -> number of ops performed
+    executor = EXECUTORS[file_type]
+    count = 0
+    for op_json in script["ops"]:
+        edit_ops = expand_op(file.json, file_type, op_json)
+        if op_json["op_type"] in REMOVAL_OP_TYPES:
+            edit_ops.reverse()  # Last match first, so the ones still to go keep their indexes
+        for edit_op in edit_ops:
+            executor.dispatch(file, edit_op)
+            count += 1
+    return count
+
+
+def read_file(resolver: LocationResolver, location: PackIndexEntry, pack_datas: Dict[str, Dict[str, memoryview]]) -> Union[bytes, memoryview]:
+    # Same resolution as opening the file in the app, but each pack is only decompressed once
+    resolved = resolver.resolve(location)
+    if resolved.is_pack:
+        if resolved.path not in pack_datas:
+            pack_datas[resolved.path] = pack_util.load_all_files_from_pack(resolved.path)
+        return pack_datas[resolved.path][location.internalfile]
+    if resolved.is_compressed:
+        return pack_util.load_compressed_file(resolved.path)
+    return pathlib.Path(resolved.path).read_bytes()
+
+
+def edit_pack(romfs: str, modfs: str, packfile: str, internalfiles: List[str], script: dict, is_dry_run: bool) -> List[Tuple[str, int]]:
+    # Runs in a worker process, one pack at a time so it's only read and written once.
+    # -> [(fullfile, op count)]
+    resolver = LocationResolver(romfs, modfs)
+    pack_datas = {}
+    items: Dict[str, SaveQueueItem] = {}
+    out = []
+    for internalfile in internalfiles:
+        file_type = RomfsFileTypes.get_from_filename(internalfile)
+        location = PackIndexEntry(internalfile=internalfile, packfile=packfile, extension=file_type)
+        try:
+            data = read_file(resolver, location, pack_datas)
+            if file_type == RomfsFileTypes.AINB:
+                file = MutableAinb.from_dt_ainb(AINB(data), location)
+            else:
+                file = MutableAsb.from_dt_asb(ASB(data), location)
+            count = apply_script(file, file_type, script)
+            if count and not is_dry_run:
+                is_compressed_root = packfile == "Root" and file_type == RomfsFileTypes.ASB
+                items[internalfile] = SaveQueueItem(location=location, data=file.to_data(), is_compressed_root=is_compressed_root)
+            out.append((location.fullfile, count))
+        except Exception as e:
+            # Skip just this file, the rest of the pack still gets saved
+            print(f"Edit script failed for {location.fullfile}: {e}", flush=True)
+
+    pack_datas.clear()
+    if items:
+        write_destination(romfs, modfs, packfile, items)
+    return out
+
+
+def run_edit_script(script_path: str, is_dry_run: bool = False, core_budget: Optional[int] = None) -> int:
+    # Headless, for the --edit-script cli. -> number of files edited
+    script = load_script(script_path)
+    core_budget = app_precompute.get_core_budget(core_budget)
+    with Connection.reader() as conn:
+        todo = find_script_files(conn, script)
+    total = sum(len(v) for v in todo.values())
+    dry_run_note = " (dry run, nothing is written)" if is_dry_run else ""
+    print(f"Running {script_path} on {total} files in {len(todo)} packs with {core_budget} cores{dry_run_note}", flush=True)
+
+    romfs = dpg.get_value(AppConfigKeys.ROMFS_PATH)
+    modfs = dpg.get_value(AppConfigKeys.MODFS_PATH)
+    edited_files = 0
+    op_count = 0
+    # Same spawned, low priority workers as precompute
+    with app_precompute.make_pool(core_budget) as pool:
+        # Biggest packs first so one straggler doesn't hold up the tail
+        by_size = sorted(todo.items(), key=lambda kv: -len(kv[1]))
+        futures = {pool.submit(edit_pack, romfs, modfs, packfile, internalfiles, script, is_dry_run): packfile for packfile, internalfiles in by_size}
+        for future in as_completed(futures):
+            for fullfile, count in future.result():
+                if count:
+                    edited_files += 1
+                    op_count += count
+                    print(f"{count} ops: {fullfile}", flush=True)
+    print(f"Performed {op_count} ops in {edited_files}/{total} files{dry_run_note}", flush=True)
+    return edited_files
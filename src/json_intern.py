@@ -0,0 +1,27 @@
+import sys
+from typing import *
+
+
+# Parsed files repeat the same few strings all over (param names, classes, node types, flags, ...),
+# but every read from a string pool decodes a fresh str. Interning them once after loading leaves
+# one object per distinct string, shared by every open file. The tree itself stays plain canonical json.
+# Keys need no help: the parsers use literals, and orjson caches the keys it decodes.
+
+
+def intern_strings(json: Any) -> Any:
+    # Containers are interned in place, returns the value to store in place of json
+    if type(json) is str:
+        return sys.intern(json)
+    if type(json) is dict:
+        for k, v in json.items():
+            if type(v) is str:
+                json[k] = sys.intern(v)
+            elif type(v) in (dict, list):
+                intern_strings(v)
+    elif type(json) is list:
+        for i, v in enumerate(json):
+            if type(v) is str:
+                json[i] = sys.intern(v)
+            elif type(v) in (dict, list):
+                intern_strings(v)
+    return json
@@ -0,0 +1,107 @@
+from __future__ import annotations
+from typing import *
+
+import orjson
+
+from .json_intern import intern_strings
+from .jsonpath import JSONPathSegment
+
+
+# Structural diff+patch for plain json trees (dicts, lists, scalars), applied in place so unchanged subtrees keep their identity.
+#
+# A patch is a list of [op, path, arg]:
+#     ["set", path, value]       container[path[-1]] = value, a dict key may be new, a list index must exist
+#     ["remove", path, None]     del dict[path[-1]]
+#     ["truncate", path, n]      del list_at_path[n:]
+#     ["extend", path, values]   list_at_path.extend(values)
+# Paths are lists of dict keys and list indexes from the root, same segments as JSONPath.
+
+JsonPatchOp = List[Any]
+JsonPatch = List[JsonPatchOp]
+
+
+def diff(old, new, path: Optional[List[JSONPathSegment]] = None) -> JsonPatch:
+    path = path or []
+    if type(old) is not type(new):
+        return [["set", path, new]]
+
+    if isinstance(old, dict):
+        out = []
+        for k, v in new.items():
+            if k not in old:
+                out.append(["set", path + [k], v])
+            elif old[k] is not v:
+                out += diff(old[k], v, path + [k])
+        for k in old.keys():
+            if k not in new:
+                out.append(["remove", path + [k], None])
+        return out
+
+    if isinstance(old, list):
+        out = []
+        # Shared prefix by position, then whatever is left over at the tail
+        for i in range(min(len(old), len(new))):
+            if old[i] is not new[i]:
+                out += diff(old[i], new[i], path + [i])
+        if len(new) < len(old):
+            out.append(["truncate", path, len(new)])
+        elif len(new) > len(old):
+            out.append(["extend", path, new[len(old):]])
+        return out
+
+    if old != new:
+        return [["set", path, new]]
+    return []
+
+
+def _get_container(doc, path: List[JSONPathSegment]):
+    for segment in path:
+        doc = doc[segment]
+    return doc
+
+
+def _clone(value):
+    # Values go into the doc as copies, the patch itself lives on in history and must not see later edits
+    return intern_strings(orjson.loads(orjson.dumps(value)))
+
+
+def apply(doc, patch: JsonPatch) -> JsonPatch:
+    # Mutates doc in place, returns the patch that undoes it
+    inverse = []
+    for op, path, arg in patch:
+        if op == "set":
+            if not path:
+                raise ValueError("Cannot set the document root, patch its contents instead")
+            container = _get_container(doc, path[:-1])
+            key = path[-1]
+            if isinstance(container, dict) and key not in container:
+                inverse.append(["remove", path, None])
+            else:
+                inverse.append(["set", path, container[key]])
+            container[key] = _clone(arg)
+        elif op == "remove":
+            container = _get_container(doc, path[:-1])
+            inverse.append(["set", path, container.pop(path[-1])])
+        elif op == "truncate":
+            target = _get_container(doc, path)
+            inverse.append(["extend", path, target[arg:]])
+            del target[arg:]
+        elif op == "extend":
+            target = _get_container(doc, path)
+            inverse.append(["truncate", path, len(target)])
+            target.extend(_clone(arg))
+        else:
+            raise ValueError(f"Unknown patch op {op}")
+    inverse.reverse()
+    return inverse
+
+
+def replace_document(doc: dict, new_doc: dict) -> JsonPatch:
+    # Top level of a document has to stay the same dict, everyone holds a reference to it
+    if not isinstance(new_doc, dict):
+        raise ValueError("Document root must be an object")
+    return apply(doc, diff(doc, new_doc))
+
+
+def get_touched_paths(patch: JsonPatch) -> List[List[JSONPathSegment]]:
+    return [path for _, path, _ in patch]
@@ -0,0 +1,134 @@
+import os
+import pathlib
+from dataclasses import dataclass
+from typing import *
+
+from . import curio
+
+from .app_types import *
+from . import pack_util
+
+
+# Opening a file used to probe modfs loose, romfs loose, modfs pack, romfs pack with Path.exists() every time.
+# Instead we keep an index of everything present in modfs (rescanned on demand or by polling, and updated
+# directly by our own saves), and romfs probes are cached forever since romfs is read only.
+
+
+@dataclass
+class ResolvedLocation:
+    path: str  # Loose file or packfile to read from
+    is_modfs: bool
+    is_pack: bool
+
+    @property
+    def is_compressed(self) -> bool:
+        return self.path.endswith(".zs")
+
+
+class LocationResolver:
+    POLL_INTERVAL_S = 5
+
+    def __init__(self, romfs: str, modfs: str):
+        self.romfs = romfs
+        self.modfs = modfs
+        self.romfs_exists: Dict[str, bool] = {}
+        # romfs-relative path -> mtime_ns, for every file in modfs
+        self.modfs_files: Dict[str, int] = {}
+        # packfile -> (mtime_ns when listed, internal filenames), filled lazily as packs are opened
+        self.modfs_pack_contents: Dict[str, Tuple[int, Set[str]]] = {}
+        self.refresh()
+
+    def refresh(self, modfs_files: Optional[Dict[str, int]] = None) -> None:
+        self.modfs_files = self.scan_modfs() if modfs_files is None else modfs_files
+        self.modfs_pack_contents = {
+            packfile: listing for packfile, listing in self.modfs_pack_contents.items()
+            if self.modfs_files.get(packfile) == listing[0]
+        }
+
+    def scan_modfs(self) -> Dict[str, int]:
+        out = {}
+        root = pathlib.Path(self.modfs)
+        if not root.is_dir():
+            return out
+        stack = [str(root)]
+        while stack:
+            # Anything can vanish mid-scan (our own atomic_output temp files get renamed away, other tools delete things),
+            # whatever is gone just isn't listed
+            try:
+                with os.scandir(stack.pop()) as it:
+                    for entry in it:
+                        try:
+                            if entry.is_dir(follow_symlinks=False):
+                                stack.append(entry.path)
+                            elif entry.is_file() and not self.is_temp_file(entry.name):
+                                relative = PackIndexEntry.fix_backslashes(os.path.relpath(entry.path, root))
+                                out[relative] = entry.stat().st_mtime_ns
+                        except OSError:
+                            continue
+            except OSError:
+                continue
+        return out
+
+    @staticmethod
+    def is_temp_file(name: str) -> bool:
+        # pack_util.atomic_output writes .{name}.*.tmp beside the destination
+        return name.startswith(".") and name.endswith(".tmp")
+
+    async def poll_as_coro(self) -> None:
+        # Picks up changes made by other tools, our own saves are reported through notify_written.
+        # Runs for the whole app, so a failed poll is only logged and the next one tries again.
+        while True:
+            await curio.sleep(self.POLL_INTERVAL_S)
+            try:
+                modfs_files = await curio.run_in_thread(self.scan_modfs)
+                if modfs_files != self.modfs_files:
+                    self.refresh(modfs_files)
+            except Exception as e:
+                print(f"Polling modfs failed: {e}", flush=True)
+
+    def notify_written(self, location: PackIndexEntry) -> None:
+        relative = location.internalfile if location.packfile == "Root" else location.packfile
+        mtime_ns = os.stat(f"{self.modfs}/{relative}").st_mtime_ns
+        self.modfs_files[relative] = mtime_ns
+        if location.packfile != "Root":
+            if listing := self.modfs_pack_contents.get(location.packfile):
+                listing[1].add(location.internalfile)
+                self.modfs_pack_contents[location.packfile] = (mtime_ns, listing[1])
+
+    def _is_in_romfs(self, relative: str) -> bool:
+        if (exists := self.romfs_exists.get(relative)) is None:
+            exists = self.romfs_exists[relative] = pathlib.Path(f"{self.romfs}/{relative}").exists()
+        return exists
+
+    def _get_modfs_pack_contents(self, packfile: str) -> Optional[Set[str]]:
+        if (mtime_ns := self.modfs_files.get(packfile)) is None:
+            return None
+        listing = self.modfs_pack_contents.get(packfile)
+        if listing is None or listing[0] != mtime_ns:
+            filenames = set(pack_util.get_pack_internal_filenames(f"{self.modfs}/{packfile}"))
+            listing = self.modfs_pack_contents[packfile] = (mtime_ns, filenames)
+        return listing[1]
+
+    def resolve(self, location: PackIndexEntry) -> ResolvedLocation:
+        if location.packfile == "Root":
+            if location.internalfile in self.modfs_files:
+                return ResolvedLocation(f"{self.modfs}/{location.internalfile}", is_modfs=True, is_pack=False)
+            if self._is_in_romfs(location.internalfile):
+                return ResolvedLocation(f"{self.romfs}/{location.internalfile}", is_modfs=False, is_pack=False)
+        else:
+            # Other tools+workflows might create incomplete packs, just fall back to romfs
+            if location.internalfile in (self._get_modfs_pack_contents(location.packfile) or ()):
+                return ResolvedLocation(f"{self.modfs}/{location.packfile}", is_modfs=True, is_pack=True)
+            if self._is_in_romfs(location.packfile):
+                return ResolvedLocation(f"{self.romfs}/{location.packfile}", is_modfs=False, is_pack=True)
+        raise FileNotFoundError(f"Failed to resolve: {location.fullfile}")
+
+    def is_overridden_by_modfs(self, location: PackIndexEntry) -> bool:
+        # Cheap enough for ui badges: never stats, and never opens a pack we haven't listed already
+        if location.packfile == "Root":
+            return location.internalfile in self.modfs_files
+        if location.packfile not in self.modfs_files:
+            return False
+        if listing := self.modfs_pack_contents.get(location.packfile):
+            return location.internalfile in listing[1]
+        return True  # Pack is modded, assume this file is too until the pack gets opened
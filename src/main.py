@@ -8,10 +8,14 @@ import dearpygui.dearpygui as dpg
 from . import curio
 
 from . import app_ainb_cache
+from . import app_precompute
+from . import edit_script
 from .app_types import *
 from . import db
 from .edit_context import EditContext
+from .save_queue import SaveQueue
 from .ui.window_ainb_index import WindowAinbIndex
+from .ui.window_content_search import WindowContentSearch
 from .ui.window_sql_shell import WindowSqlShell
 
 
@@ -96,9 +100,32 @@ def resolve_argv_location() -> Optional[PackIndexEntry]:
             raise ValueError(f"Unparsable path {arg_location}")
 
 
+def get_precompute_arg() -> Optional[int]:
+    # `--precompute` or `--precompute=N` cores: crawl, precompute, and exit without any ui
+    for arg in sys.argv[1:]:
+        if arg == "--precompute":
+            return 0
+        if arg.startswith("--precompute="):
+            return int(arg.split("=", 1)[1])
+    return None
+
+
+def get_edit_script_arg() -> Optional[str]:
+    # `--edit-script=script.json`: crawl, apply the script to every matching file, and exit without any ui
+    for arg in sys.argv[1:]:
+        if arg.startswith("--edit-script="):
+            return arg.split("=", 1)[1]
+    return None
+
+
 async def init_basic_ui():
     with dpg.window() as primary_window:
         with dpg.menu_bar():
+            with dpg.menu(label="File"):
+                dpg.add_menu_item(label="Save All Open Files", callback=lambda: EditContext.get().save_all_open_files())
+                dpg.add_menu_item(label="Open Files With Unsaved Edits", callback=lambda: CallbackReq.SpawnCoro(EditContext.get().open_unsaved_files_as_coro))
+            with dpg.menu(label="Search"):
+                dpg.add_menu_item(label="Search File Contents", callback=CallbackReq.SpawnCoro(WindowContentSearch.create_as_coro))
             with dpg.menu(label="Debug"):
                 dpg.add_menu_item(label="Show Item Registry", callback=lambda: dpg.show_tool(dpg.mvTool_ItemRegistry))
                 dpg.add_menu_item(label="Show Debug", callback=lambda: dpg.show_tool(dpg.mvTool_Debug))
@@ -109,6 +136,16 @@ async def init_basic_ui():
                     label="Show SQL Shell",
                     callback=CallbackReq.SpawnCoro(WindowSqlShell.create_as_coro, ["SELECT sql FROM sqlite_master;"])
                 )
+                dpg.add_menu_item(
+                    label="Precompute All Layouts (background)",
+                    callback=CallbackReq.SpawnCoro(app_precompute.precompute_as_coro)
+                )
+                dpg.add_menu_item(
+                    label="Wipe Crawl Cache (recrawls on next start)",
+                    callback=lambda: db.Connection.invalidate(db.CrawlCacheDb)
+                )
+            dpg.add_progress_bar(tag=SaveQueue.PROGRESS_TAG, width=400, show=False)
+            dpg.add_progress_bar(tag=app_precompute.PROGRESS_TAG, width=400, show=False)
 
         await curio.spawn(WindowAinbIndex.create_as_coro, primary_window)
 
@@ -168,6 +205,20 @@ async def dpg_callback_consumer(queue):
 
 
 def main():
+    if (precompute_cores := get_precompute_arg()) is not None:
+        async def precompute_main():
+            await init_main()
+            app_precompute.run_precompute(precompute_cores)
+        curio.run(precompute_main)
+        return
+
+    if (script_path := get_edit_script_arg()) is not None:
+        async def edit_script_main():
+            await init_main()
+            edit_script.run_edit_script(script_path, is_dry_run="--dry-run" in sys.argv[1:])
+        curio.run(edit_script_main)
+        return
+
     dpg_callback_queue = curio.UniversalQueue()
 
     async def dpg_main():
@@ -182,12 +233,16 @@ def main():
             # there is no preemptive scheduling
             await curio.sleep(0)
 
+            # Param drags queued up since the last frame become one edit op each
+            EditContext.get().flush_coalesced_edits()
+
             if frame_i == 10:
                 async with curio.TaskGroup() as g:
                     await g.spawn(after_first_frame)
 
             dpg.render_dearpygui_frame()
             frame_i += 1
+        EditContext.get().flush_coalesced_edits()  # Last frame's drags still go to the journal
         dpg.destroy_context()
 
     async def app_main():
@@ -200,6 +255,8 @@ def main():
         EditContext.get().set_callback_queue(dpg_callback_queue)
         async with curio.TaskGroup(wait=any) as g:
             await g.spawn(dpg_callback_consumer(dpg_callback_queue))
+            await g.spawn(EditContext.get().resolver.poll_as_coro)
+            await g.spawn(EditContext.get().journal.flush_loop_as_coro)
             await g.spawn(dpg_main)
 
     curio.run(app_main)
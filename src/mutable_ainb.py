@@ -1,14 +1,19 @@
 from __future__ import annotations
 from datetime import datetime, timedelta
+import io
 from typing import *
 import uuid
 
 import dearpygui.dearpygui as dpg
 import orjson
 
+from .ainb_node_refs import AinbNodeRefKinds, AinbNodeRefs
 from .app_types import *
 from .dt_tools.ainb import AINB
+from . import jsondiff
+from .json_intern import intern_strings
 from .jsonpath import JSONPath
+from .mutable_revisions import MutableRevisions
 
 
 # - dt_tools.ainb.AINB.output_dict is our canonical format, no matter the cost.
@@ -22,14 +27,27 @@ from .jsonpath import JSONPath
 #   Simple edits may not need to re-render, this is up to EditContext to determine.
 
 
-class MutableAinb:
+class MutableAinb(MutableRevisions):
+    __slots__ = ("json", "location")
+
     @classmethod
     def from_dt_ainb(cls, dt_ainb: AINB, ainb_location: PackIndexEntry) -> MutableAinb:
         ainb = cls()
-        ainb.json = dt_ainb.output_dict
+        ainb.json = intern_strings(dt_ainb.output_dict)
         ainb.location = ainb_location
+        ainb.init_revisions()
         return ainb
 
+    def to_data(self) -> bytes:
+        dt_ainb = AINB(self.json, from_dict=True)
+        data = io.BytesIO()
+        dt_ainb.ToBytes(dt_ainb, data)
+        return data.getvalue()
+
+    def get_node_refs(self) -> AinbNodeRefs:
+        # Ops with KEEPS_NODE_REFS carry it forward, anything else gets it rebuilt on next use
+        return self.get_derived(AinbNodeRefs.DERIVED_NAME, self.revision, lambda: AinbNodeRefs.build(self.json))
+
     @property
     def commands(self) -> List[MutableAinbCommand]:
         path = JSONPath(["Commands", "*"], {"command_i": 1})
@@ -47,6 +65,8 @@ class MutableAinb:
 
 
 class MutableAinbCommand:
+    __slots__ = ("ainb", "path")
+
     def __init__(self, ainb: MutableAinb, path: JSONPath):
         self.ainb = ainb
         self.path = path
@@ -57,6 +77,8 @@ class MutableAinbCommand:
 
 
 class MutableAinbNode:
+    __slots__ = ("ainb", "path")
+
     def __init__(self, ainb: MutableAinb, path: JSONPath):
         self.ainb = ainb
         self.path = path
@@ -91,6 +113,9 @@ class MutableAinbNode:
 
 
 class MutableAinbParam:
+    # Views like these are made per param/link on every render, slots keep them small
+    __slots__ = ("ainb", "path")
+
     def __init__(self, ainb: MutableAinb, path: JSONPath):
         self.ainb = ainb
         self.path = path
@@ -133,6 +158,8 @@ class MutableAinbParam:
 
 
 class MutableAinbLink:
+    __slots__ = ("ainb", "path")
+
     def __init__(self, ainb: MutableAinb, path: JSONPath):
         self.ainb = ainb
         self.path = path
@@ -160,32 +187,169 @@ class AinbEditOperationExecutor:
             # Once a point in history has been persisted by user request, don't try to merge anything
             # into it regardless of recency.
             return False
+        if prev_op.is_save_pending:
+            # Already serialized into a queued save, the save marks this op with that data's hash once written
+            return False
 
         opcls: OP_IMPL = getattr(excls, edit_op.op_type)
         is_prev_op_amended = opcls.try_merge_history(edit_op, prev_op)
         return is_prev_op_amended
 
     @classmethod
-    def dispatch(excls, ainb: MutableAinb, edit_op: AinbEditOperation):
-        # resolve the op to one of the classes below and run it on the ainb
+    def dispatch(excls, ainb: MutableAinb, edit_op: AinbEditOperation) -> AinbEditOperation:
+        # resolve the op to one of the classes below and run it on the ainb, returning its inverse
         opcls: OP_IMPL = getattr(excls, edit_op.op_type)
-        opcls.execute(ainb, edit_op)
+        prev_revision = ainb.revision
+        inverse_op = opcls.execute(ainb, edit_op)
+        ainb.mark_edited(opcls.get_edited_paths(edit_op, inverse_op))
+        if opcls.is_node_refs_kept(edit_op):
+            ainb.carry_derived(AinbNodeRefs.DERIVED_NAME, prev_revision)
+        return inverse_op
+
+    @staticmethod
+    def detach_refs(ainb: MutableAinb, refs: AinbNodeRefs, node_json: dict) -> jsondiff.JsonPatch:
+        # Unhooks everything else pointing at a node about to be removed: links and multi param sources to it are dropped,
+        # preconditions on it are dropped, inputs from it and command right nodes go back to -1.
+        # -> patch restoring what was changed, using the indexes from before the removal
+        node_i = node_json["Node Index"]
+        incoming = [ref for ref in refs.get_refs_to(node_i) if ref.owner is not node_json]
+        for ref in incoming:
+            if ref.kind == AinbNodeRefKinds.COMMAND_ROOT:
+                raise ValueError(f"Node {node_i} is the root of command {ref.owner['Name']}, it can't be removed")
+
+        sections = {
+            AinbNodeRefKinds.LINK: "Linked Nodes",
+            AinbNodeRefKinds.REPLACEMENT: "Linked Nodes",
+            AinbNodeRefKinds.INPUT: ParamSectionName.INPUT,
+            AinbNodeRefKinds.SOURCE: ParamSectionName.INPUT,
+            AinbNodeRefKinds.PRECONDITION: "Precondition Nodes",
+            AinbNodeRefKinds.COMMAND_RIGHT: "Right Node Index",
+        }
+        restore = []
+        owners = {}  # {id(owner): (owner, path)}
+        snapshotted = set()
+        for ref in incoming:
+            if id(ref.owner) not in owners:
+                if ref.kind == AinbNodeRefKinds.COMMAND_RIGHT:
+                    command_i = next(i for i, c in enumerate(ainb.json["Commands"]) if c is ref.owner)
+                    owners[id(ref.owner)] = (ref.owner, ["Commands", command_i])
+                else:
+                    owners[id(ref.owner)] = (ref.owner, ["Nodes", ref.owner["Node Index"]])
+            section = sections[ref.kind]
+            if (id(ref.owner), section) not in snapshotted:
+                snapshotted.add((id(ref.owner), section))
+                restore.append(["set", owners[id(ref.owner)][1] + [section], orjson.loads(orjson.dumps(ref.owner[section]))])
+
+        # Their refs get moved around below, so they're taken out now and rescanned once unhooked
+        for owner, _ in owners.values():
+            refs.remove_owner(owner)
+
+        is_precondition_changed = bool(node_json.get("Precondition Nodes"))
+        for ref in incoming:
+            if ref.kind == AinbNodeRefKinds.LINK:
+                linked_nodes = ref.owner["Linked Nodes"]
+                for link_type, links in list(linked_nodes.items()):
+                    if any(link is ref.container for link in links):
+                        links.remove(ref.container)
+                        if not links:
+                            del linked_nodes[link_type]
+            elif ref.kind == AinbNodeRefKinds.REPLACEMENT:
+                ref.container.pop(ref.key, None)
+            elif ref.kind == AinbNodeRefKinds.INPUT:
+                ref.container["Node Index"] = -1
+                ref.container["Parameter Index"] = 0
+            elif ref.kind == AinbNodeRefKinds.SOURCE:
+                for params in ref.owner[ParamSectionName.INPUT].values():
+                    for param in params:
+                        if any(source is ref.container for source in param.get("Sources", [])):
+                            param["Sources"].remove(ref.container)
+            elif ref.kind == AinbNodeRefKinds.PRECONDITION:
+                if "Precondition Nodes" in ref.owner:
+                    if preconditions := [n for n in ref.container if n != node_i]:
+                        ref.owner["Precondition Nodes"] = preconditions
+                    else:
+                        del ref.owner["Precondition Nodes"]
+                    is_precondition_changed = True
+            elif ref.kind == AinbNodeRefKinds.COMMAND_RIGHT:
+                ref.container[ref.key] = -1
+
+        # Multi param sources are one table as well, in node order, the node's own sources leave with it
+        is_multi_changed = any(ref.kind == AinbNodeRefKinds.SOURCE for ref in incoming) or any(
+            "Sources" in param for params in node_json.get(ParamSectionName.INPUT, {}).values() for param in params
+        )
+        if is_multi_changed:
+            AinbEditOperationExecutor.repack_multi_params(ainb, node_json, restore)
+
+        # Preconditions are one table that each node takes a slice of, keep it packed in the same order
+        if is_precondition_changed:
+            base = 0
+            with_preconditions = [n for n in ainb.json["Nodes"] if n is not node_json and n.get("Precondition Nodes")]
+            for node in sorted(with_preconditions, key=lambda n: n.get("Base Precondition Node", 0)):
+                if node.get("Base Precondition Node") != base:
+                    restore.append(["set", ["Nodes", node["Node Index"], "Base Precondition Node"], node.get("Base Precondition Node", 0)])
+                    node["Base Precondition Node"] = base
+                base += len(node["Precondition Nodes"])
+
+        for owner, path in owners.values():
+            refs.add_owner(owner, is_command=path[0] == "Commands")
+        return restore
+
+    @staticmethod
+    def repack_multi_params(ainb: MutableAinb, skip_node: dict, restore: jsondiff.JsonPatch) -> None:
+        # Multi params store where their sources start in the table as "Node Index" = -100 - base and their count as
+        # "Parameter Index", and dt_tools writes both as they are while it rebuilds the table itself from "Sources".
+        # Params left without sources go back to plain unlinked inputs. Old values go into restore.
+        base = 0
+        for node in ainb.json.get("Nodes", []):
+            if node is skip_node:
+                continue
+            # Same order as the table is written in
+            for section in (ParamSectionName.IMMEDIATE, ParamSectionName.INPUT):
+                for param_type, params in node.get(section, {}).items():
+                    for i, param in enumerate(params):
+                        if "Sources" not in param:
+                            continue
+                        sources = param["Sources"]
+                        node_index, param_index = (-100 - base, len(sources)) if sources else (-1, 0)
+                        path = ["Nodes", node["Node Index"], section, param_type, i]
+                        for key, value in (("Node Index", node_index), ("Parameter Index", param_index)):
+                            if param.get(key) != value:
+                                restore.append(["set", path + [key], param.get(key)])
+                                param[key] = value
+                        if not sources:
+                            # Sources only empty out when one was unhooked, its section is restored whole
+                            del param["Sources"]
+                        base += len(sources)
 
     class OP_IMPL:
+        # Whether execute leaves MutableAinb.get_node_refs current, by not touching node indexes or by updating it
+        KEEPS_NODE_REFS = False
+
+        @classmethod
+        def is_node_refs_kept(opcls, edit_op: AinbEditOperation) -> bool:
+            return opcls.KEEPS_NODE_REFS
+
         @staticmethod
         def try_merge_history(*_, **__) -> bool:
             # Mutates prev_op to match edit_op when applicable, returning True when this happens
             return False  # Don't merge by default
 
         @staticmethod
-        def execute(ainb: MutableAinb, edit_op: AinbEditOperation):
-            # Edits ainb according to edit_op
+        def execute(ainb: MutableAinb, edit_op: AinbEditOperation) -> AinbEditOperation:
+            # Edits ainb according to edit_op, returns the op undoing exactly this edit
             raise NotImplementedError()
 
+        @staticmethod
+        def get_edited_paths(edit_op: AinbEditOperation, inverse_op: AinbEditOperation) -> Optional[List[list]]:
+            # Json paths execute touched, for revision tracking. None means the whole file's structure
+            return None
+
     class ADD_NODE(OP_IMPL):
         # No merge
+        KEEPS_NODE_REFS = True
+
         @staticmethod
-        def execute(ainb: MutableAinb, edit_op: AinbEditOperation):
+        def execute(ainb: MutableAinb, edit_op: AinbEditOperation) -> AinbEditOperation:
             # Duplicate so the caller can't mutate it
             node_json = orjson.loads(orjson.dumps(edit_op.op_value))
 
@@ -200,20 +364,147 @@ class AinbEditOperationExecutor:
                 ainb.json["Nodes"] = []
 
             # Append + assign index
+            refs = ainb.get_node_refs()
             ainb.json["Nodes"].append(node_json)
             node_json["Node Index"] = len(ainb.json["Nodes"]) - 1
+            refs.add_owner(node_json)
 
             print(f"Added node: {node_json}")
+            return AinbEditOperation(op_type=AinbEditOperationTypes.REMOVE_LAST_NODE, op_value=None)
+
+    class REMOVE_LAST_NODE(OP_IMPL):
+        # Only the inverse of ADD_NODE, nothing can link to a node that was just appended
+        KEEPS_NODE_REFS = True
+
+        @staticmethod
+        def execute(ainb: MutableAinb, edit_op: AinbEditOperation) -> AinbEditOperation:
+            refs = ainb.get_node_refs()
+            node_json = ainb.json["Nodes"].pop()
+            refs.remove_owner(node_json)
+            print(f"Removed node: {node_json['Node Index']}")
+            return AinbEditOperation(op_type=AinbEditOperationTypes.ADD_NODE, op_value=node_json)
+
+    class REMOVE_NODE(OP_IMPL):
+        # No merge
+        KEEPS_NODE_REFS = True
+
+        @staticmethod
+        def execute(ainb: MutableAinb, edit_op: AinbEditOperation) -> AinbEditOperation:
+            # Every node after it moves down one, and only refs to those nodes get renumbered
+            path: JSONPath = edit_op.op_selector
+            node_i = path.segment_by_name("node_i")
+            nodes = ainb.json["Nodes"]
+            node_json = nodes[node_i]
+            refs = ainb.get_node_refs()
+            restore = AinbEditOperationExecutor.detach_refs(ainb, refs, node_json)
+
+            # Its own refs leave with it, still numbered for where it was
+            refs.remove_owner(node_json)
+            nodes.pop(node_i)
+            for node in nodes[node_i:]:
+                node["Node Index"] -= 1
+            refs.shift_targets(node_i + 1, -1)
+
+            print(f"Removed node: {node_i}")
+            return AinbEditOperation(op_type=AinbEditOperationTypes.INSERT_NODE, op_value={"Node": node_json, "Restore": restore}, op_selector=path)
+
+    class INSERT_NODE(OP_IMPL):
+        # No merge
+        KEEPS_NODE_REFS = True
+
+        @staticmethod
+        def execute(ainb: MutableAinb, edit_op: AinbEditOperation) -> AinbEditOperation:
+            # Every node from here on moves up one, and only refs to those nodes get renumbered
+            path: JSONPath = edit_op.op_selector
+            node_i = path.segment_by_name("node_i")
+            node_json = orjson.loads(orjson.dumps(edit_op.op_value["Node"]))
+            if ainb.json.get("Nodes") is None:
+                ainb.json["Nodes"] = []
+            nodes = ainb.json["Nodes"]
+            refs = ainb.get_node_refs()
+
+            refs.shift_targets(node_i, 1)
+            for node in nodes[node_i:]:
+                node["Node Index"] += 1
+            node_json["Node Index"] = node_i
+            nodes.insert(node_i, node_json)
+            refs.add_owner(node_json)
+
+            # Put back whatever REMOVE_NODE unhooked, indexes now match what it recorded
+            if restore := edit_op.op_value.get("Restore"):
+                jsondiff.apply(ainb.json, restore)
+                for _, restored_path, _ in restore:
+                    refs.reindex_owner(ainb.json[restored_path[0]][restored_path[1]], is_command=restored_path[0] == "Commands")
+
+            print(f"Inserted node: {node_i}")
+            return AinbEditOperation(op_type=AinbEditOperationTypes.REMOVE_NODE, op_value=None, op_selector=path)
+
+    class ADD_LINK(OP_IMPL):
+        # No merge
+        KEEPS_NODE_REFS = True
+
+        @staticmethod
+        def execute(ainb: MutableAinb, edit_op: AinbEditOperation) -> AinbEditOperation:
+            # aj["Nodes"][node_i]["Linked Nodes"][link_type].insert(i_of_link_type, op_value)
+            path: JSONPath = edit_op.op_selector
+            node_json = ainb.json["Nodes"][path.segment_by_name("node_i")]
+            link_json = orjson.loads(orjson.dumps(edit_op.op_value))
+            refs = ainb.get_node_refs()
+
+            links = node_json.setdefault("Linked Nodes", {}).setdefault(path.segment_by_name("link_type"), [])
+            links.insert(path.segment_by_name("i_of_link_type"), link_json)
+            refs.add_refs(node_json, AinbNodeRefs.scan_link(node_json, link_json))
+            return AinbEditOperation(op_type=AinbEditOperationTypes.REMOVE_LINK, op_value=None, op_selector=path)
+
+    class REMOVE_LINK(OP_IMPL):
+        # No merge
+        KEEPS_NODE_REFS = True
+
+        @staticmethod
+        def execute(ainb: MutableAinb, edit_op: AinbEditOperation) -> AinbEditOperation:
+            path: JSONPath = edit_op.op_selector
+            node_json = ainb.json["Nodes"][path.segment_by_name("node_i")]
+            link_type = path.segment_by_name("link_type")
+            refs = ainb.get_node_refs()
+
+            links = node_json["Linked Nodes"][link_type]
+            link_json = links.pop(path.segment_by_name("i_of_link_type"))
+            refs.remove_container(node_json, link_json)
+            if not links:
+                del node_json["Linked Nodes"][link_type]  # Same as parsed files, types without links aren't listed
+            return AinbEditOperation(op_type=AinbEditOperationTypes.ADD_LINK, op_value=link_json, op_selector=path)
 
     class REPLACE_JSON(OP_IMPL):
         # No merge, clicking this button feels like saving your json
         @staticmethod
-        def execute(ainb: MutableAinb, edit_op: AinbEditOperation):
-            ainb.json.clear()
-            ainb.json.update(orjson.loads(edit_op.op_value))
+        def execute(ainb: MutableAinb, edit_op: AinbEditOperation) -> AinbEditOperation:
+            # Only what differs gets touched, and undoing it is just the inverse of that diff
+            inverse_patch = jsondiff.replace_document(ainb.json, orjson.loads(edit_op.op_value))
             print(f"Overwrote working ainb @ {ainb.location.fullfile}")
+            return AinbEditOperation(op_type=AinbEditOperationTypes.JSON_PATCH, op_value=inverse_patch)
+
+        @staticmethod
+        def get_edited_paths(edit_op: AinbEditOperation, inverse_op: AinbEditOperation) -> Optional[List[list]]:
+            # Only the diff knows, and the inverse covers the same paths
+            return jsondiff.get_touched_paths(inverse_op.op_value)
+
+    class JSON_PATCH(OP_IMPL):
+        # No merge
+        @staticmethod
+        def execute(ainb: MutableAinb, edit_op: AinbEditOperation) -> AinbEditOperation:
+            inverse_patch = jsondiff.apply(ainb.json, edit_op.op_value)
+            return AinbEditOperation(op_type=AinbEditOperationTypes.JSON_PATCH, op_value=inverse_patch)
+
+        @staticmethod
+        def get_edited_paths(edit_op: AinbEditOperation, inverse_op: AinbEditOperation) -> Optional[List[list]]:
+            return jsondiff.get_touched_paths(edit_op.op_value)
 
     class PARAM_UPDATE_DEFAULT(OP_IMPL):
+        @staticmethod
+        def is_node_refs_kept(edit_op: AinbEditOperation) -> bool:
+            # Param defaults never hold node indexes, but edit scripts can aim this at any key, eg an input's "Node Index"
+            return edit_op.op_selector.path[-1] in ("Value", "Default Value")
+
         @staticmethod
         def try_merge_history(edit_op: AinbEditOperation, prev_op: AinbEditOperation) -> bool:
             if (edit_op.when - prev_op.when) > timedelta(seconds=2):
@@ -228,7 +519,7 @@ class AinbEditOperationExecutor:
             return True  # prev_op should be re-persisted, current op is good to execute
 
         @staticmethod
-        def execute(ainb: MutableAinb, edit_op: AinbEditOperation):
+        def execute(ainb: MutableAinb, edit_op: AinbEditOperation) -> AinbEditOperation:
             # The path is guaranteed to exist for this case, so no missing parts
             # aj["Nodes"][i]["Immediate Parameters"][aj_type][i_of_type]["Value"] = op_value
             # aj["Global Parameters"][aj_type][i_of_type]["Default Value"] = op_value
@@ -238,9 +529,16 @@ class AinbEditOperationExecutor:
 
             if path.segment_by_name("param_type") == "vec3f":
                 lhs = path.get_one(ainb.json)
+                prev_value = [lhs[0], lhs[1], lhs[2], 0.0]  # Same shape dpg sends
                 x, y, z, _ = edit_op.op_value
                 lhs[0] = x  # Mutate components in-place
                 lhs[1] = y
                 lhs[2] = z
             else:
+                prev_value = path.get_one(ainb.json)
                 path.update_one(ainb.json, edit_op.op_value)
+            return AinbEditOperation(op_type=AinbEditOperationTypes.PARAM_UPDATE_DEFAULT, op_value=prev_value, op_selector=path)
+
+        @staticmethod
+        def get_edited_paths(edit_op: AinbEditOperation, inverse_op: AinbEditOperation) -> Optional[List[list]]:
+            return [edit_op.op_selector.path]
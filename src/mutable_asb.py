@@ -1,5 +1,6 @@
 from __future__ import annotations
 from datetime import datetime, timedelta
+import io
 from typing import *
 import uuid
 
@@ -8,16 +9,28 @@ import orjson
 
 from .app_types import *
 from .dt_tools.asb import ASB
+from . import jsondiff
+from .json_intern import intern_strings
+from .mutable_revisions import MutableRevisions
 
 
-class MutableAsb:
+class MutableAsb(MutableRevisions):
+    __slots__ = ("json", "location")
+
     @classmethod
     def from_dt_asb(cls, dt_asb: ASB, asb_location: PackIndexEntry) -> MutableAsb:
         asb = cls()
-        asb.json = dt_asb.output_dict
+        asb.json = intern_strings(dt_asb.output_dict)
         asb.location = asb_location
+        asb.init_revisions()
         return asb
 
+    def to_data(self) -> bytes:
+        dt_asb = ASB(self.json)
+        data = io.BytesIO()
+        dt_asb.ToBuffer(data)
+        return data.getvalue()
+
     def get_command_i(self, i: int) -> MutableAsbCommand:
         return MutableAsbCommand.from_ref(self.json["Commands"][i])
 
@@ -36,6 +49,8 @@ class MutableAsb:
 
 
 class MutableAsbCommand:
+    __slots__ = ("json",)
+
     @classmethod
     def from_ref(cls, json: dict) -> MutableAsbCommand:
         cmd = cls()
@@ -44,6 +59,8 @@ class MutableAsbCommand:
 
 
 class MutableAsbTransition:
+    __slots__ = ("json", "section_i", "section_j")
+
     @classmethod
     def from_ref(cls, i: int, j: int, json: dict) -> MutableAsbTransition:
         trans = cls()
@@ -54,6 +71,8 @@ class MutableAsbTransition:
 
 
 class MutableAsbNode:
+    __slots__ = ("json",)
+
     @classmethod
     def from_ref(cls, json: dict) -> MutableAsbNode:
         node = cls()
@@ -67,6 +86,8 @@ class MutableAsbNode:
 
 
 class MutableAsbNodeParamSection:
+    __slots__ = ("json", "name")
+
     @classmethod
     def from_ref(cls, json: dict, name: str) -> MutableAsbNodeParamSection:
         section = cls()
@@ -76,6 +97,8 @@ class MutableAsbNodeParamSection:
 
 
 class MutableAsbNodeParam:
+    __slots__ = ("json", "node_i", "param_section_name", "param_type", "i_of_type")
+
     @classmethod
     def from_ref(cls, json: dict, node_i: int, param_section_name: ParamSectionName, param_type: str, i_of_type: int) -> MutableAsbNodeParam:
         param = cls()
@@ -109,16 +132,21 @@ class AsbEditOperationExecutor:
             # Once a point in history has been persisted by user request, don't try to merge anything
             # into it regardless of recency.
             return False
+        if prev_op.is_save_pending:
+            # Already serialized into a queued save, the save marks this op with that data's hash once written
+            return False
 
         opcls: OP_IMPL = getattr(excls, edit_op.op_type)
         is_prev_op_amended = opcls.try_merge_history(edit_op, prev_op)
         return is_prev_op_amended
 
     @classmethod
-    def dispatch(excls, asb: MutableAsb, edit_op: AsbEditOperation):
-        # resolve the op to one of the classes below and run it on the asb
+    def dispatch(excls, asb: MutableAsb, edit_op: AsbEditOperation) -> AsbEditOperation:
+        # resolve the op to one of the classes below and run it on the asb, returning its inverse
         opcls: OP_IMPL = getattr(excls, edit_op.op_type)
-        opcls.execute(asb, edit_op)
+        inverse_op = opcls.execute(asb, edit_op)
+        asb.mark_edited(opcls.get_edited_paths(edit_op, inverse_op))
+        return inverse_op
 
     class OP_IMPL:
         @staticmethod
@@ -127,14 +155,19 @@ class AsbEditOperationExecutor:
             return False  # Don't merge by default
 
         @staticmethod
-        def execute(asb: MutableAsb, edit_op: AsbEditOperation):
-            # Edits asb according to edit_op
+        def execute(asb: MutableAsb, edit_op: AsbEditOperation) -> AsbEditOperation:
+            # Edits asb according to edit_op, returns the op undoing exactly this edit
             raise NotImplementedError()
 
+        @staticmethod
+        def get_edited_paths(edit_op: AsbEditOperation, inverse_op: AsbEditOperation) -> Optional[List[list]]:
+            # Json paths execute touched, for revision tracking. None means the whole file's structure
+            return None
+
     class ADD_NODE(OP_IMPL):
         # No merge
         @staticmethod
-        def execute(asb: MutableAsb, edit_op: AsbEditOperation):
+        def execute(asb: MutableAsb, edit_op: AsbEditOperation) -> AsbEditOperation:
             # Duplicate so the caller can't mutate it
             node_json = orjson.loads(orjson.dumps(edit_op.op_value))
 
@@ -154,14 +187,40 @@ class AsbEditOperationExecutor:
             node_json["Node Index"] = len(asb.json["Nodes"]) - 1
 
             print(f"Added node: {node_json}")
+            return AsbEditOperation(op_type=AsbEditOperationTypes.REMOVE_LAST_NODE, op_value=None)
+
+    class REMOVE_LAST_NODE(OP_IMPL):
+        # Only the inverse of ADD_NODE, nothing can link to a node that was just appended
+        @staticmethod
+        def execute(asb: MutableAsb, edit_op: AsbEditOperation) -> AsbEditOperation:
+            node_json = asb.json["Nodes"].pop()
+            print(f"Removed node: {node_json['Node Index']}")
+            return AsbEditOperation(op_type=AsbEditOperationTypes.ADD_NODE, op_value=node_json)
 
     class REPLACE_JSON(OP_IMPL):
         # No merge, clicking this button feels like saving your json
         @staticmethod
-        def execute(asb: MutableAsb, edit_op: AsbEditOperation):
-            asb.json.clear()
-            asb.json.update(orjson.loads(edit_op.op_value))
+        def execute(asb: MutableAsb, edit_op: AsbEditOperation) -> AsbEditOperation:
+            # Only what differs gets touched, and undoing it is just the inverse of that diff
+            inverse_patch = jsondiff.replace_document(asb.json, orjson.loads(edit_op.op_value))
             print(f"Overwrote working asb @ {asb.location.fullfile}")
+            return AsbEditOperation(op_type=AsbEditOperationTypes.JSON_PATCH, op_value=inverse_patch)
+
+        @staticmethod
+        def get_edited_paths(edit_op: AsbEditOperation, inverse_op: AsbEditOperation) -> Optional[List[list]]:
+            # Only the diff knows, and the inverse covers the same paths
+            return jsondiff.get_touched_paths(inverse_op.op_value)
+
+    class JSON_PATCH(OP_IMPL):
+        # No merge
+        @staticmethod
+        def execute(asb: MutableAsb, edit_op: AsbEditOperation) -> AsbEditOperation:
+            inverse_patch = jsondiff.apply(asb.json, edit_op.op_value)
+            return AsbEditOperation(op_type=AsbEditOperationTypes.JSON_PATCH, op_value=inverse_patch)
+
+        @staticmethod
+        def get_edited_paths(edit_op: AsbEditOperation, inverse_op: AsbEditOperation) -> Optional[List[list]]:
+            return jsondiff.get_touched_paths(edit_op.op_value)
 
     class PARAM_UPDATE_DEFAULT(OP_IMPL):
         @staticmethod
@@ -176,7 +235,7 @@ class AsbEditOperationExecutor:
             return True  # prev_op should be re-persisted, current op is good to execute
 
         @staticmethod
-        def execute(asb: MutableAsb, edit_op: AsbEditOperation):
+        def execute(asb: MutableAsb, edit_op: AsbEditOperation) -> AsbEditOperation:
             #print(f"param default = {edit_op.op_value} @ {edit_op.op_selector}")
             sel = edit_op.op_selector
             if len(sel) != 6 or sel[0] != "Nodes" or sel[-1] not in ("Init Value", "Default Value"):
@@ -193,9 +252,20 @@ class AsbEditOperationExecutor:
 
             param_type, i_of_type, default_name = sel[3], sel[4], sel[5]
             if param_type == "vec3f":
+                lhs = target_params[param_type][i_of_type][default_name]
+                prev_value = [lhs[0], lhs[1], lhs[2], 0.0]  # Same shape dpg sends
                 x, y, z, _ = edit_op.op_value
                 target_params[param_type][i_of_type][default_name][0] = x
                 target_params[param_type][i_of_type][default_name][1] = y
                 target_params[param_type][i_of_type][default_name][2] = z
             else:
+                prev_value = target_params[param_type][i_of_type][default_name]
                 target_params[param_type][i_of_type][default_name] = edit_op.op_value
+            return AsbEditOperation(op_type=AsbEditOperationTypes.PARAM_UPDATE_DEFAULT, op_value=prev_value, op_selector=sel)
+
+        @staticmethod
+        def get_edited_paths(edit_op: AsbEditOperation, inverse_op: AsbEditOperation) -> Optional[List[list]]:
+            sel = edit_op.op_selector
+            if sel[1] == -420 and sel[2] == "Local Blackboard Parameters":
+                return [[sel[2], *sel[3:]]]
+            return [list(sel)]
@@ -0,0 +1,67 @@
+from typing import *
+
+from .jsonpath import JSONPathSegment
+
+
+# Revisions only ever go up: the file's counter is bumped once per executed edit op,
+# and every part the op touched remembers the file revision it was last changed at.
+# Caches of derived data (json view, layout key, rendered nodes, saves, ...) store the revision they were made from
+# and are current as long as it still matches, so nothing has to be told to invalidate.
+
+class MutableRevisions:
+    __slots__ = ("revision", "structure_revision", "node_revisions", "section_revisions", "saved_revision", "derived_cache")
+
+    # Node keys that change what a graph is made of, rather than just what one node shows
+    STRUCTURAL_NODE_KEYS = ("Node Type", "Node Index", "Linked Nodes")
+
+    def init_revisions(self) -> None:
+        self.revision = 0
+        self.structure_revision = 0  # Nodes added/removed/relinked, or anything we can't pin down further
+        self.node_revisions: Dict[int, int] = {}  # {node_i: revision}
+        self.section_revisions: Dict[str, int] = {}  # {top level key other than Nodes: revision}
+        self.saved_revision = 0  # Revision that matches the file on disk, which is what we loaded
+        self.derived_cache: Dict[str, Tuple[int, Any]] = {}
+
+    @property
+    def is_dirty(self) -> bool:
+        return self.revision != self.saved_revision
+
+    def mark_edited(self, paths: Optional[List[List[JSONPathSegment]]]) -> None:
+        # Paths the edit touched, None when that's not known
+        self.revision += 1
+        if paths is None:
+            self.structure_revision = self.revision
+            return
+        for path in paths:
+            if len(path) >= 3 and path[0] == "Nodes" and isinstance(path[1], int) and path[2] not in self.STRUCTURAL_NODE_KEYS:
+                self.node_revisions[path[1]] = self.revision
+            elif len(path) >= 1 and path[0] != "Nodes":
+                self.section_revisions[path[0]] = self.revision
+            else:
+                self.structure_revision = self.revision
+
+    def mark_saved(self, revision: int) -> None:
+        self.saved_revision = revision
+
+    def get_changes_since(self, revision: int) -> Tuple[bool, Set[int], Set[str]]:
+        # -> (structure changed, node indexes changed, sections changed) after the given revision
+        return (
+            self.structure_revision > revision,
+            {node_i for node_i, r in self.node_revisions.items() if r > revision},
+            {section for section, r in self.section_revisions.items() if r > revision},
+        )
+
+    def get_derived(self, name: str, revision: int, compute: Callable[[], Any]) -> Any:
+        # Pass the narrowest revision the value depends on, eg structure_revision for layouts
+        cached = self.derived_cache.get(name)
+        if cached is not None and cached[0] == revision:
+            return cached[1]
+        value = compute()
+        self.derived_cache[name] = (revision, value)
+        return value
+
+    def carry_derived(self, name: str, revision: int) -> None:
+        # For edits that leave a value as it was, or kept it current in place: if it was current at revision it still is
+        cached = self.derived_cache.get(name)
+        if cached is not None and cached[0] == revision:
+            self.derived_cache[name] = (self.revision, cached[1])
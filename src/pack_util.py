@@ -1,5 +1,12 @@
 from collections import defaultdict
+import contextlib
 import functools
+import mmap
+import os
+import pathlib
+import shutil
+import tempfile
+import threading
 from typing import *
 import io
 
@@ -20,49 +27,166 @@ def get_zsdics() -> Dict[str, zstd.ZstdCompressionDict]:
         return dict()
 
     romfs = dpg.get_value(AppConfigKeys.ROMFS_PATH)
-    dctx = get_zstd_decompression_ctx(dict_data=None)
-    archive = sarc.SARC(dctx.decompress(open(f"{romfs}/{zsdic_pack}", "rb").read()))
+    dctx = get_zstd_decompression_ctx(None)
+    with open_mmap(f"{romfs}/{zsdic_pack}") as data:
+        archive = sarc.SARC(dctx.decompress(data))
     return { fn: zstd.ZstdCompressionDict(archive.get_file_data(fn)) for fn in archive.list_files() }
 
 
-@functools.lru_cache  # Real Coders would do a thread pool here...
+def thread_local_cache(func):
+    # Like functools.lru_cache, but per thread: zstd contexts must not be shared across threads,
+    # and saves+crawls run off the ui thread now.
+    tls = threading.local()
+    @functools.wraps(func)
+    def wrapper(*args):
+        if not hasattr(tls, "cache"):
+            tls.cache = {}
+        if args not in tls.cache:
+            tls.cache[args] = func(*args)
+        return tls.cache[args]
+    return wrapper
+
+
+@thread_local_cache
 def get_zstd_decompression_ctx(dict_data: Optional[zstd.ZstdCompressionDict] = None) -> zstd.ZstdDecompressor:
     return zstd.ZstdDecompressor(dict_data=dict_data)
 
 
-@functools.lru_cache
+@thread_local_cache
 def get_pack_decompression_ctx() -> zstd.ZstdDecompressor:
     pack_zsdic = get_zsdics().get("pack.zsdic")
-    return get_zstd_decompression_ctx(dict_data=pack_zsdic)
+    return get_zstd_decompression_ctx(pack_zsdic)
 
 
-@functools.lru_cache
+@thread_local_cache
 def get_file_decompression_ctx() -> zstd.ZstdDecompressor:
     # For loose non-bcett files, unrelated to packs really
     zs_zsdic = get_zsdics().get("zs.zsdic")
-    return get_zstd_decompression_ctx(dict_data=zs_zsdic)
+    return get_zstd_decompression_ctx(zs_zsdic)
 
 
-@functools.lru_cache
+@thread_local_cache
 def get_file_compression_ctx() -> zstd.ZstdCompressor:
     pack_zsdic = get_zsdics().get("zs.zsdic")
     return zstd.ZstdCompressor(level=10, dict_data=pack_zsdic)
 
 
-@functools.lru_cache
+@thread_local_cache
 def get_pack_compression_ctx() -> zstd.ZstdCompressor:
     pack_zsdic = get_zsdics().get("pack.zsdic")
     return zstd.ZstdCompressor(level=10, dict_data=pack_zsdic)
 
 
+@contextlib.contextmanager
+def atomic_output(filename: Union[str, pathlib.Path]) -> Iterator[BinaryIO]:
+    # Write to a temp file beside the destination, fsync, then rename over it. Readers see either the old
+    # or the new file, never a partial one, and a crash mid-write leaves the destination untouched.
+    path = pathlib.Path(filename)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    fd, tmpname = tempfile.mkstemp(dir=path.parent, prefix=f".{path.name}.", suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as out:
+            yield out
+            out.flush()
+            os.fsync(out.fileno())
+        mode = path.stat().st_mode & 0o777 if path.exists() else 0o664
+        os.chmod(tmpname, mode)
+        os.replace(tmpname, path)
+    except BaseException:
+        try:
+            os.unlink(tmpname)
+        except FileNotFoundError:
+            pass
+        raise
+
+    if os.name != "nt":
+        # Persist the rename itself
+        dirfd = os.open(path.parent, os.O_RDONLY)
+        try:
+            os.fsync(dirfd)
+        finally:
+            os.close(dirfd)
+
+
+def atomic_write(filename: Union[str, pathlib.Path], data: bytes) -> None:
+    with atomic_output(filename) as out:
+        out.write(data)
+
+
+def atomic_clone(src: Union[str, pathlib.Path], dst: Union[str, pathlib.Path]) -> None:
+    # Byte-identical copy, sharing extents where the filesystem allows it (btrfs/xfs reflink),
+    # else an in-kernel copy_file_range, else a plain userspace copy.
+    with open(src, "rb") as srcf, atomic_output(dst) as out:
+        try:
+            import fcntl
+            FICLONE = 0x40049409
+            fcntl.ioctl(out.fileno(), FICLONE, srcf.fileno())
+            return
+        except (ImportError, OSError):
+            pass
+
+        if hasattr(os, "copy_file_range"):
+            try:
+                remaining = os.fstat(srcf.fileno()).st_size
+                while remaining > 0:
+                    copied = os.copy_file_range(srcf.fileno(), out.fileno(), remaining)
+                    if copied == 0:
+                        break
+                    remaining -= copied
+                if remaining == 0:
+                    return
+            except OSError:
+                pass
+            # Start over from scratch
+            srcf.seek(0)
+            out.seek(0)
+            out.truncate()
+
+        shutil.copyfileobj(srcf, out)
+
+
+@contextlib.contextmanager
+def open_mmap(filename: Union[str, pathlib.Path]) -> Iterator[memoryview]:
+    # Read-only mapping of a whole file, the view is only valid inside the with block.
+    # Parse what you need out of it and don't keep slices around.
+    with open(filename, "rb") as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            yield memoryview(b"")  # mmap refuses empty files
+            return
+        mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    view = memoryview(mm)
+    try:
+        yield view
+    finally:
+        view.release()
+        try:
+            mm.close()
+        except BufferError:
+            pass  # Someone kept a slice after all, the mapping gets unmapped whenever they let go of it
+
+
 def save_file_to_pack(packfile: str, internalfile: str, internaldata: io.BytesIO):
-    # Make an updated sarc file from existing modfs
-    dctx = get_pack_decompression_ctx()
-    with open(packfile, "rb") as oldf:
-        archive = sarc.SARC(dctx.decompress(oldf.read()))
+    save_files_to_pack(packfile, {internalfile: internaldata.getvalue()})
+
+
+def save_files_to_pack(packfile: str, internalfiles: Dict[str, bytes], romfs_packfile: Optional[str] = None):
+    # Make an updated sarc file, replacing every given file in one rebuild.
+    # Existing modfs packs are updated in place, otherwise the pack is initialized from romfs_packfile.
+    if pathlib.Path(packfile).exists():
+        archive = _load_pack_archive(packfile)
+    elif romfs_packfile is not None:
+        archive = _load_pack_archive(romfs_packfile)
+        if all(_get_file_data_or_none(archive, f) == data for f, data in internalfiles.items()):
+            # Nothing actually differs from romfs, skip the rebuild+recompress entirely
+            atomic_clone(romfs_packfile, packfile)
+            return
+    else:
+        raise FileNotFoundError(f"No existing pack to update at {packfile}")
+
     writer = sarc.make_writer_from_sarc(archive)
-    writer.delete_file(internalfile)
-    writer.add_file(internalfile, internaldata.getvalue())
+    for internalfile, internaldata in internalfiles.items():
+        writer.delete_file(internalfile)
+        writer.add_file(internalfile, internaldata)
     updated_sarc = io.BytesIO()
     writer.write(updated_sarc)
 
@@ -72,44 +196,53 @@ def save_file_to_pack(packfile: str, internalfile: str, internaldata: io.BytesIO
     # TODO better sanity check?
     if len(data) < 256:  # arbitrary
         raise Exception(f"Refusing to overwrite {packfile} with only {len(data)}B compressed")
-    with open(packfile, "wb") as out:
-        out.write(data)
+    atomic_write(packfile, data)
+
+
+def _get_file_data_or_none(archive: sarc.SARC, internalfile: str) -> Optional[memoryview]:
+    try:
+        return archive.get_file_data(internalfile)
+    except KeyError:
+        return None
 
 
 def load_compressed_file(filename: str) -> memoryview:
     # Not pack related at all lol
     dctx = get_file_decompression_ctx()
-    return memoryview(dctx.decompress(open(filename, "rb").read()))
+    with open_mmap(filename) as data:
+        return memoryview(dctx.decompress(data))
 
 
-def save_compressed_file(filename: str, data: io.BytesIO) -> None:
+def save_compressed_file(filename: str, data: bytes) -> None:
     # Not pack related at all lol
     # Compress and save
     cctx = get_file_compression_ctx()
-    data = cctx.compress(data.getvalue())
+    data = cctx.compress(data)
     # TODO better sanity check?
     if len(data) < 256:  # arbitrary
         raise Exception(f"Refusing to overwrite {filename} with only {len(data)}B compressed")
-    with open(filename, "wb") as out:
-        out.write(data)
+    atomic_write(filename, data)
 
 
-def load_file_from_pack(packfile: str, internalfile: str) -> memoryview:
+def _load_pack_archive(packfile: Union[str, pathlib.Path]) -> sarc.SARC:
     dctx = get_pack_decompression_ctx()
-    archive = sarc.SARC(dctx.decompress(open(packfile, "rb").read()))
+    with open_mmap(packfile) as data:
+        return sarc.SARC(dctx.decompress(data))
+
+
+def load_file_from_pack(packfile: str, internalfile: str) -> memoryview:
+    archive = _load_pack_archive(packfile)
     return archive.get_file_data(internalfile)
 
 
 def load_all_files_from_pack(packname: str) -> Dict[str, memoryview]:
-    dctx = get_pack_decompression_ctx()
-    archive = sarc.SARC(dctx.decompress(open(packname, "rb").read()))
+    archive = _load_pack_archive(packname)
     return { fn: archive.get_file_data(fn) for fn in sorted(archive.list_files()) }
 
 
 def load_ext_files_from_pack(packname: str, extensions: List["RomfsFileTypes"]) -> FileDataByExt:
     out = defaultdict(dict)
-    dctx = get_pack_decompression_ctx()
-    archive = sarc.SARC(dctx.decompress(open(packname, "rb").read()))
+    archive = _load_pack_archive(packname)
     for f in sorted(archive.list_files()):
         if e:= RomfsFileTypes.get_from_filename(f):
             out[e][f] = archive.get_file_data(f)
@@ -117,8 +250,7 @@ def load_ext_files_from_pack(packname: str, extensions: List["RomfsFileTypes"])
 
 
 def get_pack_internal_filenames(packname: str) -> List[str]:
-    dctx = get_pack_decompression_ctx()
-    archive = sarc.SARC(dctx.decompress(open(packname, "rb").read()))
+    archive = _load_pack_archive(packname)
     return sorted(archive.list_files())
 
 # TODO natural sort + ignore case, they're too inconsistent
@@ -0,0 +1,70 @@
+import gc
+import sys
+import time
+import tracemalloc
+from typing import *
+
+# Run from the repo root with the same env as the app (ROMFS, APPVAR, OUTPUT_MODFS, ...):
+#     python3 -m src.run_memory_benchmark [N]
+# Opens the first N crawled ainbs and keeps them open like windows would, then reports what stays allocated.
+# "pinned" also keeps what loading used to hold on to: each file's parser and its view into the decompressed pack.
+
+from . import curio
+from .app_types import *
+from .db import Connection, PackIndex
+from .dt_tools.ainb import AINB
+from .edit_context import EditContext
+from .main import init_main
+from .mutable_ainb import MutableAinb
+from . import pack_util
+
+
+def get_benchmark_locations(n: int) -> List[PackIndexEntry]:
+    with Connection.reader() as conn:
+        entries_by_pack = PackIndex.get_all_entries_by_extension(conn, RomfsFileTypes.AINB)
+    locations = [e for entries in entries_by_pack.values() for e in entries.values()]
+    return locations[:n]
+
+
+def load_pinned(ectx: EditContext, location: PackIndexEntry) -> Tuple[AINB, memoryview, MutableAinb]:
+    resolved = ectx.resolver.resolve(location)
+    if resolved.is_pack:
+        data = pack_util.load_file_from_pack(resolved.path, location.internalfile)
+    elif resolved.is_compressed:
+        data = pack_util.load_compressed_file(resolved.path)
+    else:
+        with open(resolved.path, "rb") as f:
+            data = memoryview(f.read())
+    dt_ainb = AINB(data)
+    return dt_ainb, data, MutableAinb.from_dt_ainb(dt_ainb, location)
+
+
+def measure(label: str, locations: List[PackIndexEntry], load: Callable[[PackIndexEntry], Any]) -> None:
+    gc.collect()
+    tracemalloc.start()
+    t0 = time.perf_counter()
+    kept = [load(location) for location in locations]
+    elapsed = time.perf_counter() - t0
+    gc.collect()
+    retained, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    mb = 1024 * 1024
+    print(f"{label:>8}: {len(kept)} files in {elapsed:.2f}s, retained {retained / mb:.1f} MiB, peak {peak / mb:.1f} MiB", flush=True)
+    del kept
+
+
+def main():
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 50
+
+    async def benchmark_main():
+        await init_main()
+        ectx = EditContext.get()
+        locations = get_benchmark_locations(n)
+        measure("current", locations, ectx.load_ainb)
+        measure("pinned", locations, lambda location: load_pinned(ectx, location))
+
+    curio.run(benchmark_main)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,120 @@
+import pathlib
+from dataclasses import dataclass
+from typing import *
+
+import dearpygui.dearpygui as dpg
+from . import curio
+
+from .app_types import *
+from .edit_journal import EditJournal
+from .location_resolver import LocationResolver
+from . import pack_util
+
+
+# Saving used to rebuild the destination pack once per dirty file: decompress, rebuild sarc, recompress, rewrite.
+# Instead, dirty files are serialized on the ui loop (a consistent snapshot of the working json),
+# queued up by destination, and every destination is then rewritten once in a worker thread.
+
+
+@dataclass
+class SaveQueueItem:
+    location: PackIndexEntry
+    data: bytes
+    is_compressed_root: bool = False  # Root ASBs are always compressed, Root AINBs never are
+    edit_op: Any = None  # Latest edit op when serialized, the journal marks it saved once written
+    on_saved: Optional[Callable[[], None]] = None  # Called on the ui loop once written, eg to mark the revision saved
+
+
+class SaveQueue:
+    PROGRESS_TAG = "save_queue/progress"
+
+    def __init__(self, romfs: str, modfs: str, resolver: LocationResolver, journal: EditJournal):
+        self.romfs = romfs
+        self.modfs = modfs
+        self.resolver = resolver
+        self.journal = journal
+        # {packfile: {internalfile: SaveQueueItem}}, latest enqueue wins
+        self.pending: Dict[str, Dict[str, SaveQueueItem]] = {}
+        self.is_flushing = False
+
+    def enqueue(self, item: SaveQueueItem) -> None:
+        self.pending.setdefault(item.location.packfile, {})[item.location.internalfile] = item
+
+    def discard(self, location: PackIndexEntry) -> None:
+        # Drop a queued save, one that is already being written still finishes
+        if items := self.pending.get(location.packfile):
+            items.pop(location.internalfile, None)
+            if not items:
+                del self.pending[location.packfile]
+
+    async def flush_as_coro(self, dpg_args=None) -> None:
+        if self.is_flushing:
+            # The running flush keeps draining self.pending, including anything just enqueued
+            return
+
+        self.is_flushing = True
+        try:
+            done = 0
+            while self.pending:
+                packfile, items = next(iter(self.pending.items()))
+                del self.pending[packfile]
+                total = done + sum(len(v) for v in self.pending.values()) + len(items)
+                self.show_progress(done, total, packfile)
+
+                try:
+                    await curio.run_in_thread(self.write_destination, packfile, items)
+                except Exception as e:
+                    # Back in the queue for the next save, behind anything enqueued for this pack in the meantime
+                    self.pending[packfile] = {**items, **self.pending.get(packfile, {})}
+                    print(f"Saving {packfile} failed: {e}", flush=True)
+                    self.show_failed(packfile, e)
+                    return
+                done += len(items)
+                for item in items.values():
+                    self.resolver.notify_written(item.location)
+                    self.journal.mark_saved(item.location, item.edit_op, item.data)
+                    if item.on_saved is not None:
+                        item.on_saved()
+                    print(f"Saved {item.location.fullfile}")
+            self.show_progress(done, done, None)
+        finally:
+            self.is_flushing = False
+
+    def show_progress(self, done: int, total: int, packfile: Optional[str]) -> None:
+        if not dpg.does_item_exist(self.PROGRESS_TAG):
+            return
+        if packfile is None:
+            dpg.configure_item(self.PROGRESS_TAG, overlay=f"Saved {done} files")
+            dpg.set_value(self.PROGRESS_TAG, 1.0)
+            return
+        dpg.show_item(self.PROGRESS_TAG)
+        dpg.configure_item(self.PROGRESS_TAG, overlay=f"Saving {done}/{total}: {packfile}")
+        dpg.set_value(self.PROGRESS_TAG, done / max(total, 1))
+
+    def show_failed(self, packfile: str, e: Exception) -> None:
+        if not dpg.does_item_exist(self.PROGRESS_TAG):
+            return
+        dpg.show_item(self.PROGRESS_TAG)
+        dpg.configure_item(self.PROGRESS_TAG, overlay=f"Saving {packfile} failed, save again to retry: {e}")
+
+    def write_destination(self, packfile: str, items: Dict[str, SaveQueueItem]) -> None:
+        write_destination(self.romfs, self.modfs, packfile, items)
+
+
+def write_destination(romfs: str, modfs: str, packfile: str, items: Dict[str, SaveQueueItem]) -> None:
+    # Runs in a worker thread (or process), no dpg calls in here
+    if packfile == "Root":
+        for item in items.values():
+            modfs_file = pathlib.Path(f"{modfs}/{item.location.internalfile}")
+            if item.is_compressed_root:
+                pack_util.save_compressed_file(modfs_file, item.data)
+            else:
+                pack_util.atomic_write(modfs_file, item.data)
+        return
+
+    # Overwrite all files and save updated pack.
+    # Newly modified packs are built straight from romfs in the same pass, created 0o664
+    # (PROTIP: Make your romfs read only)
+    modfs_packfile = pathlib.Path(f"{modfs}/{packfile}")
+    romfs_packfile = pathlib.Path(f"{romfs}/{packfile}")
+    pack_util.save_files_to_pack(modfs_packfile, {f: item.data for f, item in items.items()}, romfs_packfile=romfs_packfile)
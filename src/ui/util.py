@@ -2,6 +2,7 @@ from datetime import datetime
 import functools
 
 import dearpygui.dearpygui as dpg
+import orjson
 
 from ..app_types import *
 
@@ -29,6 +30,20 @@ def prettydate(d: datetime) -> str:
         return '{} hours ago'.format(s/3600)
 
 
+def dump_json_indent4(json: Any) -> str:
+    # orjson only indents by 2, but is fast + keeps unicode strings unescaped.
+    # Doubling the indents is a few bytes.replace passes instead of a python loop over every line:
+    # raw newlines only ever start lines (strings escape theirs), going deepest first and swapping
+    # finished lines' newline for \0 (escaped in strings too) keeps shallower passes off deeper lines.
+    data = orjson.dumps(json, option=orjson.OPT_INDENT_2)
+    depth = 0
+    while b"\n" + b"  " * (depth + 1) in data:
+        depth += 1
+    for d in range(depth, 0, -1):
+        data = data.replace(b"\n" + b"  " * d, b"\0" + b"    " * d)
+    return data.replace(b"\0", b"\n").decode("utf8")
+
+
 @functools.lru_cache
 def make_node_theme_for_hue(hue: AppColor) -> DpgTag:
     with dpg.theme() as theme:
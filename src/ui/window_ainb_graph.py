@@ -1,4 +1,5 @@
 from __future__ import annotations
+import itertools
 import pathlib
 from typing import *
 from collections import defaultdict
@@ -8,12 +9,13 @@ import dearpygui.dearpygui as dpg
 import graphviz
 import orjson
 
-from ..app_ainb_cache import scoped_pack_lookup
+from .. import app_precompute
+from ..app_ainb_cache import scoped_pack_lookup, get_node_catalog, get_userdefined_catalog
 from ..edit_context import EditContext
 from ..mutable_ainb import MutableAinb, MutableAinbParam
-from .. import db, pack_util
+from .. import db, jsondiff, pack_util
 from ..app_types import *
-from .util import make_node_theme_for_hue, prettydate
+from .util import dump_json_indent4, make_node_theme_for_hue, prettydate
 
 
 # Legend:
@@ -65,23 +67,35 @@ class AinbGraphLayout:
     inflight_dot: graphviz.Digraph = None
     inflight_nodes: dict = None
     location: PackIndexEntry = None
+    layout_key: str = None
+    is_estimated: bool = False  # Precomputed from guessed node sizes, shown until the real sizes are laid out
     global_translate: Tuple[int, int] = None
 
     @property
     def has_layout(self) -> bool:
         return self.layout_data is not None
 
-    @classmethod
-    def try_get_cached_layout(cls, location: PackIndexEntry) -> AinbGraphLayout:
-        # if layout_data := db.TODOLayoutCache.get_by_fullfile(location.fullfile):
-        #     return cls(location, layout_data)
-        return cls(location)
+    @staticmethod
+    def get_layout_key(ainb: MutableAinb) -> str:
+        # Shared with precompute, so its layouts are found here
+        return ainb.get_derived("layout_key", ainb.structure_revision, lambda: app_precompute.get_layout_key(ainb.json))
 
-    def __init__(self, location: PackIndexEntry, layout_data: dict = None):
+    @classmethod
+    def try_get_cached_layout(cls, ainb: MutableAinb) -> AinbGraphLayout:
+        layout_key = cls.get_layout_key(ainb)
+        with db.Connection.reader() as conn:
+            cached = db.AinbGraphLayoutCache.get_by_fullfile(conn, ainb.location.fullfile, layout_key)
+        if cached is None:
+            return cls(ainb.location, layout_key)
+        return cls(ainb.location, layout_key, *cached)
+
+    def __init__(self, location: PackIndexEntry, layout_key: str, layout_data: dict = None, is_estimated: bool = False):
         self.location = location
+        self.layout_key = layout_key
         self.layout_data = layout_data
+        self.is_estimated = is_estimated
         self.global_translate = [0, 0]
-        if not self.has_layout:
+        if not self.has_layout or self.is_estimated:
             # begin building new layout
             self.inflight_nodes ={}
             self.inflight_dot = graphviz.Digraph(
@@ -91,17 +105,17 @@ class AinbGraphLayout:
             )
 
     def maybe_dot_node(self, i: int, node_tag: DpgTag):
-        if self.has_layout:
+        if self.inflight_dot is None:
             return
         self.inflight_nodes[i] = node_tag
 
     def maybe_dot_edge(self, src_i: int, dst_i: int):
-        if self.has_layout:
+        if self.inflight_dot is None:
             return
         self.inflight_dot.edge(str(src_i), str(dst_i))
 
     async def finalize(self):
-        if self.has_layout:
+        if self.inflight_dot is None:
             return
 
         # TODO reimplement "after next frame" wait
@@ -123,9 +137,11 @@ class AinbGraphLayout:
             x, y = int(float(x)), -1 * int(float(y))
             out[node_index] = x, y
 
-        # TODO persist layout queryable by i+command? Dict[i|str, vec2i] but i should be fine
         # Persist separate per-graph xy translation for "panning" just like stinky did it
         self.layout_data = out
+        self.is_estimated = False
+        with db.Connection.writer() as conn:
+            db.AinbGraphLayoutCache.persist(conn, self.location.fullfile, self.layout_key, out)
 
         # persist svg
         if _do_svg_persist := True:
@@ -165,6 +181,7 @@ class WindowAinbGraph:
         print(f"Opening {ainb_location.fullfile}")
         self.ectx = ectx
         self.ainb = self.ectx.load_ainb(ainb_location)
+        self.json_textbox_revision: Optional[int] = None
 
     @property
     def history_entries_tag(self) -> DpgTag:
@@ -178,8 +195,10 @@ class WindowAinbGraph:
     def json_textbox(self) -> DpgTag:
         return f"{self.tag}/tabs/json/textbox"
 
-    async def create_as_coro(self, **window_kwargs) -> None:
+    async def create_as_coro(self, pan_node_i: Optional[int] = None, **window_kwargs) -> None:
         await self.create(**window_kwargs)
+        if pan_node_i is not None:
+            self.editor.pan_to_node(pan_node_i)
         while True:
             # ectx owns, we run this instance and its ui
             await curio.sleep(69)
@@ -191,6 +210,9 @@ class WindowAinbGraph:
         else:
             window_label = f"[{category}] {ainbfile} [from {self.ainb.location.packfile}]"
 
+        if self.ectx.is_overridden_by_modfs(self.ainb.location):
+            window_label = f"{window_label} [modfs]"
+
         self.tag = dpg.add_window(
             label=window_label,
             on_close=lambda: self.ectx.close_file_window(self.ainb.location),
@@ -200,29 +222,56 @@ class WindowAinbGraph:
         return self.tag
 
     async def redump_json_textbox(self):
-        # Replace json textbox with working ainb (possibly dirty)
-        ainb_json_str = orjson.dumps(self.ainb.json, option=orjson.OPT_INDENT_2)
-        # yep. this lib only supports 2 spaces, but fast + keeps unicode strings unescaped
-        if True: # if dpg.get_value(AppConfigKeys.INDENT_4):
-            ainb_json_str = '\n'.join([
-                ' '*(((len(line) - len(line.lstrip(' '))) // 2) * 4) + line.lstrip(' ')
-                for line in ainb_json_str.decode("utf8").split('\n')
-            ])
-        dpg.set_value(self.json_textbox, ainb_json_str)
+        # Replace json textbox with working ainb (possibly dirty), only when it was edited since the last dump.
+        # Unapplied changes in the textbox survive tab switches until then.
+        if self.json_textbox_revision == self.ainb.revision:
+            return
+        dpg.set_value(self.json_textbox, dump_json_indent4(self.ainb.json))
+        self.json_textbox_revision = self.ainb.revision
 
     def rerender_graph_from_json(self):
         user_json_str = dpg.get_value(self.json_textbox)
 
+        # Only the difference is applied and stored, a one character edit stays a one entry patch
+        patch = jsondiff.diff(self.ainb.json, orjson.loads(user_json_str))
+        if not patch:
+            return
+
         # Send event to edit ctx
-        edit_op = AinbEditOperation(op_type=AinbEditOperationTypes.REPLACE_JSON, op_value=user_json_str)
+        edit_op = AinbEditOperation(op_type=AinbEditOperationTypes.JSON_PATCH, op_value=patch)
         self.ectx.perform_new_ainb_edit_operation(self.ainb, edit_op)
+        return self.rerender_stale()
 
+    def rerender_graph(self):
         # Re-render editor TODO this belongs in AinbGraphEditor?
         dpg.delete_item(self.node_editor)
         dpg.delete_item(f"{self.node_editor}/toolbar")
 
         return CallbackReq.AwaitCoro(self.editor.render_contents)
 
+    def rerender_stale(self):
+        # Re-render only the nodes edited since the graph was last rendered, unless the graph's structure changed
+        scope = self.editor.get_stale_scope()
+        if scope is None:
+            return self.rerender_graph()
+        self.editor.rerender_nodes(scope)
+
+    def undo(self):
+        if self.ectx.undo_ainb(self.ainb):
+            return self.rerender_stale()
+
+    def redo(self):
+        if self.ectx.redo_ainb(self.ainb):
+            return self.rerender_stale()
+
+    def discard_unsaved(self):
+        # Back to the file as last saved, by reopening the window so it loads without the discarded edits
+        location = self.ainb.location
+        self.ectx.discard_unsaved_edits(location)
+        dpg.delete_item(self.tag)
+        self.ectx.close_file_window(location)
+        return CallbackReq.SpawnCoro(self.ectx.open_ainb_window_as_coro, [location])
+
     async def rerender_history(self):
         dpg.delete_item(self.history_entries_tag, children_only=True)
         # history is stored+appended with time asc, but displayed with time desc
@@ -270,6 +319,9 @@ class WindowAinbGraph:
 
             save_ainb = lambda: self.ectx.save_ainb(self.ainb)
             dpg.add_tab_button(label="Save to modfs", callback=save_ainb)
+            dpg.add_tab_button(label="Undo", callback=self.undo)
+            dpg.add_tab_button(label="Redo", callback=self.redo)
+            dpg.add_tab_button(label="Discard unsaved edits", callback=self.discard_unsaved)
 
 
 class AinbGraphEditor:
@@ -286,7 +338,7 @@ class AinbGraphEditor:
     async def set_ainb(self, ainb: MutableAinb) -> None:
         self.ainb = ainb
         # TODO clear contents?
-        self.layout = AinbGraphLayout.try_get_cached_layout(self.ainb.location)
+        self.layout = AinbGraphLayout.try_get_cached_layout(self.ainb)
         await self.render_contents()
 
     @property
@@ -302,9 +354,10 @@ class AinbGraphEditor:
             max_size=(1024, 768),
             popup=True,  # XXX neither autosize nor no_resize seem to do anything here?
         ):
-            # Get usages to present to user
+            # Get usages to present to user, cached per category after the first popup
             file_cat = self.ainb.json["Info"]["File Category"]
-            node_usages = db.AinbFileNodeUsageIndex.get_node_types(db.Connection.get(), file_cat)
+            node_catalog = get_node_catalog(file_cat)
+            userdefined_usages = get_userdefined_catalog(file_cat)
 
             # Set up filtering
             filter_ns = f"{self._add_node_tag}/Filter"
@@ -314,7 +367,15 @@ class AinbGraphEditor:
                 dpg.set_value(f"{filter_ns}/builtin", filter_string)
                 dpg.set_value(f"{filter_ns}/userdefined", filter_string)
                 dpg.set_value(f"{filter_ns}/module", filter_string)
-            dpg.add_input_text(tag=input_tag, hint="Node Type...", callback=set_filters)
+
+            variant_groups: List[DpgTag] = []
+            def show_variants(sender, is_shown, _user_data):
+                for group in variant_groups:
+                    dpg.configure_item(group, show=is_shown)
+
+            with dpg.group(horizontal=True):
+                dpg.add_input_text(tag=input_tag, hint="Node Type...", callback=set_filters, width=-260)
+                dpg.add_checkbox(label="Show all signature variants", callback=show_variants)
 
             # Output containers for filtered node types
             with dpg.child_window(horizontal_scrollbar=True):
@@ -335,7 +396,21 @@ class AinbGraphEditor:
 
             def on_submit_node(sender, data, user_data):
                 dpg.delete_item(self._add_node_tag)
-                (node_type, param_details_json) = user_data
+                node_type: str = user_data[0]
+                signature: db.NodeSignature = user_data[1]
+                with db.Connection.reader() as conn:
+                    param_details_json = db.AinbNodeSignatureParam.get_param_details_json(conn, signature.signature_id)
+
+                # Userdefined slots get their most common class+value, rather than whatever the most common signature had.
+                # Picking a specific variant means you wanted exactly that though.
+                if signature.is_most_common:
+                    catalog = db.AinbUserDefinedParamCatalog.most_common_by_slot(userdefined_usages.get(node_type, []))
+                    for (section, i_of_type), usage in catalog.items():
+                        params = param_details_json.get(section, {}).get("userdefined", [])
+                        if i_of_type < len(params):
+                            params[i_of_type]["Class"] = usage.class_name
+                            if section == ParamSectionName.INPUT and usage.default_value is not None:
+                                params[i_of_type]["Value"] = usage.default_value
 
                 # XXX how much of this even belongs in here?
                 # FIXME add ainb-level header for this module
@@ -365,7 +440,7 @@ class AinbGraphEditor:
                 return CallbackReq.AwaitCoro(self.render_contents)
 
             # Populate containers with all possible results
-            for (node_type, param_details_json) in node_usages:
+            for node_type, signatures in node_catalog.items():
                 if node_type.startswith("Element_"):  # builtins
                     parent = f"{filter_ns}/builtin"
                 elif node_type.endswith(".module"):  # modules / external ainb
@@ -373,27 +448,53 @@ class AinbGraphEditor:
                 else:  # userdefined
                     parent = f"{filter_ns}/userdefined"
 
-                with dpg.group(horizontal=True, parent=parent, filter_key=node_type):
-                    # color = AppStyleColors.GRAPH_MODULE_HUE.set_hsv(s=0.2, v=1.0)
-                    # type_color_kw["color"] = color.to_rgb24()
-                    # dpg.add_text(node_type, **type_color_kw)
-                    dpg.add_button(label=node_type, user_data=(node_type, param_details_json), callback=on_submit_node)
-
-                    with dpg.group(horizontal=False):
-                        if False: #comment := "hola pendejo":
-                            dpg.add_text(f"// {comment}", color=AppStyleColors.INLINE_COMMENT_TEXT.to_rgb24())
-                        else:
-                            dpg.add_text("")
-                        for section, typed_params in param_details_json.items():
-                            param_names = ", ".join([
-                                f"{param_type}: [{', '.join([p['Name'] for p in param_list])}]"
-                                for (param_type, param_list) in typed_params.items()
-                            ])
-                            dpg.add_text(f"{ParamSectionLegend[section]} {param_names}", color=AppStyleColors.NEW_NODE_PICKER_PARAM_DETAILS.to_rgb24())
+                # Userdefined classes are searchable too, eg find every node taking some game::ai:: type
+                node_userdefineds = userdefined_usages.get(node_type, [])
+                class_names = {u.class_name for u in node_userdefineds}
+                filter_key = " ".join([node_type, *sorted(class_names)])
+
+                for signature in signatures:
+                    with dpg.group(horizontal=True, parent=parent, filter_key=filter_key, show=signature.is_most_common) as group:
+                        # color = AppStyleColors.GRAPH_MODULE_HUE.set_hsv(s=0.2, v=1.0)
+                        # type_color_kw["color"] = color.to_rgb24()
+                        # dpg.add_text(node_type, **type_color_kw)
+                        label = node_type if signature.is_most_common else f"{node_type} (variant, used {signature.usage_count}x)"
+                        dpg.add_button(label=label, user_data=(node_type, signature), callback=on_submit_node)
+
+                        with dpg.group(horizontal=False):
+                            if False: #comment := "hola pendejo":
+                                dpg.add_text(f"// {comment}", color=AppStyleColors.INLINE_COMMENT_TEXT.to_rgb24())
+                            else:
+                                dpg.add_text("")
+                            self.render_signature_params(signature, node_userdefineds)
+                    if not signature.is_most_common:
+                        variant_groups.append(group)
 
         dpg.focus_item(input_tag)  # XXX inconsistent bullshit, this just uhh stopped working again :(
 
+    @staticmethod
+    def render_signature_params(signature: db.NodeSignature, node_userdefineds: List[db.UserDefinedParamUsage]):
+        color = AppStyleColors.NEW_NODE_PICKER_PARAM_DETAILS.to_rgb24()
+        for section, section_params in itertools.groupby(signature.params, key=lambda p: p.param_section):
+            by_type = [(param_type, list(params)) for param_type, params in itertools.groupby(section_params, key=lambda p: p.param_type)]
+            param_names = ", ".join([
+                f"{param_type}: [{', '.join([p.name if p.class_name is None else f'{p.name}<{p.class_name}>' for p in params])}]"
+                for (param_type, params) in by_type
+                # The most common signature shows userdefineds from the catalog instead, with every class seen
+                if not (signature.is_most_common and param_type == "userdefined")
+            ])
+            if param_names:
+                dpg.add_text(f"{ParamSectionLegend[section]} {param_names}", color=color)
+
+        if not signature.is_most_common:
+            return
+        for (section, i_of_type), usage in db.AinbUserDefinedParamCatalog.most_common_by_slot(node_userdefineds).items():
+            variant_n = sum(1 for u in node_userdefineds if (u.param_section, u.i_of_type) == (section, i_of_type))
+            variants = f" (+{variant_n - 1} variants)" if variant_n > 1 else ""
+            dpg.add_text(f"{ParamSectionLegend[section]} userdefined: {usage.param_name}<{usage.class_name}> x{usage.usage_count}{variants}", color=color)
+
     async def render_contents(self, dpg_args=None):
+        self.rendered_revision = self.ainb.revision
         # sludge for now
         def _link_callback(sender, app_data):
             dpg.add_node_link(app_data[0], app_data[1], parent=sender)
@@ -437,24 +538,79 @@ class AinbGraphEditor:
         await self.apply_layout()
 
 
+    def get_stale_scope(self) -> Optional[Set[int]]:
+        # -> node indexes (GLOBALS_NODE_I for globals) edited since the last render, None if only a full render will do
+        is_structure_changed, node_indexes, sections = self.ainb.get_changes_since(self.rendered_revision)
+        if is_structure_changed or sections - {ParamSectionName.GLOBAL}:
+            return None
+        node_count = len(self.ainb.json.get("Nodes", []))
+        scope = {node_i for node_i in node_indexes if node_i < node_count}
+        if ParamSectionName.GLOBAL in sections:
+            scope.add(app_precompute.GLOBALS_NODE_I)
+        return scope
+
+    def rerender_nodes(self, node_indexes: Set[int]) -> None:
+        # Replace just these dpg nodes where they currently are, then redo any links touching them.
+        # Deleting a dpg node takes its links along.
+        positions = {}
+        for node_i in node_indexes:
+            node_tag = self.get_node_tag(node_i)
+            if dpg.does_item_exist(node_tag):
+                positions[node_i] = dpg.get_item_pos(node_tag)
+                dpg.delete_item(node_tag)
+
+        gnodes: Dict[int, AinbGraphEditorNode] = {}
+        for n in self.ainb.nodes:
+            node_i = n.json["Node Index"]
+            links_here = {link.get("Node Index") for links in n.json.get("Linked Nodes", {}).values() for link in links}
+            links_here |= {
+                src.get("Node Index") for params in n.json.get(ParamSectionName.INPUT, {}).values() for p in params for src in p.get("Sources", [])
+            }
+            if node_i in node_indexes or links_here & node_indexes:
+                gnodes[node_i] = AinbGraphEditorNode(editor=self, node=n)
+
+        if app_precompute.GLOBALS_NODE_I in node_indexes and self.ainb.global_params:
+            AinbGraphEditorGlobalsNode(editor=self).render()
+        for node_i in node_indexes:
+            if gnode := gnodes.get(node_i):
+                gnode.render()
+        for node_i, pos in positions.items():
+            if dpg.does_item_exist(self.get_node_tag(node_i)):
+                dpg.set_item_pos(self.get_node_tag(node_i), pos)
+
+        for gnode in gnodes.values():
+            for link in gnode.all_links:
+                for lc in link.get_link_calls():
+                    if lc.src_node_i in node_indexes or lc.dst_node_i in node_indexes:
+                        dpg.add_node_link(lc.src_attr, lc.dst_attr, parent=lc.parent)
+        self.rendered_revision = self.ainb.revision
+
+    def get_node_tag(self, node_i: int) -> DpgTag:
+        if node_i == app_precompute.GLOBALS_NODE_I:
+            return f"{self.tag}/Globals/Node"
+        return f"{self.tag}/node{node_i}/Node"
+
     async def apply_layout(self):
+        if self.layout.is_estimated:
+            # Precomputed layouts show up right away, finalize then redoes them with the real node sizes
+            self.pan_to_start()
         await self.layout.finalize()
+        self.pan_to_start()
 
+    def pan_to_start(self) -> None:
         # Pan to some node
         if cmds := self.ainb.commands:
-            pan_node_i = cmds[0].json["Left Node Index"]
-            self.layout.global_translate_to_node(pan_node_i)
+            self.pan_to_node(cmds[0].json["Left Node Index"])
         elif self.ainb.nodes:
-            self.layout.global_translate_to_node(0)
+            self.pan_to_node(0)
 
+    def pan_to_node(self, node_i: int) -> None:
+        if node_i not in self.layout.get_node_indexes_with_layout():
+            return
+        self.layout.global_translate_to_node(node_i)
         for node_i in self.layout.get_node_indexes_with_layout():
             pos = self.layout.get_node_coordinates(node_i)
-            if node_i == -420:
-                node_tag = f"{self.tag}/Globals/Node"
-            else:
-                node_tag = f"{self.tag}/node{node_i}/Node"
-            # print(node_tag, pos)
-            dpg.set_item_pos(node_tag, pos)
+            dpg.set_item_pos(self.get_node_tag(node_i), pos)
 
 
 class AinbGraphEditorGlobalsNode:
@@ -565,8 +721,8 @@ class AinbGraphEditorParam:
 
         def on_edit(sender, data, op_selector):
             # XXX ideally plumb in ectx, or send this up through the editor?
-            edit_op = AinbEditOperation(op_type=AinbEditOperationTypes.PARAM_UPDATE_DEFAULT, op_value=data, op_selector=op_selector)
-            EditContext.get().perform_new_ainb_edit_operation(self.editor.ainb, edit_op)
+            # Drags fire every tick, ectx performs just the latest value per frame
+            EditContext.get().coalesce_ainb_param_edit(self.editor.ainb, op_selector, data)
 
         node_attr_tag_ns = f"{self.node_tag}/Params/{param.param_section_name}/{param.name}"
         ui_input_tag = f"{node_attr_tag_ns}/ui_input"
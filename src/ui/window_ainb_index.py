@@ -1,10 +1,10 @@
-import os
 import pathlib
 from typing import *
 
 from .. import curio
 import dearpygui.dearpygui as dpg
 
+from .. import db
 from .. import pack_util
 from ..app_types import *
 from ..app_ainb_cache import get_pack_index_by_extension
@@ -12,6 +12,19 @@ from ..edit_context import EditContext
 
 
 class WindowAinbIndex:
+    LIMIT_FILTER_RESULTS = 500
+    LIMIT_FILE_INFO_ROWS = 500
+    FILE_INFO_COLUMNS = (
+        # label, sql column
+        ("File", "fullfile"),
+        ("Category", "file_category"),
+        ("Nodes", "node_count"),
+        ("Cmds", "command_count"),
+        ("Globals", "global_count"),
+        ("Embeds", "embedded_count"),
+        ("Bytes", "byte_size"),
+    )
+
     @classmethod
     async def create_as_coro(cls, parent: DpgTag) -> None:
         window = cls()
@@ -25,6 +38,13 @@ class WindowAinbIndex:
         self.render_contents()
         return self.tag
 
+    @staticmethod
+    def item_label(location: PackIndexEntry) -> str:
+        # Badge files overridden by modfs, the resolver answers this without touching the filesystem
+        if EditContext.get().is_overridden_by_modfs(location):
+            return f"{location.internalfile} [modfs]"
+        return location.internalfile
+
     def render_contents(self):
         # Opening ainb windows
         with dpg.item_handler_registry(tag="ainb_index_window_handler") as open_ainb_handler:
@@ -51,26 +71,22 @@ class WindowAinbIndex:
 
             dpg.add_item_clicked_handler(callback=callback_open_asb)
 
-        # Quick search
-        actor_pack_n = -1
-        def callback_filter(sender, filter_string):
-            if len(filter_string) < 3:
-                # Exclude slowest chars for perf, although short substrings can still be invoked after commas.
-                # We have no control over how search is performed, eg no way to use a db without reimplementing filtering.
-                filter_string = ""
-            dpg.set_value(f"{self.tag}/ASB/Root/Filter", filter_string)
-            dpg.set_value(f"{self.tag}/AINB/Root/Filter", filter_string)
-            dpg.set_value(f"{self.tag}/AINB/Global/Filter", filter_string)
-            dpg.set_value(f"{self.tag}/AINB/PackActor/Filter", filter_string)
-            for i in range(actor_pack_n):
-                dpg.set_value(f"{self.tag}/AINB/PackActor/{i}/Filter", filter_string)
+        # Filling trees on first expand
+        with dpg.item_handler_registry(tag="lazy_tree_index_window_handler") as self.lazy_tree_handler:
+            dpg.add_item_toggled_open_handler(callback=self.callback_populate_tree)
+
+        # Quick search: matches come from the db and only those get rendered, the trees are just hidden meanwhile
         # filter eg `-ai/, -logic/, localmodule, load`: any positive terms pass (union), matching all (intersection) not needed
-        filter_input = dpg.add_input_text(hint="any1, any2, -exclude (min 3 chars)", callback=callback_filter, parent=self.tag)
+        filter_input = dpg.add_input_text(hint="any1, any2, -exclude", callback=self.callback_filter, parent=self.tag)
+        with dpg.child_window(tag=f"{self.tag}/FilterResults", autosize_x=True, autosize_y=True, show=False, parent=self.tag):
+            dpg.add_text("", tag=f"{self.tag}/FilterResults/Status")
+            dpg.add_table(tag=f"{self.tag}/FilterResults/Table", header_row=False, clipper=True, scrollY=True)
+            dpg.add_table_column(parent=f"{self.tag}/FilterResults/Table")
 
 
         ainb_cache = get_pack_index_by_extension(RomfsFileTypes.AINB)
         asb_cache = get_pack_index_by_extension(RomfsFileTypes.ASB)
-        with dpg.tab_bar(parent=self.tag):
+        with dpg.tab_bar(tag=f"{self.tag}/Tabs", parent=self.tag, callback=self.callback_tab_change):
             # dpg.add_tab_button(label="[max]", callback=dpg.maximize_viewport)  # works at runtime, fails at init?
             # dpg.add_tab_button(label="wipe cache")
             # dpg.add_tab_button(label="new ainb file")
@@ -82,20 +98,18 @@ class WindowAinbIndex:
                 with dpg.child_window(autosize_x=True, autosize_y=True):
                     # TODO context menu -> re-crawl pack or ainb
                     with dpg.tree_node(label="Root", default_open=True):
-                        with dpg.filter_set(tag=f"{self.tag}/AINB/Root/Filter"):
-                            cached_ainb_locations = ainb_cache.get("Root", {})
-                            for ainbfile, ainb_location in cached_ainb_locations.items():
-                                item = dpg.add_text(ainb_location.internalfile, user_data=ainb_location, parent=f"{self.tag}/AINB/Root/Filter", filter_key=ainb_location.internalfile)
-                                dpg.bind_item_handler_registry(item, open_ainb_handler)
+                        cached_ainb_locations = ainb_cache.get("Root", {})
+                        for ainbfile, ainb_location in cached_ainb_locations.items():
+                            item = dpg.add_text(self.item_label(ainb_location), user_data=ainb_location)
+                            dpg.bind_item_handler_registry(item, open_ainb_handler)
 
 
                     global_packfile = TitleVersion.get().ai_global_pack
                     with dpg.tree_node(label=global_packfile, default_open=True):
-                        with dpg.filter_set(tag=f"{self.tag}/AINB/Global/Filter"):
-                            cached_ainb_locations = ainb_cache.get(global_packfile, {})
-                            for ainbfile, ainb_location in cached_ainb_locations.items():
-                                item = dpg.add_text(ainb_location.internalfile, user_data=ainb_location, parent=f"{self.tag}/AINB/Global/Filter", filter_key=ainb_location.internalfile)
-                                dpg.bind_item_handler_registry(item, open_ainb_handler)
+                        cached_ainb_locations = ainb_cache.get(global_packfile, {})
+                        for ainbfile, ainb_location in cached_ainb_locations.items():
+                            item = dpg.add_text(self.item_label(ainb_location), user_data=ainb_location)
+                            dpg.bind_item_handler_registry(item, open_ainb_handler)
 
 
                     dpg.add_separator()
@@ -105,38 +119,135 @@ class WindowAinbIndex:
                     dpg.add_separator()
                     dpg.add_separator()
 
-                    romfs = dpg.get_value(AppConfigKeys.ROMFS_PATH)
-                    with dpg.filter_set(tag=f"{self.tag}/AINB/PackActor/Filter"):
-                        for packfile in sorted(pathlib.Path(f"{romfs}/Pack/Actor").rglob("*.pack.zs")):
-                            # XXX why so paranoid about only showing existing packs? can't we just loop through cache excluding global+root?
-                            romfs_relative: str = os.path.join(*packfile.parts[-3:])
-                            romfs_relative = PackIndexEntry.fix_backslashes(romfs_relative)
-                            cached_ainb_locations = ainb_cache.get(romfs_relative, {})
-                            ainbcount = len(cached_ainb_locations)
-                            if ainbcount == 0:
-                                continue
-
-                            packname = pathlib.Path(romfs_relative).name.rsplit(".pack.zs", 1)[0]
-                            label = f"{packname} [{ainbcount}]"
-
-                            # Glob-like formatting, but just a literal search key: a.pack.zs:{one,two}
-                            # This way we can show/hide the pack item itself based on all filenames within.
-                            # Root+Global packs make sense to always display, so we don't do this for those
-                            filter_val = ",".join([al.internalfile for al in cached_ainb_locations.values()])
-                            filter_val = f"{packfile}:{{{filter_val}}}"
-                            actor_pack_n += 1
-                            with dpg.tree_node(label=label, default_open=(ainbcount <= 4), filter_key=filter_val):
-                                with dpg.filter_set(tag=f"{self.tag}/AINB/PackActor/{actor_pack_n}/Filter"):
-                                    for ainbfile, ainb_location in cached_ainb_locations.items():
-                                        item = dpg.add_text(ainb_location.internalfile, user_data=ainb_location, bullet=True, filter_key=ainb_location.fullfile)
-                                        dpg.bind_item_handler_registry(item, open_ainb_handler)
+                    # Every pack the crawl saw is in pack_index, no need to walk romfs again
+                    for packfile in sorted(pf for pf in ainb_cache.keys() if pf.startswith("Pack/Actor/")):
+                        cached_ainb_locations = ainb_cache[packfile]
+                        ainbcount = len(cached_ainb_locations)
+                        if ainbcount == 0:
+                            continue
+
+                        packname = pathlib.Path(packfile).name.rsplit(".pack.zs", 1)[0]
+                        self.add_lazy_tree_node(f"{packname} [{ainbcount}]", cached_ainb_locations, open_ainb_handler, bullet=True)
 
 
             with dpg.tab(label="All ASBs"):
                 with dpg.child_window(autosize_x=True, autosize_y=True):
-                    with dpg.tree_node(label="Root", default_open=True):
-                        with dpg.filter_set(tag=f"{self.tag}/ASB/Root/Filter"):
-                            cached_asb_locations = asb_cache.get("Root", {})
-                            for asbfile, asb_location in cached_asb_locations.items():
-                                item = dpg.add_text(asb_location.internalfile, user_data=asb_location, parent=f"{self.tag}/ASB/Root/Filter", filter_key=asb_location.internalfile)
-                                dpg.bind_item_handler_registry(item, open_asb_handler)
+                    cached_asb_locations = asb_cache.get("Root", {})
+                    self.add_lazy_tree_node(f"Root [{len(cached_asb_locations)}]", cached_asb_locations, open_asb_handler)
+
+            with dpg.tab(label="File Info", tag=f"{self.tag}/FileInfo"):
+                self.render_file_info_tab()
+
+    def add_lazy_tree_node(self, label: str, locations: Dict[str, PackIndexEntry], open_handler: DpgTag, bullet: bool = False) -> DpgTag:
+        # Starts collapsed+empty, children are created by callback_populate_tree
+        tree = dpg.add_tree_node(label=label, default_open=False, user_data=(locations, open_handler, bullet))
+        dpg.bind_item_handler_registry(tree, self.lazy_tree_handler)
+        return tree
+
+    def callback_populate_tree(self, sender, tree: DpgTag):
+        # Fires on collapse too, only the first expand has any work
+        if dpg.get_item_children(tree, 1):
+            return
+        locations, open_handler, bullet = dpg.get_item_user_data(tree)
+        for location in locations.values():
+            item = dpg.add_text(self.item_label(location), user_data=location, bullet=bullet, parent=tree)
+            dpg.bind_item_handler_registry(item, open_handler)
+
+    def callback_filter(self, sender, filter_string):
+        results_tag = f"{self.tag}/FilterResults"
+        if not filter_string.strip():
+            dpg.hide_item(results_tag)
+            dpg.show_item(f"{self.tag}/Tabs")
+            return
+
+        with db.Connection.reader() as conn:
+            locations = db.FilePathIndex.filter(conn, filter_string, limit=self.LIMIT_FILTER_RESULTS + 1)
+        is_truncated = len(locations) > self.LIMIT_FILTER_RESULTS
+        locations = locations[:self.LIMIT_FILTER_RESULTS]
+
+        # Rows only, slot 0 holds the column
+        dpg.delete_item(f"{results_tag}/Table", children_only=True, slot=1)
+        for location in locations:
+            with dpg.table_row(parent=f"{results_tag}/Table"):
+                label = self.item_label(location)
+                if location.packfile != "Root":
+                    packname = pathlib.Path(location.packfile).name.rsplit(".pack.zs", 1)[0]
+                    label = f"{label} [{packname}]"
+                dpg.add_selectable(label=label, callback=self.callback_open_filtered, user_data=location)
+        more = f" (showing first {self.LIMIT_FILTER_RESULTS})" if is_truncated else ""
+        dpg.set_value(f"{results_tag}/Status", f"{len(locations)} matches{more}")
+
+        dpg.hide_item(f"{self.tag}/Tabs")
+        dpg.show_item(results_tag)
+
+    def callback_open_filtered(self, sender, _data, location: PackIndexEntry):
+        dpg.set_value(sender, False)  # Don't leave rows selected
+        ectx = EditContext.get()
+        if location.extension == RomfsFileTypes.ASB:
+            return CallbackReq.SpawnCoro(ectx.open_asb_window_as_coro, [location])
+        return CallbackReq.SpawnCoro(ectx.open_ainb_window_as_coro, [location])
+
+    def callback_tab_change(self, sender, tab: DpgTag):
+        # File info rows are only queried once someone looks at them
+        if dpg.get_item_alias(tab) == f"{self.tag}/FileInfo" and not dpg.get_item_children(f"{self.tag}/FileInfo/Table", 1):
+            self.refresh_file_info()
+
+    def render_file_info_tab(self):
+        self.file_info_sort: Tuple[str, bool] = ("fullfile", False)
+        with db.Connection.reader() as conn:
+            categories = db.AinbFileInfoIndex.get_file_categories(conn)
+        with dpg.group(horizontal=True):
+            dpg.add_combo(["(all)"] + categories, default_value="(all)", tag=f"{self.tag}/FileInfo/Category", width=100, callback=self.refresh_file_info)
+            dpg.add_input_text(tag=f"{self.tag}/FileInfo/Global", hint="has global param (exact)", width=-1, on_enter=True, callback=self.refresh_file_info)
+        dpg.add_text("", tag=f"{self.tag}/FileInfo/Status")
+        with dpg.table(
+            tag=f"{self.tag}/FileInfo/Table",
+            sortable=True,
+            callback=self.callback_sort_file_info,
+            clipper=True,
+            scrollX=True,
+            scrollY=True,
+            resizable=True,
+            policy=dpg.mvTable_SizingFixedFit,
+        ):
+            for label, column in self.FILE_INFO_COLUMNS:
+                dpg.add_table_column(label=label, user_data=column, prefer_sort_descending=(column not in ("fullfile", "file_category")))
+
+    def callback_sort_file_info(self, sender, sort_specs):
+        if not sort_specs:
+            return
+        column_tag, direction = sort_specs[0]
+        self.file_info_sort = (dpg.get_item_user_data(column_tag), direction < 0)
+        self.refresh_file_info()
+
+    def refresh_file_info(self, *_):
+        category = dpg.get_value(f"{self.tag}/FileInfo/Category")
+        global_name = dpg.get_value(f"{self.tag}/FileInfo/Global").strip()
+        order_by, descending = self.file_info_sort
+        with db.Connection.reader() as conn:
+            rows = db.AinbFileInfoIndex.query(
+                conn,
+                order_by=order_by,
+                descending=descending,
+                file_category=None if category == "(all)" else category,
+                global_name=global_name or None,
+                limit=self.LIMIT_FILE_INFO_ROWS,
+            )
+
+        table = f"{self.tag}/FileInfo/Table"
+        dpg.delete_item(table, children_only=True, slot=1)
+        for packfile, internalfile, file_category, node_count, command_count, command_names_csv, global_count, embedded_count, byte_size in rows:
+            location = PackIndexEntry(internalfile=internalfile, packfile=packfile, extension=RomfsFileTypes.AINB)
+            with dpg.table_row(parent=table):
+                label = internalfile if packfile == "Root" else location.fullfile
+                dpg.add_selectable(label=label, span_columns=True, callback=self.callback_open_filtered, user_data=location)
+                dpg.add_text(file_category)
+                dpg.add_text(str(node_count))
+                cmds = dpg.add_text(str(command_count))
+                with dpg.tooltip(cmds):
+                    dpg.add_text(command_names_csv.replace(",", "\n") or "(no commands)")
+                dpg.add_text(str(global_count))
+                dpg.add_text(str(embedded_count))
+                dpg.add_text(str(byte_size))
+        more = f" (first {self.LIMIT_FILE_INFO_ROWS})" if len(rows) >= self.LIMIT_FILE_INFO_ROWS else ""
+        dpg.set_value(f"{self.tag}/FileInfo/Status", f"{len(rows)} files{more}")
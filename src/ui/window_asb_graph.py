@@ -10,9 +10,9 @@ import orjson
 from ..app_ainb_cache import scoped_pack_lookup
 from ..edit_context import EditContext
 from ..mutable_asb import MutableAsb, MutableAsbNodeParam, MutableAsbTransition
-from .. import db, pack_util
+from .. import db, jsondiff, pack_util
 from ..app_types import *
-from .util import make_node_theme_for_hue, prettydate
+from .util import dump_json_indent4, make_node_theme_for_hue, prettydate
 
 
 class WindowAsbGraph:
@@ -20,6 +20,7 @@ class WindowAsbGraph:
         print(f"Opening {asb_location.fullfile}")
         self.ectx = ectx
         self.asb = self.ectx.load_asb(asb_location)
+        self.json_textbox_revision: Optional[int] = None
 
     @property
     def history_entries_tag(self) -> DpgTag:
@@ -46,6 +47,9 @@ class WindowAsbGraph:
         else:
             window_label = f"[{_AS}] {asbfile} [from {self.asb.location.packfile}]"
 
+        if self.ectx.is_overridden_by_modfs(self.asb.location):
+            window_label = f"{window_label} [modfs]"
+
         self.tag = dpg.add_window(
             label=window_label,
             on_close=lambda: self.ectx.close_file_window(self.asb.location),
@@ -55,29 +59,49 @@ class WindowAsbGraph:
         return self.tag
 
     async def redump_json_textbox(self):
-        # Replace json textbox with working asb (possibly dirty)
-        asb_json_str = orjson.dumps(self.asb.json, option=orjson.OPT_INDENT_2)
-        # yep. this lib only supports 2 spaces, but fast + keeps unicode strings unescaped
-        if True: # if dpg.get_value(AppConfigKeys.INDENT_4):
-            asb_json_str = '\n'.join([
-                ' '*(((len(line) - len(line.lstrip(' '))) // 2) * 4) + line.lstrip(' ')
-                for line in asb_json_str.decode("utf8").split('\n')
-            ])
-        dpg.set_value(self.json_textbox, asb_json_str)
+        # Replace json textbox with working asb (possibly dirty), only when it was edited since the last dump.
+        # Unapplied changes in the textbox survive tab switches until then.
+        if self.json_textbox_revision == self.asb.revision:
+            return
+        dpg.set_value(self.json_textbox, dump_json_indent4(self.asb.json))
+        self.json_textbox_revision = self.asb.revision
 
     def rerender_graph_from_json(self):
         user_json_str = dpg.get_value(self.json_textbox)
 
+        # Only the difference is applied and stored, a one character edit stays a one entry patch
+        patch = jsondiff.diff(self.asb.json, orjson.loads(user_json_str))
+        if not patch:
+            return
+
         # Send event to edit ctx
-        edit_op = AsbEditOperation(op_type=AsbEditOperationTypes.REPLACE_JSON, op_value=user_json_str)
+        edit_op = AsbEditOperation(op_type=AsbEditOperationTypes.JSON_PATCH, op_value=patch)
         self.ectx.perform_new_asb_edit_operation(self.asb, edit_op)
+        return self.rerender_graph()
 
+    def rerender_graph(self):
         # Re-render editor TODO this belongs in AsbGraphEditor?
         dpg.delete_item(self.node_editor)
         dpg.delete_item(f"{self.node_editor}/toolbar")
 
         return CallbackReq.AwaitCoro(self.editor.render_contents)
 
+    def undo(self):
+        if self.ectx.undo_asb(self.asb):
+            return self.rerender_graph()
+
+    def redo(self):
+        if self.ectx.redo_asb(self.asb):
+            return self.rerender_graph()
+
+    def discard_unsaved(self):
+        # Back to the file as last saved, by reopening the window so it loads without the discarded edits
+        location = self.asb.location
+        self.ectx.discard_unsaved_edits(location)
+        dpg.delete_item(self.tag)
+        self.ectx.close_file_window(location)
+        return CallbackReq.SpawnCoro(self.ectx.open_asb_window_as_coro, [location])
+
     async def rerender_history(self):
         dpg.delete_item(self.history_entries_tag, children_only=True)
         # history is stored+appended with time asc, but displayed with time desc
@@ -125,6 +149,9 @@ class WindowAsbGraph:
 
             save_asb = lambda: self.ectx.save_asb(self.asb)
             dpg.add_tab_button(label="Save to modfs", callback=save_asb)
+            dpg.add_tab_button(label="Undo", callback=self.undo)
+            dpg.add_tab_button(label="Redo", callback=self.redo)
+            dpg.add_tab_button(label="Discard unsaved edits", callback=self.discard_unsaved)
 
 
 class AsbGraphEditor:
@@ -433,8 +460,8 @@ class AsbGraphEditorRenderHelpers:
 
         def on_edit(sender, data, op_selector):
             # XXX ideally plumb in ectx, or send this up through the editor?
-            edit_op = AsbEditOperation(op_type=AsbEditOperationTypes.PARAM_UPDATE_DEFAULT, op_value=data, op_selector=op_selector)
-            EditContext.get().perform_new_asb_edit_operation(node.editor.asb, edit_op)
+            # Drags fire every tick, ectx performs just the latest value per frame
+            EditContext.get().coalesce_asb_param_edit(node.editor.asb, op_selector, data)
 
         node_attr_tag_ns = f"{node.tag}/Params/{param.param_section_name}/{param.name}"
         ui_input_tag = f"{node_attr_tag_ns}/ui_input"
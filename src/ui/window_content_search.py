@@ -0,0 +1,89 @@
+import time
+from typing import *
+
+import dearpygui.dearpygui as dpg
+from .. import curio
+
+from ..app_types import *
+from .. import db
+from ..edit_context import EditContext
+
+
+class WindowContentSearch:
+    LIMIT_HITS = 200
+
+    @classmethod
+    async def create_as_coro(cls, dpg_args=()) -> None:
+        window = cls()
+        window.create()
+        while True:
+            # we own+supervise this instance and its ui
+            await curio.sleep(69)
+
+    def create(self) -> DpgTag:
+        with dpg.window(label="Search File Contents", width=900, height=700, pos=[500, 150]) as dpg_window:
+            self.tag = dpg_window
+            dpg.add_input_text(
+                tag=f"{self.tag}/input",
+                hint="node names/types, param names, string values, commands, blackboard (all terms, prefix match)",
+                callback=self.on_query,
+                width=-1,
+            )
+            dpg.add_text("", tag=f"{self.tag}/status")
+            with dpg.table(
+                tag=f"{self.tag}/results",
+                header_row=True,
+                resizable=True,
+                borders_innerV=True,
+                row_background=True,
+                scrollY=True,
+                clipper=True,
+                policy=dpg.mvTable_SizingStretchProp,
+            ):
+                dpg.add_table_column(label="File", init_width_or_weight=3)
+                dpg.add_table_column(label="Node", init_width_or_weight=0.5)
+                dpg.add_table_column(label="Kind", init_width_or_weight=0.7)
+                dpg.add_table_column(label="Match", init_width_or_weight=4)
+            dpg.focus_item(f"{self.tag}/input")
+        return dpg_window
+
+    def on_query(self, sender, query: str):
+        if len(query.strip()) < 2:
+            dpg.set_value(f"{self.tag}/status", "")
+            dpg.delete_item(f"{self.tag}/results", children_only=True, slot=1)
+            return
+
+        t0 = time.perf_counter()
+        err = None
+        with db.Connection.reader() as conn:
+            try:
+                hits = db.ContentSearchIndex.search(conn, query, limit=self.LIMIT_HITS)
+            except Exception as e:
+                hits, err = [], e
+        elapsed_ms = (time.perf_counter() - t0) * 1000
+
+        if err:
+            dpg.set_value(f"{self.tag}/status", str(err))
+        else:
+            more = "+" if len(hits) >= self.LIMIT_HITS else ""
+            dpg.set_value(f"{self.tag}/status", f"{len(hits)}{more} hits in {elapsed_ms:.1f}ms")
+        self.render_hits(hits)
+
+    def render_hits(self, hits: List[db.ContentSearchHit]):
+        # slot 1 holds the rows, slot 0 the columns
+        dpg.delete_item(f"{self.tag}/results", children_only=True, slot=1)
+        for fullfile, node_i, kind, snippet in hits:
+            location = PackIndexEntry.from_fullfile(fullfile)
+            with dpg.table_row(parent=f"{self.tag}/results"):
+                dpg.add_selectable(label=fullfile, span_columns=True, callback=self.on_open_hit, user_data=(location, node_i))
+                dpg.add_text("" if node_i is None else str(node_i))
+                dpg.add_text(kind)
+                dpg.add_text(snippet)
+
+    def on_open_hit(self, sender, _data, user_data):
+        dpg.set_value(sender, False)  # Don't leave rows selected
+        location, node_i = user_data
+        ectx = EditContext.get()
+        if location.extension == RomfsFileTypes.AINB:
+            return CallbackReq.SpawnCoro(ectx.open_ainb_window_as_coro, [location, node_i])
+        return CallbackReq.SpawnCoro(ectx.open_asb_window_as_coro, [location])
@@ -1,5 +1,7 @@
+import sqlite3
+import time
 from typing import *
-from dataclasses import dataclass
+from dataclasses import dataclass, field
 
 import dearpygui.dearpygui as dpg
 from .. import curio
@@ -11,13 +13,24 @@ from .. import db
 @dataclass
 class QueryHistoryEntry:
     query: str = ""
-    rows: tuple = ()
     tag: str = None
     any_success: bool = False
+    row_count: int = 0
+    # Results are fetched up to the cap in one go so the connection goes straight back, then shown a page at a time
+    pending_rows: List[tuple] = field(default_factory=list)
+    is_capped: bool = False
+    conn: Optional[sqlite3.Connection] = None  # Only while running, for cancelling
+    is_running: bool = False
+    elapsed_ms: float = 0.0
+
+    def release(self) -> None:
+        self.pending_rows = []
 
 
 class WindowSqlShell:
     LIMIT_HISTORY = 20
+    PAGE_SIZE = 200
+    ROW_CAP = 5000  # Per query, rows past this are never fetched
 
     @classmethod
     async def create_as_coro(cls, immediate_query: str = None, dpg_args=()) -> None:
@@ -44,60 +57,165 @@ class WindowSqlShell:
 
     def append_new_query_prompt(self):
         def callback(sender, query, entry):
+            if entry.is_running:
+                return  # Cancel first
             entry.query = query
-            entry_tag = entry.tag
-
-            #is_shift = dpg.is_key_down(0x154) or dpg.is_key_down(0x158)
-            #is_enter = dpg.is_key_pressed(0x101)
-            err = None
-            with db.Connection.get() as conn:
-                try:
-                    entry.rows = [r for r in conn.execute(query)]
-                except Exception as e:
-                    err = e
-
-            if err:
-                entry.rows = []
-                dpg.set_value(f"{entry_tag}/error", str(err))
-                dpg.hide_item(f"{entry_tag}/output")
-                dpg.delete_item(f"{entry_tag}/output", children_only=True)
-                dpg.show_item(f"{entry_tag}/error")
-                dpg.focus_item(f"{entry_tag}/input")
-            else:
-                dpg.hide_item(f"{entry_tag}/error")
-                dpg.delete_item(f"{entry_tag}/output", children_only=True)
-                # display rows to table
-                if len(entry.rows) > 0:
-                    with dpg.table(parent=f"{entry_tag}/output"):
-                        for i in range(len(entry.rows[0])):
-                            dpg.add_table_column()
-                        for row in entry.rows:
-                            with dpg.table_row():
-                                for c in row:
-                                    dpg.add_text(c)
-
-                dpg.show_item(f"{entry_tag}/output")
-                if not entry.any_success:
-                    # add a prompt when a query first succeeds
-                    entry.any_success = True
-                    self.append_new_query_prompt()
-                else:
-                    # keep line focused after edits
-                    dpg.focus_item(f"{entry_tag}/input")
+            return CallbackReq.SpawnCoro(self.run_query_as_coro, [entry])
+
+        def callback_cancel(sender, _data, entry):
+            # Safe from any thread, the worker then fails with "interrupted" and cleans up as usual
+            if entry.is_running and entry.conn is not None:
+                entry.conn.interrupt()
+
+        def callback_more(sender, _data, entry):
+            if not entry.is_running:
+                self.append_page(entry)
 
         with dpg.group(parent=self.output_group) as entry_tag:
             entry = QueryHistoryEntry(tag=entry_tag)
             self.append_history(entry)
             qbox = dpg.add_input_text(tag=f"{entry_tag}/input", hint="select 420", callback=callback, on_enter=True, user_data=entry, width=-1)
             dpg.add_text("", show=False, tag=f"{entry_tag}/error", color=AppStyleColors.ERRTEXT.to_rgba32())
+            with dpg.group(horizontal=True):
+                dpg.add_text("", tag=f"{entry_tag}/status")
+                dpg.add_button(label="Cancel", show=False, tag=f"{entry_tag}/cancel", callback=callback_cancel, user_data=entry)
+                dpg.add_button(label=f"Next {self.PAGE_SIZE}", show=False, tag=f"{entry_tag}/more", callback=callback_more, user_data=entry)
+            dpg.add_text("", show=False, tag=f"{entry_tag}/plan", color=AppStyleColors.INLINE_COMMENT_TEXT.to_rgba32())
             dpg.add_group(show=False, tag=f"{entry_tag}/output")
             dpg.focus_item(qbox)
 
         return qbox
 
+    @staticmethod
+    def explain(conn: sqlite3.Connection, query: str) -> Optional[str]:
+        try:
+            rows = conn.execute(f"EXPLAIN QUERY PLAN {query}").fetchall()
+        except sqlite3.Error:
+            return None  # Not explainable (pragmas etc), or broken anyways and execution will say why
+        depth = {0: 0}
+        lines = []
+        for node_id, parent_id, _, detail in rows:
+            depth[node_id] = depth.get(parent_id, 0) + 1
+            lines.append("  " * depth[node_id] + detail)
+        return "\n".join(lines) if lines else None
+
+    def execute_capped(self, conn: sqlite3.Connection, entry: QueryHistoryEntry) -> Tuple[Optional[str], List[str], List[tuple]]:
+        # Returns (plan, columns, rows up to the cap). Nothing may outlive the connection's checkout:
+        # pooled readers are few and everything else waits on them, and open reads pin the wal.
+        entry.conn = conn
+        try:
+            plan = self.explain(conn, entry.query)
+            cursor = conn.execute(entry.query)
+            columns = [d[0] for d in cursor.description or []]
+            rows = cursor.fetchmany(self.ROW_CAP + 1)
+            cursor.close()
+        finally:
+            entry.conn = None
+        entry.is_capped = len(rows) > self.ROW_CAP
+        return plan, columns, rows[:self.ROW_CAP]
+
+    def execute_on_reader(self, entry: QueryHistoryEntry) -> Tuple[Optional[str], List[str], List[tuple]]:
+        # Runs in a worker thread
+        with db.Connection.reader() as conn:
+            return self.execute_capped(conn, entry)
+
+    def execute_on_writer(self, entry: QueryHistoryEntry) -> Tuple[Optional[str], List[str], List[tuple]]:
+        # Runs in a worker thread. The write lock can't be handed between threads, so everything happens in here
+        with db.Connection.writer() as conn:
+            return self.execute_capped(conn, entry)
+
+    async def run_query_as_coro(self, entry: QueryHistoryEntry, dpg_args=None):
+        entry_tag = entry.tag
+        entry.release()
+        entry.is_running = True
+        entry.is_capped = False
+        entry.row_count = 0
+        dpg.delete_item(f"{entry_tag}/output", children_only=True)
+        dpg.set_value(f"{entry_tag}/status", "Running...")
+        dpg.show_item(f"{entry_tag}/cancel")
+        dpg.hide_item(f"{entry_tag}/more")
+
+        err = None
+        t0 = time.perf_counter()
+        try:
+            try:
+                plan, columns, rows = await curio.run_in_thread(self.execute_on_reader, entry)
+            except sqlite3.OperationalError as e:
+                if "readonly" not in str(e):
+                    raise
+                # Writes go through the one writer connection instead
+                plan, columns, rows = await curio.run_in_thread(self.execute_on_writer, entry)
+        except Exception as e:
+            err = e
+            entry.release()
+        finally:
+            entry.is_running = False
+            entry.elapsed_ms = (time.perf_counter() - t0) * 1000
+            dpg.hide_item(f"{entry_tag}/cancel")
+
+        if err:
+            dpg.set_value(f"{entry_tag}/error", str(err))
+            dpg.set_value(f"{entry_tag}/status", f"Failed after {entry.elapsed_ms:.1f}ms")
+            dpg.hide_item(f"{entry_tag}/output")
+            dpg.hide_item(f"{entry_tag}/plan")
+            dpg.show_item(f"{entry_tag}/error")
+            dpg.focus_item(f"{entry_tag}/input")
+            return
+
+        dpg.hide_item(f"{entry_tag}/error")
+        if plan:
+            dpg.set_value(f"{entry_tag}/plan", plan)
+            dpg.show_item(f"{entry_tag}/plan")
+        else:
+            dpg.hide_item(f"{entry_tag}/plan")
+
+        # display rows to table, clipped so only visible rows cost anything
+        if columns:
+            with dpg.table(
+                tag=f"{entry_tag}/output/table",
+                parent=f"{entry_tag}/output",
+                header_row=True,
+                resizable=True,
+                clipper=True,
+                scrollY=True,
+                scrollX=True,
+                height=300,
+                policy=dpg.mvTable_SizingFixedFit,
+            ):
+                for name in columns:
+                    dpg.add_table_column(label=name)
+        entry.pending_rows = rows
+        self.append_page(entry)
+        dpg.show_item(f"{entry_tag}/output")
+
+        if not entry.any_success:
+            # add a prompt when a query first succeeds
+            entry.any_success = True
+            self.append_new_query_prompt()
+        else:
+            # keep line focused after edits
+            dpg.focus_item(f"{entry_tag}/input")
+
+    def append_page(self, entry: QueryHistoryEntry):
+        rows, entry.pending_rows = entry.pending_rows[:self.PAGE_SIZE], entry.pending_rows[self.PAGE_SIZE:]
+        if rows and dpg.does_item_exist(f"{entry.tag}/output/table"):
+            for row in rows:
+                with dpg.table_row(parent=f"{entry.tag}/output/table"):
+                    for c in row:
+                        dpg.add_text("NULL" if c is None else str(c))
+        entry.row_count += len(rows)
+
+        if entry.pending_rows:
+            dpg.show_item(f"{entry.tag}/more")
+            suffix = ", more available"
+        else:
+            dpg.hide_item(f"{entry.tag}/more")
+            suffix = f", stopped at {self.ROW_CAP} row cap" if entry.is_capped else ""
+        dpg.set_value(f"{entry.tag}/status", f"{entry.row_count} rows in {entry.elapsed_ms:.1f}ms{suffix}")
+
     def append_history(self, entry: QueryHistoryEntry):
         self.query_history.append(entry)
         if len(self.query_history) > self.LIMIT_HISTORY:
+            self.query_history[0].release()
             dpg.delete_item(self.query_history[0].tag)
             del self.query_history[0]
-
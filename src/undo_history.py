@@ -0,0 +1,97 @@
+from dataclasses import dataclass
+from typing import *
+
+from .app_types import *
+from .db import Connection, UndoSpill
+from .edit_journal import EditJournal, EditOperation
+
+
+# Undo/redo replays the inverse ops that executors return, so each step costs about as much as the edit itself.
+# Only the newest entries stay in memory, older ones spill to history.db in batches and come back as undo reaches them.
+
+
+@dataclass
+class UndoEntry:
+    edit_op: EditOperation  # Shared with the edit history, merges into it keep redo current
+    inverse_op: EditOperation  # From the first execute, merges keep undoing back to before all of them
+
+
+class UndoHistory:
+    LIMIT_IN_MEMORY = 100
+    SPILL_BATCH = 50
+    LIMIT_REDO = 100
+
+    def __init__(self, location: PackIndexEntry):
+        self.location = location
+        self.undo_stack: List[UndoEntry] = []
+        self.redo_stack: List[UndoEntry] = []
+        self.spilled_count = 0
+
+    @staticmethod
+    def clear_spills() -> None:
+        # Spills are only valid for the session that made them
+        with Connection.writer() as conn:
+            UndoSpill.clear(conn)
+
+    def clear(self) -> None:
+        self.undo_stack.clear()
+        self.redo_stack.clear()
+        if self.spilled_count > 0:
+            with Connection.writer() as conn:
+                UndoSpill.clear_fullfile(conn, self.location.fullfile)
+            self.spilled_count = 0
+
+    @property
+    def can_undo(self) -> bool:
+        return bool(self.undo_stack) or self.spilled_count > 0
+
+    @property
+    def can_redo(self) -> bool:
+        return bool(self.redo_stack)
+
+    def peek_undo_op(self) -> Optional[EditOperation]:
+        return self.undo_stack[-1].edit_op if self.undo_stack else None
+
+    def push(self, entry: UndoEntry) -> None:
+        # A new edit branches off, whatever was undone can't be redone anymore
+        self.undo_stack.append(entry)
+        self.redo_stack.clear()
+        if len(self.undo_stack) > self.LIMIT_IN_MEMORY:
+            self.spill()
+
+    def pop_undo(self) -> Optional[UndoEntry]:
+        if not self.undo_stack and self.spilled_count > 0:
+            self.unspill()
+        if not self.undo_stack:
+            return None
+        entry = self.undo_stack.pop()
+        self.redo_stack.append(entry)
+        if len(self.redo_stack) > self.LIMIT_REDO:
+            del self.redo_stack[0]
+        return entry
+
+    def pop_redo(self) -> Optional[UndoEntry]:
+        if not self.redo_stack:
+            return None
+        entry = self.redo_stack.pop()
+        self.undo_stack.append(entry)
+        return entry
+
+    def spill(self) -> None:
+        batch, self.undo_stack = self.undo_stack[:self.SPILL_BATCH], self.undo_stack[self.SPILL_BATCH:]
+        rows = [
+            (self.location.fullfile, self.spilled_count + i, self.location.extension, EditJournal.dump_op(e.edit_op), EditJournal.dump_op(e.inverse_op))
+            for i, e in enumerate(batch)
+        ]
+        with Connection.writer() as conn:
+            UndoSpill.persist_many(conn, rows)
+        self.spilled_count += len(rows)
+
+    def unspill(self) -> None:
+        with Connection.writer() as conn:
+            rows = UndoSpill.pop_newest(conn, self.location.fullfile, self.SPILL_BATCH)
+        self.undo_stack = [
+            UndoEntry(EditJournal.load_op(file_type, op_json), EditJournal.load_op(file_type, inverse_op_json))
+            for _depth, file_type, op_json, inverse_op_json in rows
+        ] + self.undo_stack
+        self.spilled_count -= len(rows)